@@ -0,0 +1,58 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class BufferPool(object):
+    """ A pool of receive buffers grouped in power-of-two size classes.
+        A buffer taken from the pool is at least the requested size, and once
+        returned it is handed out again to the next request of the same class. """
+
+    def __init__(self, min_size=1024, max_cached_size=16777216, max_cached_per_class=4):
+        """ min_size:              smallest buffer handed out, in bytes
+            max_cached_size:       buffers larger than this are never kept in the pool
+            max_cached_per_class:  number of free buffers kept for each size class
+        """
+        self.min_size = min_size
+        self.max_cached_size = max_cached_size
+        self.max_cached_per_class = max_cached_per_class
+
+        # free buffers keyed by size class
+        self.free = {}
+
+    def size_class(self, nbytes):
+        """ return the smallest power of two that is at least nbytes and min_size """
+        size = self.min_size
+        while size < nbytes:
+            size *= 2
+        return size
+
+    def get(self, nbytes):
+        """ return a bytearray of at least nbytes """
+        size = self.size_class(nbytes)
+        if size > self.max_cached_size:
+            return bytearray(nbytes)
+        try:
+            return self.free[size].pop()
+        except (KeyError, IndexError):
+            return bytearray(size)
+
+    def put(self, buf):
+        """ return a buffer to the pool once it is no longer used """
+        size = len(buf)
+        if size > self.max_cached_size or size != self.size_class(size):
+            return
+        free = self.free.setdefault(size, [])
+        if len(free) < self.max_cached_per_class:
+            free.append(buf)
+
+    def cached_bytes(self):
+        """ total size of the free buffers held by the pool """
+        return sum(size * len(free) for size, free in self.free.items())
@@ -0,0 +1,148 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+import Queue
+import heapq
+import threading
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+
+class EventLoop(object):
+    """ Calls handlers for the messages of several sources, one at a time, in the order they arrive.
+
+        Each source is watched by its own thread, which puts what arrives on one internal
+        queue. run() blocks on that queue and calls the handlers from the thread it runs in,
+        so handlers need no locking among themselves and a message from one source is
+        handled as soon as it arrives instead of waiting for another source to time out.
+
+        Timers are kept in a heap and fired from the same queue by a timer thread. run()
+        blocks on the internal queue without a timeout, since on Python 2 Queue.get with a
+        timeout polls and wakes up late. """
+
+    def __init__(self, timer_resolution=0.1):
+        """ timer_resolution: longest time before the timer thread sees a timer added
+                                for a time earlier than the ones it is waiting for
+        """
+        self.timer_resolution = timer_resolution
+        self.events = Queue.Queue()
+        self.stopped = threading.Event()
+        self.running = False
+        self.threads = []
+
+        # (deadline, sequence, interval or None, callback)
+        self.timers = []
+        self.timer_lock = threading.Lock()
+        self.timer_sequence = 0
+
+    def post(self, handler, *args):
+        """ call handler(*args) from the loop, can be called from any thread """
+        self.events.put((handler, args))
+
+    def add_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        self.threads.append(thread)
+        # sources added by a handler start right away, the others when run() is called
+        if self.running:
+            thread.start()
+
+    def add_queue(self, queue, handler, timeout=1.):
+        """ call handler(message) for each message placed on queue, the queue is
+            watched with blocking gets of up to timeout seconds """
+        self.add_thread(self.watch_queue, queue, handler, timeout)
+
+    def add_poller(self, poll, handler, min_interval=0.0001, max_interval=0.001):
+        """ call handler(message) for each message returned by poll(), which returns None when
+            there is none. poll is called at intervals that start at min_interval after a
+            message and double up to max_interval while there are none """
+        self.add_thread(self.watch_poller, poll, handler, min_interval, max_interval)
+
+    def add_event(self, event, handler, timeout=1.):
+        """ call handler() once event is set """
+        self.add_thread(self.watch_event, event, handler, timeout)
+
+    def call_later(self, delay, callback):
+        self.add_timer(delay, None, callback)
+
+    def call_every(self, interval, callback):
+        self.add_timer(interval, interval, callback)
+
+    def add_timer(self, delay, interval, callback):
+        with self.timer_lock:
+            self.timer_sequence += 1
+            heapq.heappush(self.timers, (time.time() + delay, self.timer_sequence, interval, callback))
+
+    def run(self):
+        """ run the handlers until stop() is called """
+        self.running = True
+        self.add_thread(self.watch_timers)
+        for thread in self.threads:
+            if thread.ident is None:
+                thread.start()
+        try:
+            while not self.stopped.is_set():
+                handler, args = self.events.get()
+                if handler is None:
+                    continue
+                handler(*args)
+        finally:
+            self.stopped.set()
+            self.running = False
+            for thread in self.threads:
+                if thread.is_alive():
+                    thread.join()
+
+    def stop(self):
+        """ return from run() after the current handler, can be called from any thread """
+        self.stopped.set()
+        self.events.put((None, ()))
+
+    def watch_queue(self, queue, handler, timeout):
+        while not self.stopped.is_set():
+            try:
+                message = queue.get(block=True, timeout=timeout)
+            except Queue.Empty:
+                continue
+            self.post(handler, message)
+
+    def watch_poller(self, poll, handler, min_interval, max_interval):
+        interval = min_interval
+        while not self.stopped.is_set():
+            message = poll()
+            if message is not None:
+                self.post(handler, message)
+                interval = min_interval
+                continue
+            time.sleep(interval)
+            # back off while the source is quiet, but never past max_interval
+            interval = min(interval * 2, max_interval)
+
+    def watch_event(self, event, handler, timeout):
+        while not self.stopped.is_set():
+            event.wait(timeout)
+            if event.is_set():
+                self.post(handler)
+                return
+
+    def watch_timers(self):
+        while not self.stopped.is_set():
+            now = time.time()
+            with self.timer_lock:
+                while len(self.timers) > 0 and self.timers[0][0] <= now:
+                    deadline, sequence, interval, callback = heapq.heappop(self.timers)
+                    self.post(callback)
+                    if interval is not None:
+                        self.timer_sequence += 1
+                        # a timer that fell behind fires once, not once per missed interval
+                        heapq.heappush(self.timers, (max(deadline + interval, now), self.timer_sequence, interval, callback))
+                wait = self.timer_resolution
+                if len(self.timers) > 0:
+                    wait = min(wait, self.timers[0][0] - now)
+            time.sleep(max(wait, 0))
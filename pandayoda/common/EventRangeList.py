@@ -7,6 +7,7 @@
 # - Taylor Childers (john.taylor.childers@cern.ch)
 # - Paul Nilsson (paul.nilsson@cern.ch)
 
+import array
 import logging
 import EventRange
 
@@ -25,61 +26,178 @@ class EventRangeIdNotFound(Exception):
     pass
 
 
+class StringTable(object):
+    """ interns the strings of one column, each distinct string is stored once
+        and rows refer to it by index """
+
+    def __init__(self):
+        self.strings = []
+        self.indices = {}
+
+    def index(self, string):
+        try:
+            return self.indices[string]
+        except KeyError:
+            i = len(self.strings)
+            self.strings.append(string)
+            self.indices[string] = i
+            return i
+
+    def __getitem__(self, i):
+        return self.strings[i]
+
+    def __len__(self):
+        return len(self.strings)
+
+
 class EventRangeList(object):
+    """ The event ranges of a job stored column-wise: each range is a row, the
+        start/last events and state of all rows are kept in arrays, and LFN,
+        GUID and scope are interned in StringTables. Only the range id is kept
+        as a python string per range. EventRange objects are created on access,
+        changes to them are not reflected in the list, use the mark_* methods. """
+
+    # row state codes, the index in EventRange.STATES, DELETED marks removed rows
+    COMPLETED = EventRange.EventRange.STATES.index(EventRange.EventRange.COMPLETED)
+    ASSIGNED = EventRange.EventRange.STATES.index(EventRange.EventRange.ASSIGNED)
+    READY = EventRange.EventRange.STATES.index(EventRange.EventRange.READY)
+    DELETED = -1
+
     def __init__(self, eventranges=None):
         """ initialize object, can pass optional argument:
             eventranges:      list that looks like this
                  [{"eventRangeID": "8848710-3005316503-6391858827-3-10",
                  "LFN":"EVNT.06402143._012906.pool.root.1", "lastEvent": 3, "startEvent": 3,
                  "scope": "mc15_13TeV", "GUID": "63A015D3-789D-E74D-BAA9-9F95DB068EE9"}]
-
-          some warnings: this class assumes that the list of EventRange objects is always orded by the
-                        EventRange.STATES list, with READY being at the end.
         """
 
-        # internal list of EventRange objects key-ed by id
-        self.eventranges = {}
+        # row index of each range id, and the id of each row (None once deleted)
+        self.rows = {}
+        self.ids = []
+
+        # columns
+        self.start_events = array.array('l')
+        self.last_events = array.array('l')
+        self.states = array.array('b')
+        self.lfn_index = array.array('i')
+        self.guid_index = array.array('i')
+        self.scope_index = array.array('i')
+
+        self.lfns = StringTable()
+        self.guids = StringTable()
+        self.scopes = StringTable()
+
+        # number of rows in each state, indexed by state code
+        self.state_counts = [0] * len(EventRange.EventRange.STATES)
 
         # flag to track if no events remain
         self.no_more_event_ranges = False
 
-        # internal list of indices of those ranges which have already been assigned to droid ranks
-        # indices point back to self.eventranges
-        self.ids_by_state = {}
-        for state in EventRange.EventRange.STATES:
-            self.ids_by_state[state] = []
+        # ready rows in the order they became ready, get_next pops from the end.
+        # Rows that left the READY state are not removed here but skipped when popped.
+        self.ready_stack = array.array('l')
 
         if eventranges:
             self.fill_from_list(eventranges)
 
     def number_processing(self):
         """ provide the number of ranges still to be completed """
-        return len(self.eventranges) - self.number_completed()
+        return len(self.rows) - self.number_completed()
 
     def number_assigned(self):
         """ provide the number of ranges assigned """
-        return len(self.ids_by_state[EventRange.EventRange.ASSIGNED])
+        return self.state_counts[self.ASSIGNED]
 
     def number_completed(self):
         """ provide the number of ranges completed """
-        return len(self.ids_by_state[EventRange.EventRange.COMPLETED])
+        return self.state_counts[self.COMPLETED]
 
     def number_ready(self):
         """ provide the number of ranges completed """
-        return len(self.ids_by_state[EventRange.EventRange.READY])
+        return self.state_counts[self.READY]
 
     def fill_from_list(self, list_of_eventrange_dicts):
         for eventrange in list_of_eventrange_dicts:
-            self.append(EventRange.EventRange(eventrange))
+            self.add_row(eventrange['eventRangeID'], eventrange['LFN'], eventrange['GUID'], eventrange['scope'],
+                         eventrange['startEvent'], eventrange['lastEvent'], self.READY)
+
+    def add_row(self, eventrangeid, lfn, guid, scope, start_event, last_event, state, push_ready=True):
+        """ add a range, or overwrite the range with the same id, returns its row """
+        row = self.rows.get(eventrangeid)
+        if row is None:
+            row = len(self.ids)
+            self.rows[eventrangeid] = row
+            self.ids.append(eventrangeid)
+            self.start_events.append(start_event)
+            self.last_events.append(last_event)
+            self.states.append(state)
+            self.lfn_index.append(self.lfns.index(lfn))
+            self.guid_index.append(self.guids.index(guid))
+            self.scope_index.append(self.scopes.index(scope))
+        else:
+            self.state_counts[self.states[row]] -= 1
+            self.start_events[row] = start_event
+            self.last_events[row] = last_event
+            self.states[row] = state
+            self.lfn_index[row] = self.lfns.index(lfn)
+            self.guid_index[row] = self.guids.index(guid)
+            self.scope_index[row] = self.scopes.index(scope)
+        self.state_counts[state] += 1
+        if state == self.READY and push_ready:
+            self.push_ready(row)
+        return row
+
+    def dump(self):
+        """ return the ranges and their states as a structure that can be written as JSON """
+        ranges = []
+        for row, eventrangeid in enumerate(self.ids):
+            if eventrangeid is None:
+                continue
+            ranges.append([eventrangeid, self.lfn_index[row], self.guid_index[row], self.scope_index[row],
+                           self.start_events[row], self.last_events[row], self.states[row]])
+        return {'LFN': list(self.lfns.strings),
+                'GUID': list(self.guids.strings),
+                'scope': list(self.scopes.strings),
+                'ranges': ranges,
+                'no_more_event_ranges': self.no_more_event_ranges}
+
+    def load(self, data):
+        """ add the ranges of a structure returned by dump(), ranges that were assigned are
+            made ready again since the rank they were sent to no longer holds them """
+        for eventrangeid, lfn, guid, scope, start_event, last_event, state in data['ranges']:
+            if state == self.ASSIGNED:
+                state = self.READY
+            self.add_row(eventrangeid, data['LFN'][lfn], data['GUID'][guid], data['scope'][scope],
+                         start_event, last_event, state)
+        self.no_more_event_ranges = self.no_more_event_ranges or data['no_more_event_ranges']
+
+    def get_row_dict(self, row):
+        return {'eventRangeID': self.ids[row],
+                'LFN': self.lfns[self.lfn_index[row]],
+                'scope': self.scopes[self.scope_index[row]],
+                'startEvent': self.start_events[row],
+                'lastEvent': self.last_events[row],
+                'GUID': self.guids[self.guid_index[row]]}
+
+    def get_row_eventrange(self, row):
+        eventrange = EventRange.EventRange(self.get_row_dict(row))
+        eventrange.state = EventRange.EventRange.STATES[self.states[row]]
+        return eventrange
+
+    def set_row_state(self, row, state):
+        self.state_counts[self.states[row]] -= 1
+        self.states[row] = state
+        self.state_counts[state] += 1
 
     def change_eventrange_state(self, eventrangeid, new_state):
-        if eventrangeid in self.eventranges:
+        if eventrangeid in self.rows:
             logger.debug('changing id %s to %s', eventrangeid, new_state)
-            eventrange = self.eventranges[eventrangeid]
-            logger.debug('current state of id %s is %s', eventrangeid, eventrange.state)
-            self.ids_by_state[eventrange.state].remove(eventrange.id)
-            eventrange.state = new_state
-            self.ids_by_state[eventrange.state].append(eventrange.id)
+            row = self.rows[eventrangeid]
+            logger.debug('current state of id %s is %s', eventrangeid, EventRange.EventRange.STATES[self.states[row]])
+            state = EventRange.EventRange.STATES.index(new_state)
+            self.set_row_state(row, state)
+            if state == self.READY:
+                self.push_ready(row)
         else:
             raise EventRangeIdNotFound('eventRangeID %s not found' % eventrangeid)
 
@@ -91,92 +209,184 @@ class EventRangeList(object):
         logger.debug('marking eventRangeID %s as assigned', eventrangeid)
         self.change_eventrange_state(eventrangeid, EventRange.EventRange.ASSIGNED)
 
+    def mark_ready(self, eventrangeid):
+        """ return an assigned event range to the ready ranges, returns False if it is not assigned """
+        row = self.rows.get(eventrangeid)
+        if row is None:
+            raise EventRangeIdNotFound('eventRangeID %s not found' % eventrangeid)
+        if self.states[row] != self.ASSIGNED:
+            return False
+        logger.debug('marking eventRangeID %s as ready', eventrangeid)
+        self.set_row_state(row, self.READY)
+        self.push_ready(row)
+        return True
+
     def get_next(self, number_of_ranges=1):
         """ method for retrieving number_of_ranges worth of event ranges,
               which will be marked as 'assigned'
         """
         logger.debug('getting %d event ranges.', number_of_ranges)
         if self.number_ready() <= 0:
-            raise NoMoreEventRanges(' number ready = %d; len(eventranges) = %d' % (self.number_ready(), len(self.eventranges)))
+            raise NoMoreEventRanges(' number ready = %d; len(eventranges) = %d' % (self.number_ready(), len(self.rows)))
         if self.number_ready() < number_of_ranges:
             raise RequestedMoreRangesThanAvailable
         output = []
         for i in range(number_of_ranges):
-            # pop one id off the ready list
-            _id = self.ids_by_state[EventRange.EventRange.READY].pop()
+            # pop one row off the ready stack, skipping rows no longer ready
+            row = self.ready_stack.pop()
+            while self.states[row] != self.READY:
+                row = self.ready_stack.pop()
 
-            # add the dictionary from the event range for that id to the output
-            output.append(self.eventranges[_id].get_dict())
-            self.eventranges[_id].set_assigned()
-            self.ids_by_state[EventRange.EventRange.ASSIGNED].append(_id)
+            # add the dictionary from the event range for that row to the output
+            output.append(self.get_row_dict(row))
+            self.set_row_state(row, self.ASSIGNED)
 
-            logger.debug('marked id %s as assigned', _id)
+            logger.debug('marked id %s as assigned', self.ids[row])
 
         return output
 
+    def push_ready(self, row):
+        """ put a row on top of the ready stack, dropping stale entries once they dominate it """
+        self.ready_stack.append(row)
+        if len(self.ready_stack) > 2 * self.number_ready() + 1024:
+            self.compact_ready_stack()
+
+    def compact_ready_stack(self):
+        """ remove the rows that are no longer ready, or listed twice, from the ready stack """
+        seen = set()
+        stack = array.array('l')
+        # walk from the top so the most recent entry of a row is the one kept
+        for row in reversed(self.ready_stack):
+            if self.states[row] == self.READY and row not in seen:
+                seen.add(row)
+                stack.append(row)
+        stack.reverse()
+        self.ready_stack = stack
+
     def __add__(self, other):
         if isinstance(other, EventRangeList):
             newone = EventRangeList()
 
             # combine range lists
-            for eventrangeid, eventrange in self.iteritems():
-                newone.append(eventrange)
-            for eventrangeid, eventrange in other.iteritems():
-                newone.append(eventrange)
-
-            # combine the lists of ids_by_state
-            for state in EventRange.EventRange.STATES:
-                newone.ids_by_state[state] = self.ids_by_state[state] + other.ids_by_state[state]
+            for erl in (self, other):
+                for row, eventrangeid in enumerate(erl.ids):
+                    if eventrangeid is not None:
+                        newone.add_row(eventrangeid, erl.lfns[erl.lfn_index[row]], erl.guids[erl.guid_index[row]],
+                                       erl.scopes[erl.scope_index[row]], erl.start_events[row], erl.last_events[row],
+                                       erl.states[row], push_ready=False)
+
+            # keep the ready order of both lists
+            for erl in (self, other):
+                for row in erl.ready_stack:
+                    if erl.states[row] == self.READY:
+                        newone.ready_stack.append(newone.rows[erl.ids[row]])
+            newone.compact_ready_stack()
 
             return newone
         else:
             raise TypeError('other is not of type EventRangeList: %s' % type(other).__name__)
 
+    def extend(self, eventranges):
+        """ merge ranges into this list in place, eventranges is another EventRangeList
+            or a list of event range dictionaries. Ranges whose id is already in the
+            list, e.g. re-delivered by Harvester, are skipped. Returns the number added. """
+        added = 0
+        skipped = 0
+        if isinstance(eventranges, EventRangeList):
+            other = eventranges
+            new_rows = {}
+            for row, eventrangeid in enumerate(other.ids):
+                if eventrangeid is None:
+                    continue
+                if eventrangeid in self.rows:
+                    skipped += 1
+                    continue
+                new_rows[row] = self.add_row(eventrangeid, other.lfns[other.lfn_index[row]], other.guids[other.guid_index[row]],
+                                             other.scopes[other.scope_index[row]], other.start_events[row],
+                                             other.last_events[row], other.states[row], push_ready=False)
+                added += 1
+            # keep the ready order of the other list, on top of the ranges already here
+            for row in other.ready_stack:
+                if row in new_rows and other.states[row] == self.READY:
+                    self.push_ready(new_rows[row])
+        else:
+            for eventrange in eventranges:
+                if eventrange['eventRangeID'] in self.rows:
+                    skipped += 1
+                    continue
+                self.add_row(eventrange['eventRangeID'], eventrange['LFN'], eventrange['GUID'], eventrange['scope'],
+                             eventrange['startEvent'], eventrange['lastEvent'], self.READY)
+                added += 1
+
+        if skipped > 0:
+            logger.warning('skipped %d event ranges already in the list, added %d', skipped, added)
+        return added
+
+    def __iadd__(self, other):
+        if isinstance(other, EventRangeList):
+            self.extend(other)
+            return self
+        else:
+            raise TypeError('other is not of type EventRangeList: %s' % type(other).__name__)
+
     def append(self, eventrange):
         if isinstance(eventrange, EventRange.EventRange):
-            self.eventranges[eventrange.id] = eventrange
-            self.ids_by_state[eventrange.state].append(eventrange.id)
+            self.add_row(eventrange.id, eventrange.lfn, eventrange.GUID, eventrange.scope,
+                         eventrange.startEvent, eventrange.lastEvent,
+                         EventRange.EventRange.STATES.index(eventrange.state))
         else:
             raise TypeError('object is not of type EventRange: %s' % type(eventrange).__name__)
 
     def pop(self, key, default=None):
-        return self.eventranges.pop(key, default)
+        if key not in self.rows:
+            return default
+        eventrange = self[key]
+        del self[key]
+        return eventrange
 
     def iteritems(self):
-        return self.eventranges.iteritems()
+        for eventrangeid, row in self.rows.iteritems():
+            yield eventrangeid, self.get_row_eventrange(row)
 
     def keys(self):
-        return self.eventranges.keys()
+        return self.rows.keys()
 
     def values(self):
-        return self.eventranges.values()
+        return [self.get_row_eventrange(row) for row in self.rows.itervalues()]
 
     def get(self, key, default=None):
-        return self.eventranges.get(key, default)
+        if key in self.rows:
+            return self[key]
+        return default
 
     def has_key(self, key):
-        return key in self.eventranges
+        return key in self.rows
 
     def __iter__(self, key):
-        return iter(self.eventranges)
+        return iter(self.rows)
 
     def __len__(self):
-        return len(self.eventranges)
+        return len(self.rows)
 
     def __getitem__(self, key):
-        return self.eventranges[key]
+        return self.get_row_eventrange(self.rows[key])
 
     def __setitem__(self, key, value):
         if isinstance(value, EventRange.EventRange):
-            self.eventranges[key] = value
+            self.add_row(key, value.lfn, value.GUID, value.scope, value.startEvent, value.lastEvent,
+                         EventRange.EventRange.STATES.index(value.state))
         else:
             raise TypeError('object is not of type EventRange: %s' % type(value).__name__)
 
     def __delitem__(self, key):
-        del self.eventranges[key]
+        # the row is left in the columns, marked deleted
+        row = self.rows.pop(key)
+        self.state_counts[self.states[row]] -= 1
+        self.states[row] = self.DELETED
+        self.ids[row] = None
 
     def __contains__(self, key):
-        return self.eventranges.__contains__(key)
+        return self.rows.__contains__(key)
 
 
 # testing this thread
@@ -259,3 +469,8 @@ if __name__ == '__main__':
 
     erl3 = erl + erl2
     logger.info('3 n-ready: %d  n-processing: %d', erl3.number_ready(), erl3.number_processing())
+
+    logger.info(' testing extend function')
+    erl4 = EventRangeList(_l[:2])
+    added = erl4.extend(_l)
+    logger.info('4 added: %d  n-ready: %d  n-processing: %d', added, erl4.number_ready(), erl4.number_processing())
@@ -0,0 +1,127 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+import os
+import errno
+import select
+import time
+import ctypes
+import ctypes.util
+import logging
+logger = logging.getLogger(__name__)
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class FileWatcher(object):
+    """ Waits for files to appear or disappear. On Linux the directories holding the files
+        are watched with inotify, so a change made on this node wakes the waiter at once.
+        Changes made on other nodes of a shared file system do not raise inotify events,
+        so the files are also checked every poll_interval seconds. Where inotify is not
+        available only the polling is used.
+
+        The watcher holds a file descriptor and drains its events while waiting, create
+        one per thread that waits. """
+
+    def __init__(self, poll_interval=1., use_inotify=True):
+        """ poll_interval:  seconds between checks of the file, with or without inotify
+            use_inotify:    set False to only poll
+        """
+        self.poll_interval = poll_interval
+
+        # inotify file descriptor and the watched directories
+        self.fd = None
+        self.watches = {}
+
+        if use_inotify:
+            self.init_inotify()
+
+    def init_inotify(self):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            self.fd = fd
+        except (OSError, AttributeError):
+            logger.warning('inotify is not available, polling every %s seconds instead', self.poll_interval, exc_info=True)
+            self.fd = None
+
+    def using_inotify(self):
+        return self.fd is not None
+
+    def watch_directory(self, path):
+        """ make sure the directory holding path is watched, returns False if it cannot be """
+        if self.fd is None:
+            return False
+        directory = os.path.dirname(os.path.abspath(path))
+        if directory in self.watches:
+            return True
+        wd = self.libc.inotify_add_watch(self.fd, directory.encode('utf-8'), WATCH_MASK)
+        if wd < 0:
+            logger.warning('failed to watch %s: %s, polling it instead', directory, os.strerror(ctypes.get_errno()))
+            return False
+        self.watches[directory] = wd
+        return True
+
+    def drain(self):
+        """ discard the pending inotify events, they are only used as a wake up """
+        while True:
+            try:
+                if not os.read(self.fd, 65536):
+                    return
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+    def wait_for(self, path, exists=True, timeout=None):
+        """ wait until os.path.exists(path) equals exists, returns False if timeout seconds pass first """
+        watched = self.watch_directory(path)
+        if watched:
+            self.drain()
+
+        start = time.time()
+        while True:
+            if os.path.exists(path) == exists:
+                return True
+
+            wait = self.poll_interval
+            if timeout is not None:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+
+            if watched:
+                try:
+                    readable = select.select([self.fd], [], [], wait)[0]
+                except select.error as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    readable = []
+                if readable:
+                    self.drain()
+            else:
+                time.sleep(wait)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.watches = {}
@@ -0,0 +1,78 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+import math
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LatencyHistogram(object):
+    """ Histogram of latencies in seconds with logarithmic bins, bin i covers
+        [min_latency * 2**(i-1), min_latency * 2**i), the first bin everything below
+        min_latency and the last everything above the largest edge. Percentiles are
+        reported as the upper edge of the bin they fall in. """
+
+    def __init__(self, min_latency=0.00001, nbins=28):
+        """ min_latency:    upper edge of the first bin in seconds
+            nbins:          number of bins, the default reaches about 20 minutes
+        """
+        self.min_latency = min_latency
+        self.nbins = nbins
+        self.reset()
+
+    def reset(self):
+        self.bins = [0] * self.nbins
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+    def bin_index(self, latency):
+        if latency < self.min_latency:
+            return 0
+        index = int(math.log(latency / self.min_latency, 2)) + 1
+        return min(index, self.nbins - 1)
+
+    def upper_edge(self, index):
+        return self.min_latency * 2 ** index
+
+    def record(self, latency):
+        self.bins[self.bin_index(latency)] += 1
+        self.count += 1
+        self.total += latency
+        if self.min is None or latency < self.min:
+            self.min = latency
+        if self.max is None or latency > self.max:
+            self.max = latency
+
+    def mean(self):
+        if self.count == 0:
+            return 0.
+        return self.total / self.count
+
+    def percentile(self, fraction):
+        """ return the upper edge of the bin holding the given fraction (0 to 1) of the latencies """
+        if self.count == 0:
+            return 0.
+        target = fraction * self.count
+        running = 0
+        for index, content in enumerate(self.bins):
+            running += content
+            if running >= target:
+                # the last bin has no upper edge
+                if index == self.nbins - 1:
+                    return self.max
+                return min(self.upper_edge(index), self.max)
+        return self.max
+
+    def summary(self):
+        if self.count == 0:
+            return 'no entries'
+        return 'n=%d mean=%.6f min=%.6f p50<=%.6f p90<=%.6f p99<=%.6f max=%.6f seconds' % (
+            self.count, self.mean(), self.min, self.percentile(0.5),
+            self.percentile(0.9), self.percentile(0.99), self.max)
@@ -8,10 +8,11 @@
 
 import logging
 import time
-import sys
-import copy
 from pandayoda.common import MessageTypes
 from pandayoda.common import VariableWithLock
+from pandayoda.common import SendTracker
+from pandayoda.common import BufferPool
+from pandayoda.common import binary_serializer
 from Queue import Empty
 from pandayoda.common import StatefulService
 
@@ -34,11 +35,31 @@ class MPIService(StatefulService.StatefulService):
 
     STATES = [CREATED, INITILIZED, BALANCED_MODE, MPI_BLOCKING_MODE, QUEUE_BLOCKING_MODE, EXITED]
 
+    # probe for incoming messages and receive them into buffers sized to the message,
+    # needs the MPI-3 matched probe (MPI_Improbe, MPI_Mrecv)
+    PROBE_RECEIVE = 'probe'
+    # keep one irecv posted with a buffer of default_message_buffer_size bytes
+    IRECV_RECEIVE = 'irecv'
+
+    RECEIVE_MODES = [PROBE_RECEIVE, IRECV_RECEIVE]
+
+    # messages are sent as pickles or in the compact format of binary_serializer
+    PICKLE_WIRE_FORMAT = 'pickle'
+    BINARY_WIRE_FORMAT = 'binary'
+
+    WIRE_FORMATS = [PICKLE_WIRE_FORMAT, BINARY_WIRE_FORMAT]
+
     def __init__(self, queue_list, queue_map,
                  loglevel='INFO',
                  debug_message_char_length=200,
                  default_message_buffer_size=10000000,
                  loop_timeout=30,
+                 min_poll_interval=0.0001,
+                 max_poll_interval=0.001,
+                 max_in_flight_bytes=100000000,
+                 detach_sends=False,
+                 receive_mode=IRECV_RECEIVE,
+                 wire_format=PICKLE_WIRE_FORMAT,
                  ):
         # call init of Thread class
         super(MPIService, self).__init__(loop_timeout)
@@ -55,6 +76,34 @@ class MPIService(StatefulService.StatefulService):
         self.debug_message_char_length = debug_message_char_length
         self.default_message_buffer_size = default_message_buffer_size
 
+        # while blocking, MPI is tested at intervals that start at min_poll_interval
+        # and double up to max_poll_interval, in between it waits on the message queue
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+
+        # a message taken from the queue while waiting on MPI, sent on the next loop
+        self.queued_message = None
+
+        # outgoing messages are held back while more than max_in_flight_bytes
+        # are waiting on MPI, unless detach_sends is set (see SendTracker)
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.detach_sends = detach_sends
+
+        # how incoming messages are received, the probe mode is opt-in since it needs an
+        # MPI library with the MPI-3 matched probe, without one irecv is used instead
+        if receive_mode not in self.RECEIVE_MODES:
+            raise Exception('receive_mode must be one of %s, not %s' % (self.RECEIVE_MODES, receive_mode))
+        self.receive_mode = receive_mode
+
+        # the format of outgoing messages, incoming messages are recognized by their
+        # header so ranks can be switched one at a time. Binary messages can only be
+        # received in the probe mode, the irecv mode always unpickles.
+        if wire_format not in self.WIRE_FORMATS:
+            raise Exception('wire_format must be one of %s, not %s' % (self.WIRE_FORMATS, wire_format))
+        if wire_format == self.BINARY_WIRE_FORMAT and receive_mode != self.PROBE_RECEIVE:
+            raise Exception('wire_format %s requires receive_mode %s' % (wire_format, self.PROBE_RECEIVE))
+        self.wire_format = wire_format
+
         self.set_state(self.CREATED)
 
     def set_balanced(self):
@@ -76,7 +125,7 @@ class MPIService(StatefulService.StatefulService):
         return self.in_state(self.QUEUE_BLOCKING_MODE)
 
     def message_queue_empty(self):
-        return self.queues['MPIService'].empty()
+        return self.queued_message is None and self.queues['MPIService'].empty()
 
     def queue_map_is_set(self):
         self.queue_map_set.set()
@@ -148,10 +197,22 @@ class MPIService(StatefulService.StatefulService):
         self.logger.info('debug_message_char_length:   %s', self.debug_message_char_length)
         self.logger.info('default_message_buffer_size: %s', self.default_message_buffer_size)
         self.logger.info('loop_timeout:                %s', self.loop_timeout)
+        self.logger.info('min_poll_interval:           %s', self.min_poll_interval)
+        self.logger.info('max_poll_interval:           %s', self.max_poll_interval)
+        self.logger.info('max_in_flight_bytes:         %s', self.max_in_flight_bytes)
+        self.logger.info('detach_sends:                %s', self.detach_sends)
+        self.check_receive_mode()
+        self.logger.info('receive_mode:                %s', self.receive_mode)
+        self.logger.info('wire_format:                 %s', self.wire_format)
 
         self.receiveRequest = None
 
-        self.send_requests = []
+        # buffers for messages received in the probe mode
+        self.buffer_pool = BufferPool.BufferPool()
+
+        # outstanding isend requests
+        self.send_tracker = SendTracker.SendTracker(MPI, self.max_in_flight_bytes, self.detach_sends)
+        last_metrics_time = time.time()
 
         # set initial state
         self.set_balanced()
@@ -166,17 +227,30 @@ class MPIService(StatefulService.StatefulService):
 
         while not self.exit.is_set():
             self.logger.debug('starting loop, queue empty = %s, state = %s',
-                              self.queues['MPIService'].empty(), self.get_state())
+                              self.message_queue_empty(), self.get_state())
+
+            # release the buffers of sends that have completed
+            self.send_tracker.reap()
+            if time.time() - last_metrics_time > self.loop_timeout:
+                self.logger.info('send metrics: %s', self.send_tracker.get_metrics())
+                last_metrics_time = time.time()
+
+            # too much data waiting on MPI, only receive until the sends drain
+            if not self.send_tracker.has_space():
+                self.logger.debug('%s bytes in flight, holding back sends', self.send_tracker.in_flight_bytes)
+                message = self.receive_message(block=True, timeout=self.max_poll_interval, watch_queue=False)
+                if message is not None:
+                    self.forward_message(message)
+                continue
 
             # check for incoming message
-            if no_message_on_last_loop and self.in_mpi_blocking():
-                self.logger.info('block on mpi for %s', self.loop_timeout)
+            # in MPI_BLOCKING_MODE and BALANCED_MODE the blocking receive also
+            # watches the message queue and returns as soon as either has input
+            if no_message_on_last_loop and (self.in_mpi_blocking() or self.in_balanced()):
+                self.logger.debug('block on mpi and queue for %s', self.loop_timeout)
                 message = self.receive_message(block=True, timeout=self.loop_timeout)
-            elif no_message_on_last_loop and self.in_balanced() and self.queues['MPIService'].empty():
-                self.logger.info('block on mpi for %s', self.loop_timeout / 2)
-                message = self.receive_message(block=True, timeout=self.loop_timeout / 2)
             else:
-                self.logger.info('check for mpi message')
+                self.logger.debug('check for mpi message')
                 message = self.receive_message()
 
             # if message received forward it on
@@ -193,19 +267,16 @@ class MPIService(StatefulService.StatefulService):
                 # forward message
                 self.forward_message(message)
             else:
-                self.logger.info('no message from MPI')
+                self.logger.debug('no message from MPI')
 
             # check for messages on the queue that need to be sent
             try:
                 if no_message_on_last_loop and self.in_queue_blocking():
-                    self.logger.info('block on queue for %s', self.loop_timeout)
-                    qmsg = self.queues['MPIService'].get(block=True, timeout=self.loop_timeout)
-                elif no_message_on_last_loop and self.in_balanced():
-                    self.logger.info('block on queue for %s', self.loop_timeout / 2)
-                    qmsg = self.queues['MPIService'].get(block=True, timeout=self.loop_timeout / 2)
+                    self.logger.debug('block on queue for %s', self.loop_timeout)
+                    qmsg = self.get_queue_message(block=True, timeout=self.loop_timeout)
                 else:
-                    self.logger.info('check for queue message')
-                    qmsg = self.queues['MPIService'].get(block=False)
+                    self.logger.debug('check for queue message')
+                    qmsg = self.get_queue_message(block=False)
 
                 # record that we received a message this loop
                 no_message_on_last_loop = False
@@ -229,29 +300,7 @@ class MPIService(StatefulService.StatefulService):
                     tag = qmsg['tag']
 
                 # send message
-                msgbuff = copy.deepcopy(qmsg)
-                self.logger.info('sending msg of size %s bytes and type %s with destination %s', sys.getsizeof(msgbuff), msgbuff['type'], destination_rank)
-                if tag is None:
-                    send_request = MPI.COMM_WORLD.isend(msgbuff, dest=destination_rank)
-                else:
-                    send_request = MPI.COMM_WORLD.isend(msgbuff, dest=destination_rank, tag=tag)
-
-                # On Theta I saw strange MPI behavior when waiting for the request
-                # from a non-blocking send (isend) which caused upto 20minute waits.
-                # This request should only be waiting for MPI to copy my data into
-                # its own buffer, but takes too long. This is a stop gap, which just
-                # appends the message to a dictionary (after a deepcopy of the original)
-                # and then moves on. It doesn't come back to check if it completed.
-                # I should eventually make this an 'optional' patch to enable and disable.
-                self.send_requests.append({'msg': msgbuff, 'dest': destination_rank, 'tag': tag, 'req': send_request})
-
-                # This was the previous code, which properly checks the isend request
-                # has completed.
-
-                # wait for send to complete
-                # self.logger.debug('wait for send to complete')
-                # send_request.wait()
-                # self.logger.debug('send complete')
+                self.send_message(qmsg, destination_rank, tag)
 
             except Empty:
                 self.logger.debug('no message from message queue')
@@ -265,44 +314,113 @@ class MPIService(StatefulService.StatefulService):
         self.MPI.COMM_WORLD.Barrier()
         self.logger.info('exiting')
 
-    def receive_message(self, block=False, timeout=None):
-        # there should always be a request waiting for this rank to receive data
-        self.logger.debug('receive_message: entering function')
-        if self.receiveRequest is None:
-            self.logger.debug('receive_message: creating request')
-            self.receiveRequest = self.MPI.COMM_WORLD.irecv(self.default_message_buffer_size, self.MPI.ANY_SOURCE)
-        # check status of current request
-        if self.receiveRequest is not None:
-            self.logger.debug('receive_message: checking request state')
-            starttime = time.time()
-            self.logger.debug('receive_message: enter block loop, block = %s, timeout = %s', block, timeout)
-            while True:
-                # self.logger.debug('check for MPI message')
-                status = self.MPI.Status()
-                # test to see if message was received
-                self.logger.debug('receive_message: test request')
-                message_received, message = self.receiveRequest.test(status=status)
-                self.logger.debug('receive_message: done testing')
-                # if received reset and return source rank and message content
-                if message_received:
-                    # self.logger.debug('MPI message received: %s',message)
-                    self.receiveRequest = None
-                    # add source rank to the message
-                    message['source_rank'] = status.Get_source()
-                    return message
-
-                duration = time.time() - starttime
-                if not block or duration > timeout:
-                    self.logger.debug('receive_message: receive timed out exiting blocking MPI receive loop')
-                    return None
-                elif not self.queues['MPIService'].empty():
-                    self.logger.debug('receive_message: message queue has input exiting blocking MPI receive loop')
-                    return None
-                else:
-                    # self.logger.debug('sleep 1 second: block=%s timeout=%s time=%s',block,timeout,duration)
-                    time.sleep(1)
-        # no message received return nothing
-        return None
+    def receive_message(self, block=False, timeout=None, watch_queue=True):
+        """ test for an incoming MPI message, if block is True wait upto timeout seconds for one.
+            While blocking, the message queue is watched as well (unless watch_queue is False)
+            and the function returns None as soon as a message is placed on it, that message
+            is kept for get_queue_message.
+        """
+        starttime = time.time()
+        poll_interval = self.min_poll_interval
+        status = self.MPI.Status()
+        while True:
+            # test to see if message was received
+            message_received, message = self.test_for_message(status)
+            # if received return source rank and message content
+            if message_received:
+                # add source rank to the message
+                message['source_rank'] = status.Get_source()
+                return message
+
+            if not block or time.time() - starttime > timeout:
+                return None
+
+            if not watch_queue:
+                time.sleep(poll_interval)
+            # rather than sleeping between tests of the MPI request, wait on the
+            # message queue so outgoing messages are picked up immediately
+            elif self.queued_message is None:
+                try:
+                    self.queued_message = self.queues['MPIService'].get(block=True, timeout=poll_interval)
+                except Empty:
+                    pass
+            if watch_queue and self.queued_message is not None:
+                self.logger.debug('receive_message: message queue has input exiting blocking MPI receive loop')
+                return None
+
+            # back off while the line is quiet, but never past max_poll_interval
+            poll_interval = min(poll_interval * 2, self.max_poll_interval)
+
+    def check_receive_mode(self):
+        """ fall back to the irecv mode if the MPI library has no matched probe """
+        if self.receive_mode != self.PROBE_RECEIVE:
+            return
+        version = self.MPI.Get_version()
+        if version >= (3, 0) and hasattr(self.MPI.COMM_WORLD, 'Improbe'):
+            return
+        if self.wire_format == self.BINARY_WIRE_FORMAT:
+            raise Exception('wire_format %s requires receive_mode %s, which needs MPI-3 but the MPI library is version %s.%s'
+                            % (self.wire_format, self.PROBE_RECEIVE, version[0], version[1]))
+        self.logger.warning('receive_mode %s needs MPI-3 matched probe but the MPI library is version %s.%s, using %s',
+                            self.PROBE_RECEIVE, version[0], version[1], self.IRECV_RECEIVE)
+        self.receive_mode = self.IRECV_RECEIVE
+
+    def test_for_message(self, status):
+        """ non-blocking check for an incoming message, returns (received, message) """
+        if self.receive_mode == self.IRECV_RECEIVE:
+            # there should always be a request waiting for this rank to receive data
+            if self.receiveRequest is None:
+                self.logger.debug('test_for_message: creating request')
+                self.receiveRequest = self.MPI.COMM_WORLD.irecv(self.default_message_buffer_size, self.MPI.ANY_SOURCE)
+            message_received, message = self.receiveRequest.test(status=status)
+            if message_received:
+                self.receiveRequest = None
+            return message_received, message
+
+        # match a pending message, if any, which gives its exact size
+        mpi_message = self.MPI.COMM_WORLD.Improbe(self.MPI.ANY_SOURCE, self.MPI.ANY_TAG, status)
+        if mpi_message is None:
+            return False, None
+
+        nbytes = status.Get_count(self.MPI.BYTE)
+        buf = self.buffer_pool.get(nbytes)
+        try:
+            mpi_message.Recv([buf, nbytes, self.MPI.BYTE])
+            if binary_serializer.is_binary(buf):
+                message = binary_serializer.deserialize(buf, nbytes)
+            else:
+                message = self.MPI.pickle.loads(memoryview(buf)[:nbytes].tobytes())
+        finally:
+            self.buffer_pool.put(buf)
+        return True, message
+
+    def send_message(self, qmsg, destination_rank, tag=None):
+        """ serialize the message once and send the resulting buffer with a non-blocking send.
+            The buffer is owned by the send tracker until MPI reports the send complete.
+            Pickled messages are unpacked by the receiving side like any message sent
+            with the lowercase isend, binary ones are recognized by their header.
+        """
+        if tag is None:
+            tag = 0
+        if self.wire_format == self.BINARY_WIRE_FORMAT:
+            buf = binary_serializer.serialize(qmsg)
+        else:
+            buf = self.MPI.pickle.dumps(qmsg)
+        nbytes = len(buf)
+        self.logger.info('sending msg of size %s bytes and type %s with destination %s', nbytes, qmsg['type'], destination_rank)
+        send_request = self.MPI.COMM_WORLD.Isend([buf, self.MPI.BYTE], dest=destination_rank, tag=tag)
+
+        # the request is not waited on here, the tracker tests outstanding
+        # requests at the top of each loop and releases completed ones
+        self.send_tracker.add(send_request, buf, nbytes, destination_rank, tag)
+
+    def get_queue_message(self, block=False, timeout=None):
+        """ return the next message to send, raises Empty if there is none """
+        if self.queued_message is not None:
+            qmsg = self.queued_message
+            self.queued_message = None
+            return qmsg
+        return self.queues['MPIService'].get(block=block, timeout=timeout)
 
     def forward_message(self, message):
 
@@ -35,6 +35,9 @@ WALLCLOCK_EXPIRING = 'WALLCLOCK_EXPIRING'
 
 WAKE_UP = 'WAKE_UP'
 
+# sent by RequestHarvesterEventRanges to WorkManager when Harvester did not answer a request in time
+EVENT_RANGES_TIMEOUT = 'EVENT_RANGES_TIMEOUT'
+
 TYPES = [
     REQUEST_JOB,
     NEW_JOB,
@@ -58,11 +61,12 @@ forwarding_map = [
     {
         REQUEST_JOB: ['WorkManager'],
         REQUEST_EVENT_RANGES: ['WorkManager'],
-        OUTPUT_FILE: ['FileManager'],
-        DROID_HAS_EXITED: ['Yoda'],
+        OUTPUT_FILE: ['FileManager', 'WorkManager'],
+        DROID_HAS_EXITED: ['Yoda', 'WorkManager'],
     },
     {
         NEW_JOB: ['Droid', 'JobComm'],
+        NO_MORE_JOBS: ['Droid'],
         NEW_EVENT_RANGES: ['JobComm'],
         WALLCLOCK_EXPIRING: ['Droid'],
         DROID_EXIT: ['Droid'],
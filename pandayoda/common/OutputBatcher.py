@@ -0,0 +1,131 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+import time
+import logging
+from pandayoda.common import serializer
+logger = logging.getLogger(__name__)
+
+
+class OutputBatcher(object):
+    """ Collects output file entries and decides when they are sent on as a batch.
+
+        A batch is due once it holds max_files entries, once the entries add up to
+        max_bytes (measured as their serialized size) or once the oldest entry is
+        max_age seconds old, whichever comes first. After expiring() every entry is
+        due right away, so nothing waits once the wall clock is running out.
+
+        Entries carry the time they were created, so a batch that already waited
+        elsewhere (see the 'batch_age' of OUTPUT_FILE messages) keeps its age and is
+        not held for a second full max_age. """
+
+    def __init__(self, name, max_files=1000, max_bytes=1000000, max_age=10.):
+        """ name:       used in the log messages
+            max_files:  most entries in a batch
+            max_bytes:  most serialized bytes in a batch
+            max_age:    seconds the oldest entry may wait
+        """
+        self.name = name
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        # (entry, serialized size, time created)
+        self.entries = []
+        self.nbytes = 0
+        # time the oldest entry was created, None without entries
+        self.oldest = None
+        self.expiring_flag = False
+
+        # totals over all batches
+        self.nbatches = 0
+        self.total_files = 0
+        self.total_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def pending(self):
+        """ return the list of entries not sent yet """
+        return [entry for entry, size, created in self.entries]
+
+    def add(self, entries, created=None):
+        """ add a list of entries, created is the time the oldest of them was produced """
+        if created is None:
+            created = time.time()
+        for entry in entries:
+            size = len(serializer.serialize(entry))
+            self.entries.append((entry, size, created))
+            self.nbytes += size
+        if len(entries) > 0 and (self.oldest is None or created < self.oldest):
+            self.oldest = created
+
+    def expiring(self):
+        """ the wall clock is running out, every entry is due from now on """
+        self.expiring_flag = True
+
+    def due(self, now=None):
+        """ return why a batch is due, 'files', 'bytes', 'age' or 'expiring', or None if it is not """
+        if len(self.entries) == 0:
+            return None
+        if now is None:
+            now = time.time()
+        if self.expiring_flag:
+            return 'expiring'
+        if len(self.entries) >= self.max_files:
+            return 'files'
+        if self.nbytes >= self.max_bytes:
+            return 'bytes'
+        if now - self.oldest >= self.max_age:
+            return 'age'
+        return None
+
+    def time_until_due(self, now=None):
+        """ seconds until the oldest entry reaches max_age, None if there are no entries """
+        if len(self.entries) == 0:
+            return None
+        if now is None:
+            now = time.time()
+        return max(0., self.max_age - (now - self.oldest))
+
+    def take(self, reason=None, limit=True, now=None):
+        """ remove and return a batch of entries and its age in seconds. With limit the batch
+            holds at most max_files entries and max_bytes (but at least one entry), the rest
+            stays for the next batch. reason is only logged. """
+        if now is None:
+            now = time.time()
+        if len(self.entries) == 0:
+            return [], 0.
+
+        if limit:
+            count = 0
+            nbytes = 0
+            for entry, size, created in self.entries:
+                if count > 0 and (count >= self.max_files or nbytes + size > self.max_bytes):
+                    break
+                count += 1
+                nbytes += size
+        else:
+            count = len(self.entries)
+            nbytes = self.nbytes
+
+        batch = self.entries[:count]
+        self.entries = self.entries[count:]
+        self.nbytes -= nbytes
+        age = now - min(created for entry, size, created in batch)
+        self.oldest = min(created for entry, size, created in self.entries) if len(self.entries) > 0 else None
+
+        self.nbatches += 1
+        self.total_files += count
+        self.total_bytes += nbytes
+        logger.info('%s batch %s: %s files, %s bytes, oldest %.1f seconds, due to %s, %s files left; '
+                    'totals: %s batches, %s files, %s bytes',
+                    self.name, self.nbatches, count, nbytes, age, reason, len(self.entries),
+                    self.nbatches, self.total_files, self.total_bytes)
+
+        return [entry for entry, size, created in batch], age
@@ -0,0 +1,91 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SendTracker(object):
+    """ Keeps track of outstanding non-blocking MPI sends. The message buffer of
+        each send is held here until MPI reports the send complete, after which
+        it is released. """
+
+    def __init__(self, MPI, max_in_flight_bytes=100000000, detach_sends=False):
+        """ MPI:                  the mpi4py MPI module
+            max_in_flight_bytes:  has_space() returns False once this many bytes are outstanding
+            detach_sends:         never hold back sends, regardless of the bytes in flight.
+                                  On Theta waiting for an isend to complete could take up to
+                                  20 minutes, so this lets sends go out without ever waiting on
+                                  them. Completed sends are still reaped, since Testsome does not block.
+        """
+        self.MPI = MPI
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.detach_sends = detach_sends
+
+        # outstanding requests and, at the same index, the details of each send
+        self.requests = []
+        self.sends = []
+
+        self.in_flight_bytes = 0
+        self.total_sent = 0
+        self.total_completed = 0
+
+    def add(self, request, buf, nbytes, dest, tag=None):
+        """ start tracking a send, buf is kept alive until the send completes """
+        self.requests.append(request)
+        self.sends.append({'buf': buf, 'nbytes': nbytes, 'dest': dest, 'tag': tag, 'time': time.time()})
+        self.in_flight_bytes += nbytes
+        self.total_sent += 1
+
+    def reap(self):
+        """ release all sends that have completed, returns the number released """
+        if len(self.requests) == 0:
+            return 0
+
+        indices = self.MPI.Request.Testsome(self.requests)
+        if not indices:
+            return 0
+
+        completed = set(indices)
+        requests = []
+        sends = []
+        for i in range(len(self.requests)):
+            if i in completed:
+                self.in_flight_bytes -= self.sends[i]['nbytes']
+            else:
+                requests.append(self.requests[i])
+                sends.append(self.sends[i])
+        self.requests = requests
+        self.sends = sends
+        self.total_completed += len(completed)
+
+        return len(completed)
+
+    def has_space(self):
+        """ returns False when more bytes are in flight than allowed and new sends should wait """
+        if self.detach_sends or len(self.requests) == 0:
+            return True
+        return self.in_flight_bytes < self.max_in_flight_bytes
+
+    def in_flight_count(self):
+        return len(self.requests)
+
+    def oldest_age(self):
+        """ seconds since the oldest outstanding send was started """
+        if len(self.sends) == 0:
+            return 0.
+        return time.time() - self.sends[0]['time']
+
+    def get_metrics(self):
+        return {'in_flight_count': self.in_flight_count(),
+                'in_flight_bytes': self.in_flight_bytes,
+                'oldest_age': self.oldest_age(),
+                'total_sent': self.total_sent,
+                'total_completed': self.total_completed,
+                }
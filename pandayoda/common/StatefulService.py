@@ -8,7 +8,7 @@
 
 import logging
 import time
-from pandayoda.common import VariableWithLock
+from pandayoda.common import StatusBlock
 from pandayoda.common.yoda_multiprocessing import Process, Event
 logger = logging.getLogger()
 
@@ -22,13 +22,17 @@ class StatefulService(Process):
     # by derived class
     STATES = []
 
+    # names of counters kept next to the state, may be
+    # overridden by derived class
+    COUNTERS = []
+
     def __init__(self, loop_timeout=30):
         # call init of Thread class
         super(StatefulService, self).__init__()
 
-        # current state of this process
-        self.state = VariableWithLock.VariableWithLock('NOT_YET_DEFINED')
-        self.state_time = VariableWithLock.VariableWithLock(time.clock())
+        # current state of this process, the time it was set and the counters,
+        # shared with the parent and readable without taking a lock
+        self.status = StatusBlock.StatusBlock(self.STATES, self.COUNTERS)
 
         # this is used to trigger the thread exit
         self.exit = Event()
@@ -42,13 +46,12 @@ class StatefulService(Process):
 
     def get_state(self):
         """ return current state """
-        return self.state.get()
+        return self.status.get_state()
 
     def set_state(self, state):
         """ set current state """
         if state in self.STATES:
-            self.state.set(state)
-            self.state_time.set(time.clock())
+            self.status.set_state(state)
         else:
             logger.error('tried to set state %s which is not supported', state)
 
@@ -59,7 +62,21 @@ class StatefulService(Process):
         return False
 
     def state_lifetime(self):
-        return time.clock() - self.state_time.get()
+        """ seconds since the current state was set """
+        return time.time() - self.status.get_state_time()
+
+    def increment_counter(self, name, n=1):
+        self.status.increment(name, n)
+
+    def set_counter(self, name, value):
+        self.status.set_counter(name, value)
+
+    def get_counter(self, name):
+        return self.status.get_counter(name)
+
+    def get_counters(self):
+        """ return a dictionary of all counters """
+        return self.status.get_counters()
 
     def run(self):
         """ run when obj.start() is called """
@@ -0,0 +1,104 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+import mmap
+import struct
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+# sequence number, state index, time the state was set
+_HEADER = struct.Struct('=Qqd')
+_SEQUENCE = struct.Struct('=Q')
+_COUNTER = struct.Struct('=q')
+
+
+class StatusBlock(object):
+    """ The state, the time it was set and a few counters of a process, kept in an
+        anonymous shared memory map. A process started after the block was created,
+        with fork, shares it with its parent.
+
+        Reads take no lock, a sequence number (seqlock) is made odd while the block is
+        written and even after, a reader retries until it read the same even number
+        before and after copying the block. Only one process or thread may write the
+        block at a time, for a StatefulService that is the service itself once it runs.
+
+        The state is stored as its index in the list of states given to the block. """
+
+    NOT_YET_DEFINED = 'NOT_YET_DEFINED'
+
+    def __init__(self, states, counters=None):
+        """ states:     list of the state names
+            counters:   list of the counter names
+        """
+        self.states = list(states)
+        self.state_indices = dict((state, i) for i, state in enumerate(self.states))
+        self.counters = list(counters or [])
+        self.counter_offsets = dict((name, _HEADER.size + i * _COUNTER.size) for i, name in enumerate(self.counters))
+        self.block = struct.Struct('=Qqd%dq' % len(self.counters))
+        self.buf = mmap.mmap(-1, self.block.size)
+        self.buf.write(self.block.pack(0, -1, time.time(), *([0] * len(self.counters))))
+
+    def read(self):
+        """ return a consistent copy of the block, (sequence, state index, state time, counters...) """
+        while True:
+            before = _SEQUENCE.unpack_from(self.buf, 0)[0]
+            if before & 1:
+                # a write is in progress
+                time.sleep(0)
+                continue
+            values = self.block.unpack_from(self.buf, 0)
+            after = _SEQUENCE.unpack_from(self.buf, 0)[0]
+            if before == after:
+                return values
+
+    def begin_write(self):
+        sequence = _SEQUENCE.unpack_from(self.buf, 0)[0]
+        _SEQUENCE.pack_into(self.buf, 0, sequence + 1)
+        return sequence + 2
+
+    def end_write(self, sequence):
+        _SEQUENCE.pack_into(self.buf, 0, sequence)
+
+    def get_state(self):
+        index = self.read()[1]
+        if index < 0:
+            return self.NOT_YET_DEFINED
+        return self.states[index]
+
+    def get_state_time(self):
+        return self.read()[2]
+
+    def set_state(self, state):
+        index = self.state_indices[state]
+        sequence = self.begin_write()
+        _HEADER.pack_into(self.buf, 0, sequence - 1, index, time.time())
+        self.end_write(sequence)
+
+    def get_counter(self, name):
+        return self.read()[3 + self.counters.index(name)]
+
+    def set_counter(self, name, value):
+        offset = self.counter_offsets[name]
+        sequence = self.begin_write()
+        _COUNTER.pack_into(self.buf, offset, value)
+        self.end_write(sequence)
+
+    def increment(self, name, n=1):
+        offset = self.counter_offsets[name]
+        sequence = self.begin_write()
+        value = _COUNTER.unpack_from(self.buf, offset)[0]
+        _COUNTER.pack_into(self.buf, offset, value + n)
+        self.end_write(sequence)
+
+    def get_counters(self):
+        values = self.read()
+        return dict(zip(self.counters, values[3:]))
+
+    def close(self):
+        self.buf.close()
@@ -21,3 +21,7 @@ class MessengerConfigError(Exception):
 
 class MessengerFailedToParse(Exception):
     pass
+
+
+class MessengerFileIncomplete(Exception):
+    pass
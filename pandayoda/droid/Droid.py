@@ -22,7 +22,9 @@ config_section = os.path.basename(__file__)[:os.path.basename(__file__).rfind('.
 
 
 class Droid(StatefulService.StatefulService):
-    """ 1 Droid runs per node of a parallel job and launches the AthenaMP process """
+    """ 1 Droid runs per node of a parallel job and launches the AthenaMP process.
+        When a transform exits the Droid requests another job, keeping the same JobComm,
+        yampl socket and working directory, until Yoda replies NO_MORE_JOBS. """
 
     CREATED = 'CREATED'
     REQUEST_JOB = 'REQUEST_JOB'
@@ -173,6 +175,12 @@ class Droid(StatefulService.StatefulService):
                             self.set_state(Droid.REQUEST_JOB)
                         # set MPIService to be Queue focused
                         # MPIService.mpiService.set_queue_blocking()
+                    elif qmsg['type'] == MessageTypes.NO_MORE_JOBS:
+                        logger.info('received NO_MORE_JOBS from Yoda, exiting')
+                        self.stop()
+                    elif qmsg['type'] in [MessageTypes.WALLCLOCK_EXPIRING, MessageTypes.DROID_EXIT]:
+                        logger.info('received %s from Yoda while waiting for a job, exiting', qmsg['type'])
+                        self.stop()
                     else:
                         logger.error('message type was not NEW_JOB, faied parsing: %s', qmsg)
 
@@ -223,8 +231,10 @@ class Droid(StatefulService.StatefulService):
                         logger.info('transform running, block for %s on message queue', self.loop_timeout)
                         try:
                             qmsg = self.queues['Droid'].get(block=True, timeout=self.loop_timeout)
-                            if qmsg['type'] == MessageTypes.WALLCLOCK_EXPIRING:
-                                logger.info('received WALLCLOCK_EXPIRING message from Yoda, exiting.')
+                            if qmsg['type'] in [MessageTypes.WALLCLOCK_EXPIRING, MessageTypes.DROID_EXIT]:
+                                logger.info('received %s message from Yoda, exiting.', qmsg['type'])
+                                # JobComm sends its output files without waiting for their batch to fill
+                                self.queues['JobComm'].put({'type': MessageTypes.WALLCLOCK_EXPIRING})
                                 # stop Droid and it will kill all subthreads,etc.
                                 self.stop()
                             elif qmsg['type'] == MessageTypes.NO_MORE_EVENT_RANGES:
@@ -255,10 +265,18 @@ class Droid(StatefulService.StatefulService):
                     logger.error('transform exited but is not in FINISHED state, returncode = %s',
                                  self.subthreads['transform'].get_returncode())
 
-                # trigger exit
-                self.stop()
+                logger.info('JobComm counters: %s', self.subthreads['JobComm'].get_counters())
 
-                # in the future you might imagine requesting another job here
+                # JobComm sends its remaining output files and waits for the next job
+                self.queues['JobComm'].put({'type': MessageTypes.TRANSFORM_EXITED})
+                del self.subthreads['transform']
+
+                # request another job, Yoda answers NO_MORE_JOBS when there are none left
+                if self.subthreads['JobComm'].is_alive():
+                    self.set_state(Droid.REQUEST_JOB)
+                else:
+                    logger.error('JobComm thread exited, not requesting another job')
+                    self.stop()
 
         # set exit state
         self.set_state(self.EXITING)
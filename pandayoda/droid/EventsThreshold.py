@@ -0,0 +1,96 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+import math
+import time
+import logging
+from collections import deque
+logger = logging.getLogger(__name__)
+
+
+class EventsThreshold(object):
+    """ Decides how few ready event ranges JobComm may hold before it asks Yoda for more.
+
+        The payload workers consume ranges at a rate measured over the last rate_window
+        seconds, and a request takes the averaged round trip to Yoda to be answered. The
+        ranges still ready when a request goes out have to last that long, so the threshold is
+            max(min_threshold, safety_factor * rate * round trip)
+        Until a round trip has been measured the threshold is min_threshold. """
+
+    def __init__(self, min_threshold, safety_factor=2., rate_window=300., latency_weight=0.5):
+        """ min_threshold:  smallest threshold, get_more_events_threshold of the configuration
+            safety_factor:  the ready ranges cover this many round trips
+            rate_window:    seconds of history used to measure the consumption rate
+            latency_weight: weight of the newest round trip in the averaged round trip
+        """
+        self.min_threshold = min_threshold
+        self.safety_factor = safety_factor
+        self.rate_window = rate_window
+        self.latency_weight = latency_weight
+
+        # (time, number of ranges) sent to the payload within the rate_window
+        self.consumed_ranges = deque()
+        self.nconsumed = 0
+        self.first_consumed = None
+
+        # averaged round trip in seconds, None until measured
+        self.latency = None
+        # time the outstanding request was sent, None if there is none
+        self.request_time = None
+
+    def consumed(self, nranges, now=None):
+        """ nranges event ranges were sent to the payload """
+        if now is None:
+            now = time.time()
+        self.consumed_ranges.append((now, nranges))
+        self.nconsumed += nranges
+        if self.first_consumed is None:
+            self.first_consumed = now
+
+    def requested(self, now=None):
+        """ a request for event ranges was sent to Yoda """
+        if now is None:
+            now = time.time()
+        self.request_time = now
+
+    def received(self, now=None):
+        """ Yoda answered the outstanding request """
+        if now is None:
+            now = time.time()
+        if self.request_time is None:
+            return
+        latency = now - self.request_time
+        self.request_time = None
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.latency_weight * (latency - self.latency)
+        logger.debug('event range request round trip %.3f seconds, average %.3f', latency, self.latency)
+
+    def cancel(self):
+        """ the outstanding request will not be answered, for instance the job ended """
+        self.request_time = None
+
+    def rate(self, now=None):
+        """ event ranges sent to the payload per second over the rate_window """
+        if now is None:
+            now = time.time()
+        while len(self.consumed_ranges) > 0 and now - self.consumed_ranges[0][0] > self.rate_window:
+            self.nconsumed -= self.consumed_ranges.popleft()[1]
+        if self.first_consumed is None:
+            return 0.
+        # until a full window has passed, average over the time since the first ranges went out
+        span = float(min(self.rate_window, now - self.first_consumed))
+        if span <= 0:
+            return 0.
+        return self.nconsumed / span
+
+    def threshold(self, now=None):
+        if self.latency is None:
+            return self.min_threshold
+        return max(self.min_threshold, int(math.ceil(self.safety_factor * self.rate(now) * self.latency)))
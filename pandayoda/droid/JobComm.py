@@ -10,11 +10,13 @@
 import os
 import os.path
 import logging
-import Queue
 import shutil
+import threading
 import time
+from collections import deque
 from pandayoda.common.yoda_multiprocessing import Event
-from pandayoda.common import MessageTypes, EventRangeList, StatefulService, serializer
+from pandayoda.common import MessageTypes, EventRangeList, StatefulService, serializer, LatencyHistogram, EventLoop, OutputBatcher
+from pandayoda.droid import EventsThreshold
 
 logger = logging.getLogger(__name__)
 
@@ -61,6 +63,10 @@ class JobComm(StatefulService.StatefulService):  # noqa: C901
     The event range format is json and is this: [{"eventRangeID": "8848710-3005316503-6391858827-3-10",
     "LFN":"EVNT.06402143._012906.pool.root.1", "lastEvent": 3, "startEvent": 3, "scope": "mc15_13TeV",
     "GUID": "63A015D3-789D-E74D-BAA9-9F95DB068EE9"}]
+
+    Messages on the JobComm queue, messages from AthenaMP and the exit signal are each watched by a thread of an
+    EventLoop and handled in the order they arrive, so event ranges from Yoda never wait on the payload socket or
+    the other way around. The state only reports what JobComm is waiting for.
     """
 
     WAITING_FOR_JOB = 'WAITING_FOR_JOB'
@@ -77,6 +83,8 @@ class JobComm(StatefulService.StatefulService):  # noqa: C901
               REQUEST_EVENT_RANGES, WAIT_FOR_PAYLOAD_MESSAGE,
               MESSAGE_RECEIVED, SEND_EVENT_RANGE, SEND_OUTPUT_FILE, EXITED]
 
+    COUNTERS = ['eventranges_sent', 'output_files', 'output_batches', 'get_more_events_threshold']
+
     def __init__(self, config, queues, droid_working_path, droid_output_path, yampl_socket_name):
         """
           queues: A dictionary of SerialQueue.SerialQueue objects where the JobManager can send
@@ -109,6 +117,15 @@ class JobComm(StatefulService.StatefulService):  # noqa: C901
         # set some defaults
         self.debug_message_char_length = 100
         self.stage_outputs = False
+        self.eventranges_per_message = 1
+        self.batch_max_files = 1000
+        self.batch_max_bytes = 1000000
+        self.events_threshold_safety_factor = 2.
+        self.min_poll_interval = 0.0001
+        self.max_poll_interval = 0.001
+
+        # time from a "Ready for events" of the payload to the answer sent to it
+        self.ready_latency = LatencyHistogram.LatencyHistogram()
 
         # set initial state
         self.set_state(self.WAITING_FOR_JOB)
@@ -119,360 +136,259 @@ class JobComm(StatefulService.StatefulService):  # noqa: C901
     def no_more_work(self):
         return self.all_work_done.is_set()
 
-    def run(self):  # noqa: C901
+    def run(self):
         """ this is the function run as a subthread when the user runs jobComm_instance.start() """
 
         self.read_config()
 
         logger.debug('start yampl payloadcommunicator')
-        athpayloadcomm = AthenaPayloadCommunicator(self.yampl_socket_name)
-        payload_msg = ''
+        self.athpayloadcomm = AthenaPayloadCommunicator(self.yampl_socket_name)
+
+        # output files waiting to be sent via MPI
+        self.output_batcher = OutputBatcher.OutputBatcher('JobComm output files', self.batch_max_files,
+                                                          self.batch_max_bytes, self.aggregate_output_files_time)
+
+        # ready event ranges below which more are requested, adapted to the consumption rate
+        self.events_threshold = EventsThreshold.EventsThreshold(self.get_more_events_threshold,
+                                                                self.events_threshold_safety_factor)
+        self.set_counter('get_more_events_threshold', self.get_more_events_threshold)
+
+        # the state of the current panda job, see reset_job
+        self.reset_job()
+
+        # messages from Droid and Yoda, from the payload and the exit signal are handled
+        # as they arrive, output files are checked ten times per aggregate_output_files_time
+        # (at most every second) in case the oldest is due and the need for event ranges
+        # is also checked every loop_timeout
+        self.loop = EventLoop.EventLoop()
+        self.loop.add_queue(self.queues['JobComm'], self.handle_queue_message)
+        self.loop.add_poller(self.athpayloadcomm.poll, self.handle_payload_message,
+                             self.min_poll_interval, self.max_poll_interval)
+        self.loop.add_event(self.exit, self.loop.stop)
+        self.loop.call_every(min(1., self.aggregate_output_files_time / 10.), self.send_output_files)
+        self.loop.call_every(self.loop_timeout, self.check_work)
+        self.loop.call_every(self.loop_timeout, self.report_events_threshold)
+
+        self.set_state(self.WAITING_FOR_JOB)
+        self.loop.run()
 
-        # current list of output files to send via MPI
-        output_files = []
-        last_output_file_mpi_send = time.time()
+        # send any remaining output files to Yoda before exiting
+        self.send_output_files(force=True)
 
-        # list of event ranges
-        eventranges = EventRangeList.EventRangeList()
-        no_more_events = False
-        waiting_for_eventranges = False
-        event_range_request_counter = 0
+        logger.info('payload ready for events to answer latency: %s', self.ready_latency.summary())
+
+        self.set_state(self.EXITED)
 
+        logger.info('JobComm exiting')
+
+    def reset_job(self):
+        """ forget the current panda job, its event ranges and the payload requests """
         # current panda job that AthenaMP is configured to run
-        current_job = None
-
-        while not self.exit.is_set():
-            logger.debug('start loop: state: %s', self.get_state())
-
-            # in debug mode, report evenranges status
-            if logger.getEffectiveLevel() == logging.DEBUG:
-                ready_events = eventranges.number_ready()
-                number_completed = eventranges.number_completed()
-                total = len(eventranges)
-                logger.debug('number of ready events %s; number of completed events %s; total events %s',
-                             ready_events, number_completed, total)
-
-            # don't want to hammer Yoda with lots of little messages for output files
-            # so aggregate output files for some time period then send as a group
-            if len(output_files) == 0:
-                last_output_file_mpi_send = time.time()
-            elif (time.time() - last_output_file_mpi_send) > self.aggregate_output_files_time:
-
-                # send output file data to Yoda/FileManager
-                logger.info('sending %s output files to Yoda/FileManager', len(output_files))
-                mpi_message = {'type': MessageTypes.OUTPUT_FILE,
-                               'filelist': output_files,
-                               'destination_rank': 0
-                               }
-                self.queues['MPIService'].put(mpi_message)
-
-                # set time for next send
-                last_output_file_mpi_send = time.time()
-                # reset output file list
-                output_files = []
-
-            ##################
-            # WAITING_FOR_JOB: waiting for the job definition to arrive, before
-            #        it does, it is assumed that there is no payload running
-            ######################################################################
-            if self.get_state() == self.WAITING_FOR_JOB:
-                logger.info(' waiting for job definition, blocking on message queue for %s ', self.loop_timeout)
-                try:
-                    qmsg = self.queues['JobComm'].get(block=True, timeout=self.loop_timeout)
-                except Queue.Empty:
-                    logger.debug('no message on queue')
-                else:
-                    # shorten our message for printing
-                    if logger.getEffectiveLevel() == logging.DEBUG:
-                        tmpmsg = str(qmsg)
-                        if len(tmpmsg) > self.debug_message_char_length:
-                            tmpslice = slice(0, self.debug_message_char_length)
-                            tmpmsg = tmpmsg[tmpslice] + '...'
-                        logger.debug('received queue message: %s', tmpmsg)
-
-                    # verify message type is as expected
-                    if 'type' not in qmsg or qmsg['type'] != MessageTypes.NEW_JOB or 'job' not in qmsg:
-                        logger.error('received unexpected message format: %s', qmsg)
-                    else:
-                        logger.info('received job definition')
-                        current_job = qmsg['job']
-
-                        # change state
-                        self.set_state(self.REQUEST_EVENT_RANGES)
-                qmsg = None
-
-            ##################
-            # REQUEST_EVENT_RANGES: Request event ranges from Yoda
-            ######################################################################
-            elif self.get_state() == self.REQUEST_EVENT_RANGES:
-                if not waiting_for_eventranges:
-                    logger.info('sending request for event ranges')
-                    # send MPI message to Yoda for more event ranges
-                    self.request_events(current_job)
-                    waiting_for_eventranges = True
-                # change state
-                self.set_state(self.WAITING_FOR_EVENT_RANGES)
-
-            ##################
-            # WAITING_FOR_EVENT_RANGES: Waiting for event ranges from Yoda
-            ######################################################################
-            elif self.get_state() == self.WAITING_FOR_EVENT_RANGES:
-                logger.info('waiting for event ranges, blocking on message queue for %s', self.loop_timeout)
-                try:
-                    qmsg = self.queues['JobComm'].get(block=True, timeout=self.loop_timeout)
-                except Queue.Empty:
-                    logger.debug('no message on queue')
-                else:
-                    # shorten our message for printing
-                    if logger.getEffectiveLevel() == logging.DEBUG:
-                        tmpmsg = str(qmsg)
-                        if len(tmpmsg) > self.debug_message_char_length:
-                            tmpslice = slice(0, self.debug_message_char_length)
-                            tmpmsg = tmpmsg[tmpslice] + '...'
-                        logger.debug('received queue message: %s', tmpmsg)
-
-                    if 'type' not in qmsg:
-                        logger.error('received unexpected message format: %s', qmsg)
-                    elif qmsg['type'] == MessageTypes.NEW_EVENT_RANGES:
-                        logger.info('received event ranges, adding to list')
-                        eventranges += EventRangeList.EventRangeList(qmsg['eventranges'])
-                        # add event ranges to payload messenger list
-                        # payloadcomm.add_eventranges(eventranges)
-                        # change state
-                        self.set_state(self.WAIT_FOR_PAYLOAD_MESSAGE)
-                    elif qmsg['type'] == MessageTypes.NO_MORE_EVENT_RANGES:
-                        logger.info('no more event ranges for PandaID %s', qmsg['PandaID'])
-                        no_more_events = True
-
-                        # check for running events
-                        if len(eventranges) == eventranges.number_completed():
-                            logger.info('no eventranges left to send so triggering exit')
-                            self.stop()
-                        else:
-                            logger.info('still have events to process so continuing')
-                            self.set_state(self.WAIT_FOR_PAYLOAD_MESSAGE)
-
-                    else:
-                        logger.error('unknown message type: %s', qmsg['type'])
-
-                    waiting_for_eventranges = False
-
-                qmsg = None
-
-            ##################
-            # WAIT_FOR_PAYLOAD_MESSAGE: initiates
-            #          a request for a message from the payload
-            ######################################################################
-            if self.get_state() == self.WAIT_FOR_PAYLOAD_MESSAGE:
-
-                # first check if there is an incoming message
-                try:
-                    logger.debug('checking for queue message')
-                    qmsg = self.queues['JobComm'].get(block=False)
-                    if MessageTypes.NEW_EVENT_RANGES in qmsg['type']:
-                        logger.info('received new event range')
-                        eventranges += EventRangeList.EventRangeList(qmsg['eventranges'])
-                        waiting_for_eventranges = False
-                    elif qmsg['type'] == MessageTypes.NO_MORE_EVENT_RANGES:
-                        logger.info('no more event ranges for PandaID %s', qmsg['PandaID'])
-                        no_more_events = True
-
-                        # check for running events
-                        if len(eventranges) == eventranges.number_completed():
-                            logger.info('no eventranges left to send so triggering exit')
-                            self.stop()
-                        else:
-                            logger.info('still have events to process so continuing')
-
-                    else:
-                        logger.error('received message of unknown type: %s', qmsg)
-                except Queue.Empty:
-                    logger.debug('no messages on queue')
-
-                logger.info('checking for message from payload, block for %s, pending event range requests: %s',
-                            self.loop_timeout, event_range_request_counter)
-
-                payload_msg = athpayloadcomm.recv(self.loop_timeout)
-
-                if len(payload_msg) > 0:
-                    logger.debug('received message: %s', payload_msg)
-                    self.set_state(self.MESSAGE_RECEIVED)
-                else:
-                    logger.debug('did not receive message from payload')
-                    if event_range_request_counter > 0:
-                        logger.debug('have %s pending event range requests so will try sending one.', event_range_request_counter)
-                        self.set_state(self.SEND_EVENT_RANGE)
-                    # time.sleep(self.loop_timeout)
-
-            ##################
-            # MESSAGE_RECEIVED: this state indicates that a message has been
-            #          received from the payload and its meaning will be parsed
-            ######################################################################
-            elif self.get_state() == self.MESSAGE_RECEIVED:
-
-                # if ready for events, send them or wait for some
-                if AthenaPayloadCommunicator.READY_FOR_EVENTS in payload_msg:
-                    logger.info('payload is ready for event range')
-                    self.set_state(self.SEND_EVENT_RANGE)
-                    # increment counter to keep track of how many requests are queued
-                    event_range_request_counter += 1
-
-                #### OUTPUT File received
-                elif len(payload_msg.split(',')) == 4:
-                    # Athena sent details of an output file
-                    logger.info('received output file from AthenaMP')
-                    self.set_state(self.SEND_OUTPUT_FILE)
+        self.current_job = None
+        # list of event ranges
+        self.eventranges = EventRangeList.EventRangeList()
+        self.no_more_events = False
+        self.waiting_for_eventranges = False
+        # arrival times of the "Ready for events" messages not answered yet
+        self.ready_times = deque()
+
+    def handle_queue_message(self, qmsg):
+        """ handle a message from Droid or Yoda """
+        # shorten our message for printing
+        if logger.getEffectiveLevel() == logging.DEBUG:
+            tmpmsg = str(qmsg)
+            if len(tmpmsg) > self.debug_message_char_length:
+                tmpslice = slice(0, self.debug_message_char_length)
+                tmpmsg = tmpmsg[tmpslice] + '...'
+            logger.debug('received queue message: %s', tmpmsg)
+
+        if 'type' not in qmsg:
+            logger.error('received unexpected message format: %s', qmsg)
+        elif qmsg['type'] == MessageTypes.TRANSFORM_EXITED:
+            self.transform_exited()
+        elif qmsg['type'] == MessageTypes.WALLCLOCK_EXPIRING:
+            # Droid is about to stop, send the output files now and as they come in
+            logger.info('wall clock expiring, sending %s output files without waiting', len(self.output_batcher))
+            self.output_batcher.expiring()
+            self.send_output_files()
+        elif qmsg['type'] == MessageTypes.NEW_JOB:
+            if 'job' not in qmsg:
+                logger.error('received unexpected message format: %s', qmsg)
+            elif self.current_job is not None:
+                logger.error('received job definition while PandaID %s is running, ignoring it', self.current_job['PandaID'])
+            else:
+                logger.info('received job definition')
+                self.current_job = qmsg['job']
+                logger.info('sending request for event ranges')
+                # send MPI message to Yoda for more event ranges
+                self.request_events(self.current_job)
+                self.waiting_for_eventranges = True
+        elif not self.for_current_job(qmsg, self.current_job):
+            logger.warning('dropping %s for PandaID %s, a previous job', qmsg['type'], qmsg['PandaID'])
+        elif qmsg['type'] == MessageTypes.NEW_EVENT_RANGES:
+            logger.info('received event ranges, adding to list')
+            self.events_threshold.received()
+            self.eventranges.extend(qmsg['eventranges'])
+            self.waiting_for_eventranges = False
+            self.answer_payload_requests()
+        elif qmsg['type'] == MessageTypes.NO_MORE_EVENT_RANGES:
+            logger.info('no more event ranges for PandaID %s', qmsg['PandaID'])
+            # the payload is told there are no more events when it next asks,
+            # then it exits and Droid requests the next job
+            self.events_threshold.received()
+            self.no_more_events = True
+            self.waiting_for_eventranges = False
+            self.answer_payload_requests()
+        else:
+            logger.error('unknown message type: %s', qmsg['type'])
 
-                else:
-                    logger.error('failed to parse message from Athena: %s', payload_msg)
-                    self.set_state(self.WAIT_FOR_PAYLOAD_MESSAGE)
-
-            ##################
-            # SEND_EVENT_RANGE: wait until more event ranges are sent by JobComm
-            ######################################################################
-            elif self.get_state() == self.SEND_EVENT_RANGE:
-                logger.debug('sending event to payload')
-                # if event ranges available, send one
-                try:
-                    logger.debug('have %d ready event ranges to send to AthenaMP', eventranges.number_ready())
-                    local_eventranges = eventranges.get_next()
-                # no more event ranges available
-                except EventRangeList.NoMoreEventRanges:
-                    logger.debug('there are no more event ranges to process')
-                    # if we have been told there are no more eventranges, then tell the AthenaMP worker there are no more events
-                    if no_more_events:
-                        logger.info('sending AthenaMP NO_MORE_EVENTS')
-                        athpayloadcomm.send(AthenaPayloadCommunicator.NO_MORE_EVENTS)
-                        # return to state requesting a message
-                        self.set_state(self.WAIT_FOR_PAYLOAD_MESSAGE)
-
-                    # otherwise wait for more events
-                    else:
-                        logger.info('waiting for more events ranges')
-                        self.set_state(self.WAIT_FOR_PAYLOAD_MESSAGE)
-
-                # something wrong with the index in the EventRangeList index
-                except EventRangeList.RequestedMoreRangesThanAvailable:
-                    logger.error('requested more event ranges than available, waiting for more event ranges')
-                    self.set_state(self.WAIT_FOR_PAYLOAD_MESSAGE)
+        self.check_work()
 
-                else:
-                    logger.info('sending %s eventranges to AthenaMP', len(local_eventranges))
-                    # append full path to file name for AthenaMP
-                    # and adjust event counter by the number of files
-                    # input_files = self.job_def.get()['inFiles'].split(',')
-                    # logger.debug('%s: found %s input files',self.prelog,len(input_files))
-                    for evtrg in local_eventranges:
-                        evtrg['PFN'] = os.path.join(os.getcwd(), evtrg['LFN'])
-
-                    # send AthenaMP the new event ranges
-                    athpayloadcomm.send(serializer.serialize(local_eventranges))
-                    # decrement counter since we sent some events
-                    event_range_request_counter -= 1
-
-                    # return to state requesting a message
-                    self.set_state(self.WAIT_FOR_PAYLOAD_MESSAGE)
-
-                payload_msg = None
-
-            ##################
-            # SEND_OUTPUT_FILE: send output file data to MPIService
-            ######################################################################
-            elif self.get_state() == self.SEND_OUTPUT_FILE:
-                logger.debug('send output file information')
-
-                # parse message
-                parts = payload_msg.split(',')
-                # there should be four parts:
-                # "myHITS.pool.root_000.Range-6,ID:Range-6,CPU:1,WALL:1"
-                if len(parts) == 4:
-                    # parse the parts
-                    outputfilename = parts[0]
-                    eventrangeid = parts[1].replace('ID:', '')
-                    cpu = parts[2].replace('CPU:', '')
-                    wallclock = parts[3].replace('WALL:', '')
-
-                    # if staging, stage and change output filename
-                    if self.stage_outputs:
-                        # move file to staging_path
-                        logger.debug('shutil.move(%s,%s)', outputfilename, self.staging_path)
-                        shutil.move(outputfilename, self.staging_path)
-                        # change output filename
-                        outputfilename = os.path.join(self.staging_path, os.path.basename(outputfilename))
-                        logger.info('outputfilename - %s', outputfilename)
-
-                    # build the data for Harvester output file
-                    output_file_data = {'type': MessageTypes.OUTPUT_FILE,
-                                        'filename': outputfilename,
-                                        'eventrangeid': eventrangeid,
-                                        'cpu': cpu,
-                                        'wallclock': wallclock,
-                                        'scope': current_job['scopeOut'],
-                                        'pandaid': current_job['PandaID'],
-                                        'eventstatus': 'finished',
-                                        'destination_rank': 0,
-                                        }
-                    # self.output_file_data.set(output_file_data)
-
-                    # append output file data to list of files for transfer via MPI
-                    output_files.append(output_file_data)
-                    logger.info('received output file from AthenaMP; %s output files now on waiting list', len(output_files))
-
-                    # set event range to completed:
-                    logger.debug('mark event range id %s as completed', output_file_data['eventrangeid'])
-                    try:
-                        eventranges.mark_completed(output_file_data['eventrangeid'])
-                    except Exception:
-                        logger.error('failed to mark eventrangeid %s as completed', output_file_data['eventrangeid'])
-                        self.stop()
-
-                    # return to state requesting a message
-                    self.set_state(self.WAIT_FOR_PAYLOAD_MESSAGE)
+    def handle_payload_message(self, payload_msg):
+        """ handle a message from AthenaMP """
+        logger.debug('received message: %s', payload_msg)
 
-                else:
-                    logger.error('failed to parse output file')
-                    self.set_state(self.WAIT_FOR_PAYLOAD_MESSAGE)
+        # if ready for events, send them or wait for some
+        if AthenaPayloadCommunicator.READY_FOR_EVENTS in payload_msg:
+            logger.info('payload is ready for event range')
+            self.ready_times.append(time.time())
+            self.answer_payload_requests()
 
-                payload_msg = None
+        #### OUTPUT File received
+        elif len(payload_msg.split(',')) == 4:
+            # Athena sent details of an output file
+            logger.info('received output file from AthenaMP')
+            self.send_output_file(payload_msg)
 
-            # if ready_events is below the threshold and the no more events flag has not been set
-            # request more event ranges
-            if eventranges.number_ready() < self.get_more_events_threshold and not no_more_events and not waiting_for_eventranges and current_job is not None:
-                logger.info('number of ready events %s below request threshold %s, asking for more.',
-                            eventranges.number_ready(), self.get_more_events_threshold)
-                # send MPI message to Yoda for more event ranges
-                self.request_events(current_job)
-                waiting_for_eventranges = True
+        else:
+            logger.error('failed to parse message from Athena: %s', payload_msg)
 
-            # if the number of completed events equals the number of event ranges
-            # available, and no more events flag is set, then kill subprocess and exit.
-            elif eventranges.number_ready() == 0 and eventranges.number_completed() == len(eventranges) and no_more_events:
-                logger.info('no more events to process, exiting')
-                self.stop()
-                self.all_work_done.set()
-            # else:
-            # logger.info('sleeping for %s',self.loop_timeout)
-            # self.exit.wait(timeout=self.loop_timeout)
+        self.check_work()
 
-        # send any remaining output files to Yoda before exitingn.
-        # don't want to hammer Yoda with lots of little messages for output files
-        # so aggregate output files for some time period then send as a group
-        if len(output_files) > 0:
+    def answer_payload_requests(self):
+        """ answer all pending "Ready for events" of the payload that can be answered """
+        if len(self.ready_times) == 0:
+            return
 
-            # send output file data to Yoda/FileManager
-            logger.info('sending %s output files to Yoda/FileManager', len(output_files))
+        self.set_state(self.SEND_EVENT_RANGE)
+        logger.debug('answering %s pending payload requests, have %d ready event ranges',
+                     len(self.ready_times), self.eventranges.number_ready())
+        while len(self.ready_times) > 0:
+            nranges = min(self.eventranges_per_message, self.eventranges.number_ready())
+            try:
+                local_eventranges = self.eventranges.get_next(nranges) if nranges > 0 else []
+            # something wrong with the index in the EventRangeList index
+            except EventRangeList.RequestedMoreRangesThanAvailable:
+                logger.error('requested more event ranges than available, waiting for more event ranges')
+                break
+
+            if len(local_eventranges) == 0:
+                logger.debug('there are no more event ranges to process')
+                # if we have been told there are no more eventranges, then tell the AthenaMP worker there are no more events
+                if self.no_more_events:
+                    logger.info('sending AthenaMP NO_MORE_EVENTS')
+                    self.athpayloadcomm.send(AthenaPayloadCommunicator.NO_MORE_EVENTS)
+                # otherwise wait for more events
+                else:
+                    logger.info('waiting for more events ranges, %s payload requests pending', len(self.ready_times))
+                    break
+            else:
+                logger.info('sending %s eventranges to AthenaMP', len(local_eventranges))
+                # append full path to file name for AthenaMP
+                for evtrg in local_eventranges:
+                    evtrg['PFN'] = os.path.join(os.getcwd(), evtrg['LFN'])
+
+                # send AthenaMP the new event ranges
+                self.athpayloadcomm.send(serializer.serialize(local_eventranges))
+                self.increment_counter('eventranges_sent', len(local_eventranges))
+                self.events_threshold.consumed(len(local_eventranges))
+
+            # the request was answered
+            self.ready_latency.record(time.time() - self.ready_times.popleft())
+
+    def check_work(self):
+        """ request more event ranges when running low, flag the end of the job once all are completed """
+        # in debug mode, report evenranges status
+        if logger.getEffectiveLevel() == logging.DEBUG:
+            logger.debug('number of ready events %s; number of completed events %s; total events %s',
+                         self.eventranges.number_ready(), self.eventranges.number_completed(), len(self.eventranges))
+
+        if self.current_job is None:
+            self.update_state()
+            return
+
+        # if ready_events is below the threshold and the no more events flag has not been set
+        # request more event ranges
+        threshold = self.events_threshold.threshold()
+        if self.eventranges.number_ready() < threshold and not self.no_more_events and not self.waiting_for_eventranges:
+            logger.info('number of ready events %s below request threshold %s, asking for more.',
+                        self.eventranges.number_ready(), threshold)
+            # send MPI message to Yoda for more event ranges
+            self.request_events(self.current_job)
+            self.waiting_for_eventranges = True
+
+        # if the number of completed events equals the number of event ranges
+        # available, and no more events flag is set, the job is done, the transform
+        # exits and Droid requests the next job
+        elif self.eventranges.number_ready() == 0 and self.eventranges.number_completed() == len(self.eventranges) \
+                and self.no_more_events and not self.all_work_done.is_set():
+            logger.info('no more events to process for PandaID %s', self.current_job['PandaID'])
+            self.all_work_done.set()
+
+        self.update_state()
+
+    def update_state(self):
+        """ set the state shown to Droid and monitors from what JobComm is waiting for """
+        if self.current_job is None:
+            state = self.WAITING_FOR_JOB
+        elif self.waiting_for_eventranges and self.eventranges.number_ready() == 0:
+            state = self.WAITING_FOR_EVENT_RANGES
+        else:
+            state = self.WAIT_FOR_PAYLOAD_MESSAGE
+        if not self.in_state(state):
+            self.set_state(state)
+
+    def transform_exited(self):
+        """ the transform exited, send what is left of this job and wait for the next one """
+        if len(self.output_batcher) > 0:
+            logger.info('transform exited, sending %s output files to Yoda/FileManager', len(self.output_batcher))
+            self.send_output_files(force=True)
+        logger.info('transform for PandaID %s exited, waiting for the next job',
+                    self.current_job['PandaID'] if self.current_job else None)
+        logger.info('payload ready for events to answer latency: %s', self.ready_latency.summary())
+        self.events_threshold.cancel()
+        self.reset_job()
+        self.all_work_done.clear()
+
+    def report_events_threshold(self):
+        """ log the threshold for requesting event ranges and what it was derived from """
+        threshold = self.events_threshold.threshold()
+        self.set_counter('get_more_events_threshold', threshold)
+        latency = self.events_threshold.latency
+        logger.info('get_more_events_threshold %s: payload consumes %.3f ranges/s, request round trip %s seconds',
+                    threshold, self.events_threshold.rate(), '%.3f' % latency if latency is not None else 'not measured')
+
+    def send_output_files(self, force=False):
+        """ send the due batches of output files to Yoda/FileManager, all of them if force is set """
+        # don't want to hammer Yoda with lots of little messages for output files
+        # so they are aggregated until batch_max_files, batch_max_bytes or
+        # aggregate_output_files_time is reached
+        while len(self.output_batcher) > 0:
+            reason = self.output_batcher.due()
+            if reason is None:
+                if not force:
+                    return
+                reason = 'flush'
+
+            filelist, age = self.output_batcher.take(reason)
             mpi_message = {'type': MessageTypes.OUTPUT_FILE,
-                           'filelist': output_files,
+                           'filelist': filelist,
+                           # lets FileManager count the time already waited here
+                           'batch_age': age,
                            'destination_rank': 0
                            }
             self.queues['MPIService'].put(mpi_message)
-
-            # reset output file list
-            output_files = []
-
-        self.set_state(self.EXITED)
-
-        logger.info('JobComm exiting')
+            self.increment_counter('output_batches')
 
     def read_config(self):
 
@@ -499,6 +415,30 @@ class JobComm(StatefulService.StatefulService):  # noqa: C901
             else:
                 raise Exception('must specify "get_more_events_threshold" in "%s" section of config file' % config_section)
 
+            # read batch_max_files:
+            if 'batch_max_files' in self.config[config_section]:
+                self.batch_max_files = int(self.config[config_section]['batch_max_files'])
+                logger.info('%s batch_max_files: %s', config_section, self.batch_max_files)
+            else:
+                logger.warning('no "batch_max_files" in "%s" section of config file, using default %s',
+                               config_section, self.batch_max_files)
+
+            # read batch_max_bytes:
+            if 'batch_max_bytes' in self.config[config_section]:
+                self.batch_max_bytes = int(self.config[config_section]['batch_max_bytes'])
+                logger.info('%s batch_max_bytes: %s', config_section, self.batch_max_bytes)
+            else:
+                logger.warning('no "batch_max_bytes" in "%s" section of config file, using default %s',
+                               config_section, self.batch_max_bytes)
+
+            # read events_threshold_safety_factor:
+            if 'events_threshold_safety_factor' in self.config[config_section]:
+                self.events_threshold_safety_factor = float(self.config[config_section]['events_threshold_safety_factor'])
+                logger.info('%s events_threshold_safety_factor: %s', config_section, self.events_threshold_safety_factor)
+            else:
+                logger.warning('no "events_threshold_safety_factor" in "%s" section of config file, using default %s',
+                               config_section, self.events_threshold_safety_factor)
+
             # read aggregate_output_files_time:
             if 'aggregate_output_files_time' in self.config[config_section]:
                 self.aggregate_output_files_time = int(self.config[config_section]['aggregate_output_files_time'])
@@ -514,6 +454,30 @@ class JobComm(StatefulService.StatefulService):  # noqa: C901
                 logger.warning('no "debug_message_char_length" in "%s" section of config file, using default %s',
                                config_section, self.debug_message_char_length)
 
+            # read eventranges_per_message:
+            if 'eventranges_per_message' in self.config[config_section]:
+                self.eventranges_per_message = max(1, int(self.config[config_section]['eventranges_per_message']))
+                logger.info('%s eventranges_per_message: %s', config_section, self.eventranges_per_message)
+            else:
+                logger.warning('no "eventranges_per_message" in "%s" section of config file, using default %s',
+                               config_section, self.eventranges_per_message)
+
+            # read min_poll_interval:
+            if 'min_poll_interval' in self.config[config_section]:
+                self.min_poll_interval = float(self.config[config_section]['min_poll_interval'])
+                logger.info('%s min_poll_interval: %s', config_section, self.min_poll_interval)
+            else:
+                logger.warning('no "min_poll_interval" in "%s" section of config file, using default %s',
+                               config_section, self.min_poll_interval)
+
+            # read max_poll_interval:
+            if 'max_poll_interval' in self.config[config_section]:
+                self.max_poll_interval = float(self.config[config_section]['max_poll_interval'])
+                logger.info('%s max_poll_interval: %s', config_section, self.max_poll_interval)
+            else:
+                logger.warning('no "max_poll_interval" in "%s" section of config file, using default %s',
+                               config_section, self.max_poll_interval)
+
             # read stage_outputs:
             if 'stage_outputs' in self.config[config_section]:
                 self.stage_outputs = self.get_boolean(self.config[config_section]['stage_outputs'])
@@ -530,6 +494,12 @@ class JobComm(StatefulService.StatefulService):  # noqa: C901
             return True
         return False
 
+    def for_current_job(self, qmsg, current_job):
+        """ False for event range messages answering a request made for a previous job """
+        if 'PandaID' not in qmsg or current_job is None:
+            return True
+        return str(qmsg['PandaID']) == str(current_job['PandaID'])
+
     def request_events(self, current_job):
         msg = {
             'type': MessageTypes.REQUEST_EVENT_RANGES,
@@ -539,9 +509,17 @@ class JobComm(StatefulService.StatefulService):  # noqa: C901
             'destination_rank': 0,  # YODA rank
         }
         self.queues['MPIService'].put(msg)
+        self.events_threshold.requested()
+
+    def send_output_file(self, payload_msg):
+        """ add the output file reported by the payload to the files to send to Yoda/FileManager """
+        logger.debug('send output file information')
+
+        if self.current_job is None:
+            logger.error('received output file while there is no job: %s', payload_msg)
+            return
 
-    def send_output_file(self, payload_msg, current_job, eventranges, output_files):
-        logger.debug('sending output file information')
+        self.set_state(self.SEND_OUTPUT_FILE)
 
         # parse message
         parts = payload_msg.split(',')
@@ -569,74 +547,41 @@ class JobComm(StatefulService.StatefulService):  # noqa: C901
                                 'eventrangeid': eventrangeid,
                                 'cpu': cpu,
                                 'wallclock': wallclock,
-                                'scope': current_job['scopeOut'],
-                                'pandaid': current_job['PandaID'],
+                                'scope': self.current_job['scopeOut'],
+                                'pandaid': self.current_job['PandaID'],
                                 'eventstatus': 'finished',
                                 'destination_rank': 0,
                                 }
-            # self.output_file_data.set(output_file_data)
 
             # append output file data to list of files for transfer via MPI
-            output_files.append(output_file_data)
-            logger.info('received output file from AthenaMP; %s output files now on waiting list', len(output_files))
-
-            # return to state requesting a message
-            # self.set_state(self.WAIT_FOR_PAYLOAD_MESSAGE)
+            self.output_batcher.add([output_file_data])
+            logger.info('received output file from AthenaMP; %s output files now on waiting list', len(self.output_batcher))
+            self.increment_counter('output_files')
 
             # set event range to completed:
             logger.debug('mark event range id %s as completed', output_file_data['eventrangeid'])
             try:
-                eventranges.mark_completed(output_file_data['eventrangeid'])
+                self.eventranges.mark_completed(output_file_data['eventrangeid'])
             except Exception:
                 logger.error('failed to mark eventrangeid %s as completed', output_file_data['eventrangeid'])
                 self.stop()
 
-        else:
-            logger.error('failed to parse output file')
-
-    def send_eventrange(self, eventranges, athpayloadcomm, no_more_events):
-        logger.debug('sending event to payload')
-        # if event ranges available, send one
-        try:
-            logger.debug('have %d ready event ranges to send to AthenaMP', eventranges.number_ready())
-            local_eventranges = eventranges.get_next()
-
-        # no more event ranges available
-        except EventRangeList.NoMoreEventRanges:
-            logger.debug('there are no more event ranges to process')
-            # if we have been told there are no more eventranges, then tell the AthenaMP worker there are no more events
-            if no_more_events:
-                logger.info('sending AthenaMP NO_MORE_EVENTS')
-                athpayloadcomm.send(AthenaPayloadCommunicator.NO_MORE_EVENTS)
-            else:
-                # otherwise, raise the Exception to trigger an event request
-                raise
-
-        # something wrong with the index in the EventRangeList index
-        except EventRangeList.RequestedMoreRangesThanAvailable:
-            logger.error('requested more event ranges than available, going to try waiting for more events')
-            raise EventRangeList.NoMoreEventRanges()
+            # send right away if the batch is full
+            self.send_output_files()
 
         else:
-            logger.info('sending eventranges to AthenaMP: %s', local_eventranges)
-            # append full path to file name for AthenaMP
-            # and adjust event counter by the number of files
-            # input_files = self.job_def.get()['inFiles'].split(',')
-            # logger.debug('found %s input files',len(input_files))
-            for evtrg in local_eventranges:
-                evtrg['PFN'] = os.path.join(os.getcwd(), evtrg['LFN'])
-
-            # send AthenaMP the new event ranges
-            athpayloadcomm.send(serializer.serialize(local_eventranges))
+            logger.error('failed to parse output file')
 
 
 class AthenaPayloadCommunicator:
-    """ small class to handle yampl payloadcommunication exception handling """
+    """ small class to handle yampl payloadcommunication exception handling,
+        the socket may be polled from one thread while another sends """
     READY_FOR_EVENTS = 'Ready for events'
     NO_MORE_EVENTS = 'No more events'
     FAILED_PARSE = 'ERR_ATHENAMP_PARSE'
 
     def __init__(self, socketname='EventService_EventRanges', context='local'):
+        self.lock = threading.Lock()
 
         # create server socket for yampl
         try:
@@ -648,19 +593,16 @@ class AthenaPayloadCommunicator:
     def send(self, message):
         # send message using yampl
         try:
-            self.socket.send_raw(message)
+            with self.lock:
+                self.socket.send_raw(message)
         except Exception:
             logger.exception("Failed to send yampl message: %s", message)
             raise
 
-    def recv(self, timeout=0):
-        # receive yampl message, timeout is in milliseconds
-        t1 = time.time()
-        buf = ''
-        while time.time() < (t1 + timeout):
+    def poll(self):
+        """ return a waiting yampl message, None if there is none """
+        with self.lock:
             size, buf = self.socket.try_recv_raw()
-            if size == -1:
-                time.sleep(1)
-            else:
-                break
+        if size == -1:
+            return None
         return str(buf)
@@ -0,0 +1,122 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+# Times the EventRangeList operations done for every range of a job, filling
+# the list at once or in refills, handing out ranges with get_next and marking
+# them completed, for lists of 10^3 to 10^6 ranges. The time per range should stay flat as the
+# list grows.
+#
+# With --memory it reports the memory held by an EventRangeList next to a
+# dictionary of EventRange objects, the layout used before the list became
+# column-wise. Each measurement runs in its own process and uses the growth
+# of the peak resident size, so it is only a rough figure.
+#
+# usage: python benchmark_eventrangelist.py [-n 1000,10000,100000,1000000] [-b BATCH] [--refill REFILL] [--memory]
+
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+from pandayoda.common import EventRange
+from pandayoda.common import EventRangeList
+
+
+def eventrange_dicts(nranges):
+    return [{'eventRangeID': '10919503-3298217817-8731829857-%d-49' % i,
+             'LFN': 'EVNT.06402143._000615.pool.root.1',
+             'GUID': 'BEA4C016-E37E-0841-A448-8D664E8CD570',
+             'scope': 'mc15_13TeV',
+             'startEvent': i,
+             'lastEvent': i} for i in range(nranges)]
+
+
+def run(nranges, batch, refill):
+    dicts = eventrange_dicts(nranges)
+    timings = []
+
+    start = time.time()
+    erl = EventRangeList.EventRangeList(dicts)
+    timings.append(('fill', time.time() - start))
+
+    # the same ranges arriving in refills of request_n_eventranges, each merged in place
+    start = time.time()
+    refilled = EventRangeList.EventRangeList()
+    for i in range(0, nranges, refill):
+        refilled.extend(dicts[i:i + refill])
+    timings.append(('refill', time.time() - start))
+
+    start = time.time()
+    assigned = []
+    while erl.number_ready() > 0:
+        assigned.extend(erl.get_next(min(batch, erl.number_ready())))
+    timings.append(('get_next', time.time() - start))
+
+    # complete in the order the ranges were handed out, as output files arrive
+    start = time.time()
+    for eventrange in assigned:
+        erl.mark_completed(eventrange['eventRangeID'])
+    timings.append(('mark_completed', time.time() - start))
+
+    if erl.number_completed() != nranges:
+        raise Exception('completed %d of %d ranges' % (erl.number_completed(), nranges))
+    return timings
+
+
+def max_rss_bytes():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure_memory(nranges, layout):
+    """ run in a child process, prints the bytes held by nranges ranges in the given layout """
+    dicts = eventrange_dicts(nranges)
+    before = max_rss_bytes()
+    if layout == 'objects':
+        held = {}
+        for eventrange in dicts:
+            held[eventrange['eventRangeID']] = EventRange.EventRange(eventrange)
+    else:
+        held = EventRangeList.EventRangeList(dicts)
+    print(max_rss_bytes() - before)
+    return held
+
+
+def main():
+    oparser = argparse.ArgumentParser()
+    oparser.add_argument('-n', '--nranges', dest='nranges', default='1000,10000,100000,1000000',
+                         help='comma separated list of the number of ranges to test')
+    oparser.add_argument('-b', '--batch', dest='batch', default=128, type=int, help='ranges per get_next call')
+    oparser.add_argument('--refill', dest='refill', default=8192, type=int, help='ranges per refill')
+    oparser.add_argument('--memory', dest='memory', default=False, action='store_true', help='report memory instead of timing')
+    oparser.add_argument('--layout', dest='layout', default=None, help=argparse.SUPPRESS)
+    args = oparser.parse_args()
+
+    if args.layout is not None:
+        measure_memory(int(args.nranges), args.layout)
+        return
+
+    if args.memory:
+        for nranges in [int(n) for n in args.nranges.split(',')]:
+            results = []
+            for layout in ['objects', 'EventRangeList']:
+                output = subprocess.check_output([sys.executable, __file__, '-n', str(nranges), '--layout', layout])
+                results.append((layout, int(output.split()[-1])))
+            print('%8d ranges  ' % nranges + '  '.join('%s %8.1f MB (%4d bytes/range)' % (layout, held / 1e6, held / nranges)
+                                                       for layout, held in results))
+        return
+
+    for nranges in [int(n) for n in args.nranges.split(',')]:
+        timings = run(nranges, args.batch, args.refill)
+        print('%8d ranges  ' % nranges + '  '.join('%s %7.3f s (%5.2f us/range)' % (name, duration, duration * 1e6 / nranges)
+                                                   for name, duration in timings))
+
+
+if __name__ == '__main__':
+    main()
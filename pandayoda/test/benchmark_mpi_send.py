@@ -0,0 +1,101 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+# Compares the work done per message by the MPIService send path before and
+# after serializing once into the send buffer. No MPI is needed, only the
+# serialization steps that happen before the message is handed to MPI are timed.
+#
+# usage: python benchmark_mpi_send.py [-n NRANGES] [-r REPEAT]
+
+import argparse
+import copy
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+def new_event_ranges_message(nranges):
+    eventranges = []
+    for i in range(nranges):
+        eventranges.append({'eventRangeID': '10919503-3298217817-8731829857-%d-49' % i,
+                            'LFN': 'EVNT.06402143._000615.pool.root.1',
+                            'GUID': 'BEA4C016-E37E-0841-A448-8D664E8CD570',
+                            'scope': 'mc15_13TeV',
+                            'startEvent': i,
+                            'lastEvent': i})
+    return {'type': 'NEW_EVENT_RANGES', 'eventranges': eventranges, 'destination_rank': 1}
+
+
+def output_file_message(nfiles):
+    filelist = []
+    for i in range(nfiles):
+        filelist.append({'type': 'OUTPUT_FILE',
+                         'filename': '/scratch/droid_rank_00001/worker_%d/myHITS.pool.root_%03d.Range-%d' % (i % 64, i, i),
+                         'eventrangeid': '10919503-3298217817-8731829857-%d-49' % i,
+                         'cpu': '312', 'wallclock': '320',
+                         'scope': 'mc15_13TeV', 'pandaid': 3298217817,
+                         'eventstatus': 'finished', 'destination_rank': 0})
+    return {'type': 'OUTPUT_FILE', 'filelist': filelist, 'destination_rank': 0}
+
+
+def old_send(qmsg):
+    # deepcopy of the message, followed by the pickle done inside lowercase isend
+    msgbuff = copy.deepcopy(qmsg)
+    return pickle.dumps(msgbuff, pickle.HIGHEST_PROTOCOL)
+
+
+def new_send(qmsg):
+    # one pickle straight into the buffer handed to Isend
+    return pickle.dumps(qmsg, pickle.HIGHEST_PROTOCOL)
+
+
+def measure(func, qmsg, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        func(qmsg)
+    duration = (time.time() - start) / repeat
+
+    allocated = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        func(qmsg)
+        allocated = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return duration, allocated
+
+
+def main():
+    oparser = argparse.ArgumentParser()
+    oparser.add_argument('-n', '--nranges', dest='nranges', default=10000, type=int, help='number of ranges or files per message')
+    oparser.add_argument('-r', '--repeat', dest='repeat', default=20, type=int, help='number of sends to average over')
+    args = oparser.parse_args()
+
+    for name, qmsg in [('NEW_EVENT_RANGES', new_event_ranges_message(args.nranges)),
+                       ('OUTPUT_FILE', output_file_message(args.nranges))]:
+        payload = len(new_send(qmsg))
+        print('%s with %d entries, %d bytes on the wire' % (name, args.nranges, payload))
+        for label, func in [('deepcopy + isend', old_send), ('single pickle + Isend', new_send)]:
+            duration, allocated = measure(func, qmsg, args.repeat)
+            if allocated is None:
+                print('  %-24s %8.2f ms/msg' % (label, duration * 1000.))
+            else:
+                print('  %-24s %8.2f ms/msg  %10d bytes allocated/msg (%.1fx payload)' %
+                      (label, duration * 1000., allocated, float(allocated) / payload))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+# Compares the size on the wire and the encode/decode time of the messages
+# exchanged between Yoda and Droid for the pickle, JSON (serializer) and
+# binary (binary_serializer) formats. No MPI is needed.
+#
+# usage: python benchmark_wire_format.py [-n NRANGES] [-r REPEAT]
+
+import argparse
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from pandayoda.common import serializer
+from pandayoda.common import binary_serializer
+
+
+def new_event_ranges_message(nranges):
+    eventranges = []
+    for i in range(nranges):
+        eventranges.append({'eventRangeID': '10919503-3298217817-8731829857-%d-49' % i,
+                            'LFN': 'EVNT.06402143._000615.pool.root.1',
+                            'GUID': 'BEA4C016-E37E-0841-A448-8D664E8CD570',
+                            'scope': 'mc15_13TeV',
+                            'startEvent': i,
+                            'lastEvent': i})
+    return {'type': 'NEW_EVENT_RANGES', 'eventranges': eventranges, 'destination_rank': 1}
+
+
+def output_file_message(nfiles):
+    filelist = []
+    for i in range(nfiles):
+        filelist.append({'type': 'OUTPUT_FILE',
+                         'filename': '/scratch/droid_rank_00001/worker_%d/myHITS.pool.root_%03d.Range-%d' % (i % 64, i, i),
+                         'eventrangeid': '10919503-3298217817-8731829857-%d-49' % i,
+                         'cpu': '312', 'wallclock': '320',
+                         'scope': 'mc15_13TeV', 'pandaid': 3298217817,
+                         'eventstatus': 'finished', 'destination_rank': 0})
+    return {'type': 'OUTPUT_FILE', 'filelist': filelist, 'destination_rank': 0}
+
+
+def request_event_ranges_message():
+    return {'type': 'REQUEST_EVENT_RANGES', 'PandaID': '3298217817', 'taskID': '10919503',
+            'jobsetID': '3298217816', 'destination_rank': 0}
+
+
+FORMATS = [
+    ('pickle', lambda m: pickle.dumps(m, pickle.HIGHEST_PROTOCOL), pickle.loads),
+    ('json', serializer.serialize, serializer.deserialize),
+    ('binary', binary_serializer.serialize, binary_serializer.deserialize),
+]
+
+
+def timeit(func, arg, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        func(arg)
+    return (time.time() - start) / repeat
+
+
+def main():
+    oparser = argparse.ArgumentParser()
+    oparser.add_argument('-n', '--nranges', dest='nranges', default=1000, type=int, help='number of ranges or files per message')
+    oparser.add_argument('-r', '--repeat', dest='repeat', default=20, type=int, help='number of encodes/decodes to average over')
+    args = oparser.parse_args()
+
+    for name, qmsg in [('NEW_EVENT_RANGES', new_event_ranges_message(args.nranges)),
+                       ('OUTPUT_FILE', output_file_message(args.nranges)),
+                       ('REQUEST_EVENT_RANGES', request_event_ranges_message())]:
+        # messages are built from what Harvester writes, so no two strings share an object
+        qmsg = serializer.deserialize(serializer.serialize(qmsg))
+        print('%s' % name)
+        for label, encode, decode in FORMATS:
+            buf = encode(qmsg)
+            if decode(buf) != qmsg:
+                print('  %-8s does not round trip' % label)
+            encode_time = timeit(encode, qmsg, args.repeat)
+            decode_time = timeit(decode, buf, args.repeat)
+            print('  %-8s %10d bytes  encode %8.3f ms  decode %8.3f ms' %
+                  (label, len(buf), encode_time * 1000., decode_time * 1000.))
+
+
+if __name__ == '__main__':
+    main()
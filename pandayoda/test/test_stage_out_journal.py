@@ -0,0 +1,49 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+# a batch torn by a crash in the middle of the stage out journal must not
+# keep the batches around it from being handed to Harvester
+
+import os
+import json
+import shutil
+import tempfile
+from pandayoda.yoda import shared_file_messenger as sfm
+
+tmpdir = tempfile.mkdtemp()
+try:
+    eventstatusdumpjsonfile = os.path.join(tmpdir, 'worker_updateevents.json')
+    sfm.sfm_har_config['eventStatusDumpJsonFile'] = eventstatusdumpjsonfile
+    sfm.sfm_har_config_done.set()
+
+    sfm.append_stage_out_journal({'1': [{'eventRangeID': 'r1'}]})
+    # a crash while the second batch was written
+    with open(eventstatusdumpjsonfile + '.journal', 'a') as f:
+        f.write('{"1": [{"eventRangeID": "r2"')
+    sfm.append_stage_out_journal({'1': [{'eventRangeID': 'r3'}], '2': [{'eventRangeID': 'r4'}]})
+    # a crash while the last batch was written
+    with open(eventstatusdumpjsonfile + '.journal', 'a') as f:
+        f.write('{"2": [')
+
+    nfiles = sfm.compact_stage_out_journal()
+    print('%s files handed to Harvester' % nfiles)
+    assert nfiles == 3
+
+    data = json.load(open(eventstatusdumpjsonfile))
+    assert [x['eventRangeID'] for x in data['1']] == ['r1', 'r3']
+    assert [x['eventRangeID'] for x in data['2']] == ['r4']
+    assert not os.path.exists(eventstatusdumpjsonfile + '.journal.compacting')
+
+    # Harvester consumed the file, the next batch goes through again
+    os.remove(eventstatusdumpjsonfile)
+    sfm.append_stage_out_journal({'3': [{'eventRangeID': 'r5'}]})
+    assert sfm.compact_stage_out_journal() == 1
+    assert json.load(open(eventstatusdumpjsonfile)).keys() == ['3']
+    print('torn journal records are skipped')
+finally:
+    shutil.rmtree(tmpdir)
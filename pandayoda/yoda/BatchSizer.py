@@ -0,0 +1,84 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+import math
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+
+class BatchSizer(object):
+    """ Chooses how many event ranges to send a Droid rank per request.
+
+        The completion rate of each rank is measured from the OUTPUT_FILE messages it sends
+        and a batch is sized to keep the rank busy for target_time seconds. Until a rank has
+        reported output files it is sent send_n_eventranges. As the ready pool runs low the
+        batch is limited to an equal share of what is left for the active ranks (guided
+        self-scheduling), so the last ranges are spread over the ranks instead of leaving a
+        few ranks with long batches at the end of the job. """
+
+    def __init__(self, send_n_eventranges, target_time=600., min_batch=1, max_batch=None, rate_weight=0.3):
+        """ send_n_eventranges: ranges sent to a rank before its rate is known
+            target_time:        seconds of work a batch should hold
+            min_batch:          smallest batch sent while enough ranges are ready
+            max_batch:          largest batch sent, defaults to 8 * send_n_eventranges
+            rate_weight:        weight of the newest measurement in the averaged rate
+        """
+        self.send_n_eventranges = send_n_eventranges
+        self.target_time = target_time
+        self.min_batch = max(1, min_batch)
+        self.max_batch = max_batch if max_batch is not None else 8 * send_n_eventranges
+        self.rate_weight = rate_weight
+
+        # rank: averaged completed ranges per second
+        self.rates = {}
+        # rank: time of the last output files received, or of the first batch sent
+        self.last_times = {}
+
+    def sent(self, rank, now=None):
+        """ a batch was sent to rank, starts the clock for its first rate measurement """
+        if now is None:
+            now = time.time()
+        if rank not in self.last_times:
+            self.last_times[rank] = now
+
+    def completed(self, rank, nranges, now=None):
+        """ rank reported nranges output files """
+        if now is None:
+            now = time.time()
+        last_time = self.last_times.get(rank)
+        self.last_times[rank] = now
+        if last_time is None or now <= last_time:
+            return
+        rate = float(nranges) / (now - last_time)
+        if rank in self.rates:
+            self.rates[rank] += self.rate_weight * (rate - self.rates[rank])
+        else:
+            self.rates[rank] = rate
+        logger.debug('rank %s completed %s ranges at %.2f/s, average %.2f/s', rank, nranges, rate, self.rates[rank])
+
+    def batch_size(self, rank, number_ready, active_ranks):
+        """ return the number of ranges to send rank, number_ready are in the pool shared by active_ranks """
+        if number_ready <= 0:
+            return 0
+
+        if rank in self.rates:
+            size = int(self.rates[rank] * self.target_time)
+        else:
+            size = self.send_n_eventranges
+        size = min(max(size, self.min_batch), self.max_batch)
+
+        # guided self-scheduling: never take more than an equal share of the remaining pool
+        share = int(math.ceil(number_ready / float(max(active_ranks, 1))))
+        size = min(size, max(share, self.min_batch))
+
+        return min(size, number_ready)
+
+    def remove(self, rank):
+        self.rates.pop(rank, None)
+        self.last_times.pop(rank, None)
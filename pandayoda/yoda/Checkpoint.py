@@ -0,0 +1,99 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+import os
+import json
+import logging
+from pandayoda.common import serializer
+logger = logging.getLogger(__name__)
+
+
+class Checkpoint(object):
+    """ Keeps the state of a Yoda component on disk so the next allocation can resume from it.
+
+        The state is a snapshot, <path>.snapshot, plus a log of the changes made since,
+        <path>.log, with one JSON record per line. Changes are appended to the log as
+        they happen and compact() replaces both with a new snapshot every so often.
+
+        Both files carry a generation number. compact() first writes the new snapshot,
+        then starts a new log, so a log whose generation differs from the snapshot's
+        was written before the snapshot and is already part of it. A line cut short by
+        the end of the allocation is ignored when the log is read back. """
+
+    def __init__(self, path):
+        self.snapshot_filename = path + '.snapshot'
+        self.log_filename = path + '.log'
+        self.generation = 0
+        self.log = None
+
+    def exists(self):
+        return os.path.exists(self.snapshot_filename)
+
+    def load(self):
+        """ return the snapshot state and the list of records logged after it, (None, []) if there is no checkpoint """
+        if not self.exists():
+            return None, []
+
+        with open(self.snapshot_filename) as f:
+            snapshot = serializer.deserialize(f.read())
+        self.generation = snapshot['generation']
+
+        records = []
+        if os.path.exists(self.log_filename):
+            with open(self.log_filename) as f:
+                lines = f.read().split('\n')
+            try:
+                header = json.loads(lines[0])
+            except ValueError:
+                header = {}
+            if header.get('generation') != self.generation:
+                logger.info('checkpoint log %s predates the snapshot, ignoring it', self.log_filename)
+            else:
+                for i, line in enumerate(lines[1:]):
+                    if not line:
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        logger.warning('ignoring incomplete record %s of checkpoint log %s', i + 1, self.log_filename)
+                        break
+
+        logger.info('loaded checkpoint generation %s with %s logged records', self.generation, len(records))
+        return snapshot['state'], records
+
+    def append(self, record):
+        """ add a record to the log, it is on disk when this returns """
+        if self.log is None:
+            self.log = open(self.log_filename, 'a')
+        self.log.write(serializer.serialize(record) + '\n')
+        self.log.flush()
+        os.fsync(self.log.fileno())
+
+    def compact(self, state):
+        """ write state as the new snapshot and start an empty log """
+        self.generation += 1
+        self.write_file(self.snapshot_filename, serializer.serialize({'generation': self.generation, 'state': state}))
+
+        if self.log is not None:
+            self.log.close()
+        self.write_file(self.log_filename, serializer.serialize({'generation': self.generation}) + '\n')
+        self.log = open(self.log_filename, 'a')
+
+    def write_file(self, filename, data):
+        # replace the file atomically so a crash leaves either the old or the new content
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_filename, filename)
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
@@ -0,0 +1,150 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+import time
+import logging
+from collections import deque
+logger = logging.getLogger(__name__)
+
+
+class EventRangePrefetcher(object):
+    """ Decides when WorkManager should ask Harvester for more event ranges for a panda id
+        and how many, so the pool is refilled before the Droid ranks empty it.
+
+        Per panda id it keeps the ranks that asked for ranges recently, the ranges handed out
+        over the last rate_window seconds and the time Harvester took to answer the previous
+        requests. From these:
+            low watermark  = max(send_n_eventranges * active ranks, safety_factor * rate * latency)
+            high watermark = max(2 * low, low + request_n_eventranges)
+        Once the ready ranges drop below the low watermark, the ranges needed to reach the
+        high watermark are requested. """
+
+    def __init__(self, send_n_eventranges, request_n_eventranges, safety_factor=2.,
+                 active_rank_timeout=600., rate_window=300., latency_weight=0.5):
+        """ send_n_eventranges:     number of ranges sent to a rank per request
+            request_n_eventranges:  smallest number of ranges requested from Harvester
+            safety_factor:          the low watermark covers this many Harvester round trips
+            active_rank_timeout:    ranks that have not asked for ranges for this many seconds are not counted
+            rate_window:            seconds of history used to measure the consumption rate
+            latency_weight:         weight of the newest round trip in the averaged latency
+        """
+        self.send_n_eventranges = send_n_eventranges
+        self.request_n_eventranges = request_n_eventranges
+        self.safety_factor = safety_factor
+        self.active_rank_timeout = active_rank_timeout
+        self.rate_window = rate_window
+        self.latency_weight = latency_weight
+
+        # state per panda id, see get_pool
+        self.pools = {}
+
+    def get_pool(self, pandaid):
+        pandaid = str(pandaid)
+        if pandaid not in self.pools:
+            self.pools[pandaid] = {
+                # rank: time of its last request
+                'ranks': {},
+                # (time, number of ranges) handed out within the rate_window
+                'consumed': deque(),
+                'nconsumed': 0,
+                'first_consumed': None,
+                # averaged Harvester round trip in seconds, None until measured
+                'latency': None,
+                # time the outstanding request was made, None if there is none
+                'request_time': None,
+            }
+        return self.pools[pandaid]
+
+    def rank_active(self, pandaid, rank, now=None):
+        """ a rank asked for event ranges of this panda id """
+        if now is None:
+            now = time.time()
+        self.get_pool(pandaid)['ranks'][rank] = now
+
+    def consumed(self, pandaid, nranges, now=None):
+        """ nranges event ranges of this panda id were sent to a rank """
+        if now is None:
+            now = time.time()
+        pool = self.get_pool(pandaid)
+        pool['consumed'].append((now, nranges))
+        pool['nconsumed'] += nranges
+        if pool['first_consumed'] is None:
+            pool['first_consumed'] = now
+
+    def requested(self, pandaid, now=None):
+        """ a request for event ranges of this panda id was sent to Harvester """
+        if now is None:
+            now = time.time()
+        self.get_pool(pandaid)['request_time'] = now
+
+    def received(self, pandaid, now=None):
+        """ Harvester answered the outstanding request for this panda id """
+        if now is None:
+            now = time.time()
+        pool = self.get_pool(pandaid)
+        if pool['request_time'] is None:
+            return
+        latency = now - pool['request_time']
+        pool['request_time'] = None
+        if pool['latency'] is None:
+            pool['latency'] = latency
+        else:
+            pool['latency'] += self.latency_weight * (latency - pool['latency'])
+        logger.debug('panda id %s Harvester round trip %.1f seconds, average %.1f', pandaid, latency, pool['latency'])
+
+    def cancel(self, pandaid):
+        """ the outstanding request for this panda id will not be answered """
+        self.get_pool(pandaid)['request_time'] = None
+
+    def active_ranks(self, pandaid, now=None):
+        if now is None:
+            now = time.time()
+        ranks = self.get_pool(pandaid)['ranks']
+        for rank, last_request in list(ranks.items()):
+            if now - last_request > self.active_rank_timeout:
+                del ranks[rank]
+        return len(ranks)
+
+    def rate(self, pandaid, now=None):
+        """ event ranges handed out per second over the rate_window """
+        if now is None:
+            now = time.time()
+        pool = self.get_pool(pandaid)
+        consumed = pool['consumed']
+        while len(consumed) > 0 and now - consumed[0][0] > self.rate_window:
+            pool['nconsumed'] -= consumed.popleft()[1]
+        if pool['first_consumed'] is None:
+            return 0.
+        # until a full window has passed, average over the time since the first ranges went out
+        span = float(min(self.rate_window, now - pool['first_consumed']))
+        if span <= 0:
+            return 0.
+        return pool['nconsumed'] / span
+
+    def watermarks(self, pandaid, now=None):
+        """ return the (low, high) watermarks for the ready ranges of this panda id """
+        if now is None:
+            now = time.time()
+        low = self.send_n_eventranges * self.active_ranks(pandaid, now)
+        latency = self.get_pool(pandaid)['latency']
+        if latency is not None:
+            low = max(low, int(self.safety_factor * self.rate(pandaid, now) * latency))
+        high = max(2 * low, low + self.request_n_eventranges)
+        return low, high
+
+    def need(self, pandaid, number_ready, now=None):
+        """ return the number of event ranges to request for this panda id, 0 if none are needed """
+        low, high = self.watermarks(pandaid, now)
+        if number_ready < low:
+            logger.debug('panda id %s has %s ready event ranges, below the low watermark %s, requesting %s',
+                         pandaid, number_ready, low, high - number_ready)
+            return high - number_ready
+        return 0
+
+    def remove(self, pandaid):
+        self.pools.pop(str(pandaid), None)
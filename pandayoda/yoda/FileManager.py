@@ -11,8 +11,10 @@ import os
 import logging
 import time
 import Queue
+import threading
 from pandayoda.common.yoda_multiprocessing import Process, Event
-from pandayoda.common import MessageTypes
+from pandayoda.common import MessageTypes, OutputBatcher
+from pandayoda.yoda import Checkpoint
 
 logger = logging.getLogger(__name__)
 
@@ -47,6 +49,20 @@ class FileManager(Process):
 
         # default harvester_output_timeout
         self.harvester_output_timeout = 10
+        self.batch_max_files = 1000
+        self.batch_max_bytes = 1000000
+
+        # checkpoint of the output files not yet handed to Harvester
+        self.use_checkpoint = True
+        self.checkpoint_interval = 300.
+        self.resume = False
+        self.checkpoint = None
+        self.last_compaction = None
+
+        # set in run()
+        self.batcher = None
+        self.journal = False
+        self.last_check = None
 
     def stop(self):
         """ this function can be called by outside threads to cause the JobManager thread to exit. """
@@ -58,57 +74,168 @@ class FileManager(Process):
         # read configuration info from file
         self.read_config()
 
-        local_filelist = []
+        # output files waiting to be staged to Harvester, their age counts from the time
+        # JobComm received them
+        self.batcher = OutputBatcher.OutputBatcher('FileManager output files', self.batch_max_files,
+                                                   self.batch_max_bytes, self.harvester_output_timeout)
+
+        self.last_check = time.time()
+
+        # in the journal mode output files are appended to a journal as they arrive
+        # and the messenger hands them to Harvester once it consumed the previous file
+        self.journal = self.harvester_messenger.stage_out_journal_enabled()
 
-        last_check = time.time()
+        self.open_checkpoint()
+
+        # stage what the previous allocation left behind without waiting for new output files
+        if self.resume:
+            self.queues['FileManager'].put({'type': MessageTypes.WAKE_UP})
+
+        # wakes this loop up as soon as Harvester consumes the eventStatusDumpJsonFile
+        watcher = threading.Thread(target=self.watch_stage_out_file, name='FileManagerWatcher')
+        watcher.daemon = True
+        watcher.start()
 
         while not self.exit.is_set():
-            logger.debug('starting loop, local_filelist size: %s', len(local_filelist))
+            logger.debug('starting loop, %s output files waiting', len(self.batcher))
+
+            # replace the checkpoint log with a new snapshot
+            if self.checkpoint is not None and time.time() - self.last_compaction > self.checkpoint_interval:
+                self.checkpoint.compact({'filelist': self.batcher.pending()})
+                self.last_compaction = time.time()
 
-            # process incoming messages
+            # process incoming messages, waking up when the oldest waiting file is due
+            timeout = self.loop_timeout
+            if len(self.batcher) > 0:
+                timeout = min(timeout, max(self.batcher.time_until_due(), 0.1))
             try:
-                qmsg = self.queues['FileManager'].get(timeout=self.loop_timeout)
+                qmsg = self.queues['FileManager'].get(timeout=timeout)
             except Queue.Empty:
                 logger.debug('queue is empty')
             else:
-
                 logger.debug('message received: %s', qmsg)
+                self.handle_queue_message(qmsg)
+
+            self.stage_out_due()
+
+            # hand journaled files to Harvester even when no new files arrive
+            if self.journal and time.time() - self.last_check > self.harvester_output_timeout:
+                self.compact_journal()
+
+        if len(self.batcher) > 0:
+            self.stage_out(self.batcher, 'exit')
 
-                if qmsg['type'] == MessageTypes.OUTPUT_FILE:
-
-                    local_filelist += qmsg['filelist']
-                    logger.info('received output file, waiting list contains %s files', len(local_filelist))
-
-                    # I don't want to constantly check to see if the output file exists
-                    # so I'll only check every few seconds
-                    if time.time() - last_check > self.harvester_output_timeout:
-                        last_check = time.time()
-
-                        # if an output file already exists,
-                        # wait for harvester to read in file, so add file list to
-                        # local running list
-                        if not self.harvester_messenger.stage_out_file_exists():
-                            # add file to Harvester stage out
-                            logger.info('staging %s files to Harvester', len(local_filelist))
-                            self.harvester_messenger.stage_out_files(
-                                local_filelist,
-                                self.output_file_type
-                            )
-                            local_filelist = []
-                        else:
-                            logger.warning(
-                                'Harvester has not yet consumed output files, currently waiting to dump %s output files',
-                                len(local_filelist))
-                else:
-                    logger.error('message type not recognized')
-
-        if local_filelist:
-            logger.info('staging %s files to Harvester', len(local_filelist))
-            self.harvester_messenger.stage_out_files(local_filelist, self.output_file_type)
+        if self.checkpoint is not None:
+            self.checkpoint.compact({'filelist': self.batcher.pending()})
+            self.checkpoint.close()
 
         # exit
         logger.info('FileManager exiting')
 
+    def open_checkpoint(self):
+        """ keep the output files waiting for Harvester on disk so a later allocation can stage them,
+            the journal mode needs no checkpoint since the journal already is on disk """
+        if self.use_checkpoint and not self.journal:
+            self.checkpoint = Checkpoint.Checkpoint(os.path.join(self.yoda_working_path, 'yoda_checkpoint_' + config_section))
+            if self.resume:
+                # the files of the previous allocation are due right away
+                self.batcher.add(self.restore_checkpoint(), time.time() - self.harvester_output_timeout)
+            self.checkpoint.compact({'filelist': self.batcher.pending()})
+        self.last_compaction = time.time()
+
+    def handle_queue_message(self, qmsg):
+        if qmsg['type'] == MessageTypes.OUTPUT_FILE and self.journal:
+            logger.info('received output file, appending %s files to the stage out journal', len(qmsg['filelist']))
+            self.harvester_messenger.stage_out_files(qmsg['filelist'], self.output_file_type)
+            self.last_check = time.time()
+
+        elif qmsg['type'] == MessageTypes.OUTPUT_FILE:
+            self.batcher.add(qmsg['filelist'], time.time() - qmsg.get('batch_age', 0.))
+            self.log_checkpoint({'op': 'outputs', 'filelist': qmsg['filelist']})
+            logger.info('received output file, waiting list contains %s files', len(self.batcher))
+
+        elif qmsg['type'] == MessageTypes.WAKE_UP:
+            # Harvester consumed the eventStatusDumpJsonFile, hand over the waiting files now
+            if self.journal:
+                self.compact_journal()
+            else:
+                self.last_check = time.time()
+                if len(self.batcher) > 0 and not self.harvester_messenger.stage_out_file_exists():
+                    self.stage_out(self.batcher, 'harvester ready')
+
+        elif qmsg['type'] == MessageTypes.WALLCLOCK_EXPIRING:
+            self.wallclock_expiring()
+
+        else:
+            logger.error('message type not recognized')
+
+    def wallclock_expiring(self):
+        """ stage what is waiting and every file that still arrives without delay,
+            merging into the eventStatusDumpJsonFile if Harvester has not consumed it """
+        logger.info('wall clock expiring, staging %s output files without waiting', len(self.batcher))
+        self.batcher.expiring()
+        if self.journal:
+            self.harvester_messenger.compact_stage_out_journal()
+
+    def stage_out_due(self):
+        """ stage the waiting files once their batch is due, if an output file already
+            exists wait for Harvester to read it in first """
+        reason = self.batcher.due()
+        if reason is None:
+            return
+        if reason == 'expiring' or not self.harvester_messenger.stage_out_file_exists():
+            self.stage_out(self.batcher, reason)
+        elif time.time() - self.last_check > self.harvester_output_timeout:
+            self.last_check = time.time()
+            logger.warning('Harvester has not yet consumed output files, currently waiting to dump %s output files',
+                           len(self.batcher))
+
+    def compact_journal(self):
+        self.last_check = time.time()
+        nfiles = self.harvester_messenger.compact_stage_out_journal()
+        if nfiles > 0:
+            logger.info('staged %s journaled files to Harvester', nfiles)
+
+    def stage_out(self, batcher, reason):
+        """ hand all files waiting in batcher to Harvester """
+        filelist, age = batcher.take(reason, limit=False)
+        logger.info('staging %s files to Harvester', len(filelist))
+        self.harvester_messenger.stage_out_files(filelist, self.output_file_type)
+        self.log_checkpoint({'op': 'staged'})
+
+    def log_checkpoint(self, record):
+        if self.checkpoint is not None:
+            self.checkpoint.append(record)
+
+    def restore_checkpoint(self):
+        """ return the output files the checkpoint holds that were not handed to Harvester """
+        state, records = self.checkpoint.load()
+        if state is None:
+            logger.warning('asked to resume but there is no checkpoint, starting from scratch')
+            return []
+        filelist = state['filelist']
+        for record in records:
+            if record['op'] == 'outputs':
+                filelist += record['filelist']
+            elif record['op'] == 'staged':
+                filelist = []
+        logger.info('resumed %s output files waiting to be staged to Harvester', len(filelist))
+        return filelist
+
+    def watch_stage_out_file(self):
+        """ runs in a thread, posts a WAKE_UP message each time Harvester consumes the eventStatusDumpJsonFile """
+        while not self.exit.is_set():
+            try:
+                if not self.harvester_messenger.stage_out_file_exists():
+                    self.harvester_messenger.wait_for_stage_out_file(True, timeout=self.loop_timeout)
+                elif self.harvester_messenger.wait_for_stage_out_file(False, timeout=self.loop_timeout):
+                    logger.debug('eventStatusDumpJsonFile consumed by Harvester, waking up FileManager')
+                    self.queues['FileManager'].put({'type': MessageTypes.WAKE_UP})
+            except Exception:
+                logger.exception('failed to watch the eventStatusDumpJsonFile, falling back to checking every %s seconds',
+                                 self.harvester_output_timeout)
+                return
+
     def read_config(self):
 
         if config_section in self.config:
@@ -136,6 +263,22 @@ class FileManager(Process):
                 logger.warning('no "harvester_output_timeout" in "%s" section of config file, keeping default %s',
                                config_section, self.harvester_output_timeout)
 
+            # read batch_max_files:
+            if 'batch_max_files' in self.config[config_section]:
+                self.batch_max_files = int(self.config[config_section]['batch_max_files'])
+                logger.info('%s batch_max_files: %s', config_section, self.batch_max_files)
+            else:
+                logger.warning('no "batch_max_files" in "%s" section of config file, keeping default %s',
+                               config_section, self.batch_max_files)
+
+            # read batch_max_bytes:
+            if 'batch_max_bytes' in self.config[config_section]:
+                self.batch_max_bytes = int(self.config[config_section]['batch_max_bytes'])
+                logger.info('%s batch_max_bytes: %s', config_section, self.batch_max_bytes)
+            else:
+                logger.warning('no "batch_max_bytes" in "%s" section of config file, keeping default %s',
+                               config_section, self.batch_max_bytes)
+
             # read output_file_type:
             if 'output_file_type' in self.config[config_section]:
                 self.output_file_type = self.config[config_section]['output_file_type']
@@ -146,5 +289,26 @@ class FileManager(Process):
                 raise Exception(
                     'must specify "output_file_type" in %s section of config file. Typically set to "es_output"' % config_section)
 
+            # read checkpoint:
+            if 'checkpoint' in self.config[config_section]:
+                self.use_checkpoint = 'true' in self.config[config_section]['checkpoint'].lower()
+                logger.info('%s checkpoint: %s', config_section, self.use_checkpoint)
+            else:
+                logger.warning('no "checkpoint" in "%s" section of config file, keeping default %s', config_section, self.use_checkpoint)
+
+            # read checkpoint_interval:
+            if 'checkpoint_interval' in self.config[config_section]:
+                self.checkpoint_interval = float(self.config[config_section]['checkpoint_interval'])
+                logger.info('%s checkpoint_interval: %s', config_section, self.checkpoint_interval)
+            else:
+                logger.warning('no "checkpoint_interval" in "%s" section of config file, keeping default %s', config_section, self.checkpoint_interval)
+
+            # read resume:
+            if 'resume' in self.config[config_section]:
+                self.resume = 'true' in self.config[config_section]['resume'].lower()
+                logger.info('%s resume: %s', config_section, self.resume)
+            else:
+                logger.warning('no "resume" in "%s" section of config file, keeping default %s', config_section, self.resume)
+
         else:
             raise Exception('no %s section in the configuration' % config_section)
@@ -0,0 +1,148 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Authors:
+# - Taylor Childers (john.taylor.childers@cern.ch)
+
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LeaseTable(object):
+    """ Records which Droid rank holds which assigned event ranges.
+
+        A lease is granted when ranges are sent to a rank and released when the rank
+        reports their output files. Every message from a rank renews all of its leases.
+        A rank that has not been heard from for longer than the lease time loses its
+        leases, as does a rank that exits. A rank that asks for a new job may still send
+        the last output files of its previous job, so its leases are orphaned and only
+        lost after a grace time. Lost leases are returned by expire() and release_rank()
+        so their ranges can be marked ready again.
+
+        The lease time is lease_factor times the averaged time from sending a range to
+        receiving its output file, but at least min_lease_time. """
+
+    def __init__(self, min_lease_time=600., lease_factor=3., duration_weight=0.1):
+        """ min_lease_time:     shortest lease in seconds
+            lease_factor:       lease time in units of the averaged processing time
+            duration_weight:    weight of the newest processing time in the average
+        """
+        self.min_lease_time = min_lease_time
+        self.lease_factor = lease_factor
+        self.duration_weight = duration_weight
+
+        # rank: {'time': last time the rank was heard from, 'leases': {eventrangeid: (pandaid, grant time)},
+        #        'deadline': time the leases are lost regardless of renewals, or None}
+        # orphaned leases are kept under the key ('orphaned', rank, time orphaned)
+        self.ranks = {}
+        # eventrangeid: key in self.ranks holding it
+        self.holders = {}
+
+        # averaged seconds from sending a range to receiving its output file, None until measured
+        self.duration = None
+
+        # eventrangeid: number of times its lease was lost
+        self.reassign_counts = {}
+        self.total_reassigned = 0
+
+    def lease_time(self):
+        if self.duration is None:
+            return self.min_lease_time
+        return max(self.min_lease_time, self.lease_factor * self.duration)
+
+    def grant(self, rank, pandaid, eventrangeids, now=None):
+        """ eventrangeids of panda id were sent to rank """
+        if now is None:
+            now = time.time()
+        holder = self.ranks.setdefault(rank, {'time': now, 'leases': {}, 'deadline': None})
+        holder['time'] = now
+        for eventrangeid in eventrangeids:
+            # a range can only be held by one rank
+            previous = self.holders.get(eventrangeid)
+            if previous is not None and previous != rank:
+                self.ranks[previous]['leases'].pop(eventrangeid, None)
+            holder['leases'][eventrangeid] = (str(pandaid), now)
+            self.holders[eventrangeid] = rank
+
+    def renew(self, rank, now=None):
+        """ rank is alive, restart the lease time of all its ranges """
+        if now is None:
+            now = time.time()
+        if rank in self.ranks:
+            self.ranks[rank]['time'] = now
+
+    def release(self, eventrangeid, now=None):
+        """ the output file of eventrangeid arrived, returns False if it was not leased """
+        if now is None:
+            now = time.time()
+        rank = self.holders.pop(eventrangeid, None)
+        if rank is None:
+            return False
+        pandaid, grant_time = self.ranks[rank]['leases'].pop(eventrangeid)
+        duration = now - grant_time
+        if self.duration is None:
+            self.duration = duration
+        else:
+            self.duration += self.duration_weight * (duration - self.duration)
+        return True
+
+    def orphan(self, rank, grace_time, now=None):
+        """ rank moved on to a new job, its leases are lost in grace_time seconds unless released """
+        if now is None:
+            now = time.time()
+        holder = self.ranks.pop(rank, None)
+        if holder is None or len(holder['leases']) == 0:
+            return
+        key = ('orphaned', rank, now)
+        holder['deadline'] = now + grace_time
+        self.ranks[key] = holder
+        for eventrangeid in holder['leases']:
+            self.holders[eventrangeid] = key
+        logger.debug('rank %s left %s leased event ranges, waiting %s seconds for their output files',
+                     rank, len(holder['leases']), grace_time)
+
+    def release_rank(self, rank):
+        """ rank will not process its ranges, returns them as a list of (pandaid, eventrangeid) """
+        holder = self.ranks.pop(rank, None)
+        if holder is None:
+            return []
+        lost = []
+        for eventrangeid, (pandaid, grant_time) in holder['leases'].items():
+            del self.holders[eventrangeid]
+            self.reassign_counts[eventrangeid] = self.reassign_counts.get(eventrangeid, 0) + 1
+            lost.append((pandaid, eventrangeid))
+        self.total_reassigned += len(lost)
+        if len(lost) > 0:
+            logger.info('rank %s lost its leases on %s event ranges, %s ranges reassigned in total',
+                        rank, len(lost), self.total_reassigned)
+        return lost
+
+    def expire(self, now=None):
+        """ release the ranges of the ranks not heard from within the lease time,
+            returns them as a list of (pandaid, eventrangeid) """
+        if now is None:
+            now = time.time()
+        lease_time = self.lease_time()
+        lost = []
+        for rank, holder in list(self.ranks.items()):
+            if len(holder['leases']) == 0:
+                if holder['deadline'] is not None:
+                    del self.ranks[rank]
+            elif holder['deadline'] is not None:
+                if now > holder['deadline']:
+                    lost += self.release_rank(rank)
+            elif now - holder['time'] > lease_time:
+                logger.warning('rank %s has not been heard from for %d seconds, longer than the lease time of %d seconds',
+                               rank, now - holder['time'], lease_time)
+                lost += self.release_rank(rank)
+        return lost
+
+    def number_leased(self, rank=None):
+        if rank is None:
+            return len(self.holders)
+        if rank in self.ranks:
+            return len(self.ranks[rank]['leases'])
+        return 0
@@ -19,9 +19,22 @@ class PandaJob:
 
         self.eventranges = EventRangeList.EventRangeList()
 
+        # droid ranks currently running this job
+        self.ranks = set()
+
     def number_ready(self):
         return self.eventranges.number_ready()
 
+    def priority(self):
+        try:
+            return int(self.job_def.get('currentPriority', 0))
+        except (TypeError, ValueError):
+            return 0
+
+    def exhausted(self):
+        """ True once Harvester has no more event ranges for this job and none are left to hand out """
+        return self.eventranges.no_more_event_ranges and self.number_ready() == 0
+
     def get_next(self, number_of_ranges=1):
         return self.eventranges.get_next(number_of_ranges)
 
@@ -7,11 +7,18 @@
 # - Taylor Childers (john.taylor.childers@cern.ch)
 # - Paul Nilsson (paul.nilsson@cern.ch)
 
+import heapq
 from pandayoda.yoda import PandaJob
 
 
 class PandaJobDict:
-    """ A list of PandaJob objects. """
+    """ A list of PandaJob objects.
+
+        The jobs are also kept in a heap ordered by priority and by ready event ranges
+        per assigned rank, so the job to give the next droid rank is found without
+        scanning every job. Entries are not removed when a job changes, update() pushes
+        a new entry and bumps the job's version, older entries are skipped when they
+        reach the top of the heap. Jobs that are exhausted are not in the heap. """
 
     def __init__(self, pandajobs=None):
         """ Create a new list. Can pass a dictionary object that will be
@@ -20,42 +27,76 @@ class PandaJobDict:
         # list of PandaJob objects, keyed by PandaID
         self.jobs = {}
 
+        # heap of (sort key, panda id, version) and the current version of each panda id
+        self.heap = []
+        self.versions = {}
+
+        # droid rank: panda id of the job it was given
+        self.rank_jobs = {}
+
         if pandajobs:
             self.append_from_dict(pandajobs)
 
     def append_from_dict(self, pandajobs):
         for _id in pandajobs.keys():
             self.jobs[str(_id)] = PandaJob.PandaJob(pandajobs[_id])
+            self.update(_id)
+
+    def sort_key(self, job):
+        # highest priority first, then the most ready event ranges per rank running the job
+        return -job.priority(), -float(job.number_ready()) / (len(job.ranks) + 1)
+
+    def update(self, pandaid):
+        """ must be called after the ready event ranges, ranks or state of a job change """
+        pandaid = str(pandaid)
+        version = self.versions.get(pandaid, 0) + 1
+        self.versions[pandaid] = version
+        job = self.jobs.get(pandaid)
+        if job is None or job.exhausted():
+            return
+        heapq.heappush(self.heap, (self.sort_key(job), pandaid, version))
+        # drop the stale entries once they dominate the heap
+        if len(self.heap) > 2 * len(self.jobs) + 64:
+            self.rebuild()
+
+    def rebuild(self):
+        self.heap = [(self.sort_key(job), pandaid, self.versions[pandaid])
+                     for pandaid, job in self.jobs.iteritems() if not job.exhausted()]
+        heapq.heapify(self.heap)
+
+    def assign_rank(self, rank, pandaid):
+        """ record that rank was sent the job, it no longer runs the job it had before """
+        pandaid = str(pandaid)
+        previous = self.rank_jobs.get(rank)
+        if previous is not None and previous != pandaid and previous in self.jobs:
+            self.jobs[previous].ranks.discard(rank)
+            self.update(previous)
+        self.rank_jobs[rank] = pandaid
+        self.jobs[pandaid].ranks.add(rank)
+        self.update(pandaid)
+
+    def release_rank(self, rank):
+        """ record that rank exited, it no longer counts against the job it ran """
+        pandaid = self.rank_jobs.pop(rank, None)
+        if pandaid is not None and pandaid in self.jobs:
+            self.jobs[pandaid].ranks.discard(rank)
+            self.update(pandaid)
 
     def get_job_with_most_ready_events(self):
-        # if there are no jobs, return None
-        if len(self.jobs) == 0:
-            return None
-        # if there is only one job, return it if it has ready events
-        elif len(self.jobs) == 1:
-            job = self.jobs[self.jobs.keys()[0]]
-            if job.events_ready() > 0:
-                return job
-            else:
-                return None
-        # if there are more than one job choose the one with the most events
-        else:
-            pandaid = self.jobid_with_most_ready_events()
-            if pandaid > 0:
+        """ return the job with the highest priority and the most ready events per rank,
+            or None if every job is exhausted """
+        while len(self.heap) > 0:
+            key, pandaid, version = self.heap[0]
+            if pandaid in self.jobs and self.versions.get(pandaid) == version:
                 return self.jobs[pandaid]
-            # otherwise, return None
-            else:
-                return None
+            heapq.heappop(self.heap)
+        return None
 
     def jobid_with_most_ready_events(self):
-        max_id = 0
-        max_ready = 0
-        for jobid, job in self.jobs.iteritems():
-            if job.events_ready() > max_ready:
-                max_ready = job.events_ready()
-                max_id = jobid
-
-        return max_id
+        job = self.get_job_with_most_ready_events()
+        if job is None:
+            return 0
+        return str(job['PandaID'])
 
     def get_eventranges(self, pandaid):
         pandaid = str(pandaid)
@@ -99,6 +140,7 @@ class PandaJobDict:
     def __setitem__(self, key, value):
         if isinstance(value, PandaJob.PandaJob):
             self.jobs[key] = value
+            self.update(key)
         else:
             raise TypeError('object is not of type PandaJob: %s' % type(value).__name__)
 
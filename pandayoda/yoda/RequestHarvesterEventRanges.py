@@ -10,41 +10,44 @@
 import logging
 import os
 import time
-from pandayoda.common import StatefulService, exceptions
-from pandayoda.common import yoda_multiprocessing as mp
+import Queue
+import threading
+from pandayoda.common import StatefulService, exceptions, MessageTypes
 logger = logging.getLogger(__name__)
 
 config_section = os.path.basename(__file__)[:os.path.basename(__file__).rfind('.')]
 
 
 class RequestHarvesterEventRanges(StatefulService.StatefulService):
-    ''' This thread is spawned to request event ranges from Harvester '''
+    """ This service runs for the lifetime of Yoda and requests event ranges from Harvester.
+        It takes REQUEST_EVENT_RANGES messages for any PandaID from its queue and passes them
+        on to Harvester straight away, so requests for several PandaIDs can be outstanding at
+        once. The event ranges Harvester returns are sent to the WorkManager queue as
+        NEW_EVENT_RANGES messages, NO_MORE_EVENT_RANGES when Harvester has none left or
+        EVENT_RANGES_TIMEOUT when it does not answer within eventrange_timeout. Ranges that
+        arrive after the timeout are sent as NEW_EVENT_RANGES marked 'late', they do not
+        answer a request made since.
+
+        request message: {'type': REQUEST_EVENT_RANGES, 'pandaID': ..., 'taskID': ..., 'jobsetID': ..., 'nRanges': ...}
+    """
 
     CREATED = 'CREATED'
-    REQUEST = 'REQUEST'
+    IDLE = 'IDLE'
     WAITING = 'WAITING'
-    RETRIEVE_EVENTS = 'RETRIEVE_EVENTS'
     EXITED = 'EXITED'
 
-    STATES = [CREATED, REQUEST, WAITING, RETRIEVE_EVENTS, EXITED]
-    RUNNING_STATES = [CREATED, REQUEST, WAITING, RETRIEVE_EVENTS]
+    STATES = [CREATED, IDLE, WAITING, EXITED]
+    RUNNING_STATES = [CREATED, IDLE, WAITING]
 
-    def __init__(self, config, job_def, mpmgr, harvester_messenger):
+    def __init__(self, config, queues, harvester_messenger):
         super(RequestHarvesterEventRanges, self).__init__()
 
         # local config options
         self.config = config
 
-        # these variables used to return new event ranges
-        self.mgr = mpmgr
-        self.new_eventranges = self.mgr.dict()
-        self.eventranges_avail = mp.Event()
-
-        # set if there are no more event ranges coming from Harvester
-        self.no_more_eventranges_flag = mp.Event()
-
-        # set this to define which job definition will be used to request event ranges
-        self.job_def = job_def
+        # dictionary of queues, requests arrive on queues['RequestHarvesterEventRanges']
+        # and event ranges are sent to queues['WorkManager']
+        self.queues = queues
 
         # messenger module for communicating with harvester
         self.harvester_messenger = harvester_messenger
@@ -53,6 +56,10 @@ class RequestHarvesterEventRanges(StatefulService.StatefulService):
 
         # to be set
         self.loglevel = None
+        self.eventrange_timeout = 0
+        self.outstanding = None
+        self.timed_out = None
+        self.file_read = None
 
     def exited(self):
         return self.in_state(self.EXITED)
@@ -62,27 +69,142 @@ class RequestHarvesterEventRanges(StatefulService.StatefulService):
             return True
         return False
 
-    def get_eventranges(self):
-        """ Parent thread calls this function to retrieve the event ranges sent by Harvester. """
-        return self.new_eventranges
+    def run(self):
+        """ Overriding base class function. """
 
-    def set_eventranges(self, eventranges):
-        for key in eventranges.keys():
-            self.new_eventranges[key] = eventranges[key]
-            self.eventranges_avail.set()
+        # get the messenger for communicating with Harvester
+        logger.debug('starting requestHarvesterEventRanges thread')
 
-    def eventranges_ready(self):
-        return self.eventranges_avail.is_set()
+        self.read_config()
 
-    def no_more_eventranges(self):
-        return self.no_more_eventranges_flag.is_set()
+        # outstanding requests key-ed by panda id: {'job_def': request, 'time': time of the first request}
+        self.outstanding = {}
+        # panda ids whose last request timed out before Harvester answered it
+        self.timed_out = set()
 
-    def run(self):  # noqa: C901
-        """ Overriding base class function. """
+        # the watcher waits for the main loop to read an eventRangesFile before looking for the next one
+        self.file_read = threading.Event()
+        self.file_read.set()
+        watcher = threading.Thread(target=self.watch_eventranges_file, name='RequestHarvesterEventRangesWatcher')
+        watcher.daemon = True
+        watcher.start()
 
-        # get the messenger for communicating with Harvester
-        logger.debug('starting requestHarvesterEventRanges thread')
+        self.set_state(self.IDLE)
 
+        while not self.exit.is_set():
+            logger.debug('start loop, outstanding requests for panda ids: %s', self.outstanding.keys())
+
+            try:
+                qmsg = self.queues['RequestHarvesterEventRanges'].get(block=True, timeout=self.loop_timeout)
+            except Queue.Empty:
+                qmsg = None
+
+            if qmsg is None:
+                pass
+            elif qmsg['type'] == MessageTypes.REQUEST_EVENT_RANGES:
+                self.request_eventranges(qmsg)
+            elif qmsg['type'] == MessageTypes.WAKE_UP:
+                self.retrieve_eventranges()
+            else:
+                logger.error('message type was not recognized: %s', qmsg['type'])
+
+            self.expire_requests()
+
+            if len(self.outstanding) > 0:
+                self.set_state(self.WAITING)
+            else:
+                self.set_state(self.IDLE)
+
+        self.file_read.set()
+        self.set_state(self.EXITED)
+        logger.debug('thread is exiting')
+
+    def request_eventranges(self, qmsg):
+        """ pass a request on to Harvester, requests for a panda id already outstanding are merged by the messenger """
+        job_def = {'pandaID': qmsg['pandaID'],
+                   'taskID': qmsg['taskID'],
+                   'jobsetID': qmsg['jobsetID'],
+                   'nRanges': qmsg['nRanges'],
+                   }
+        pandaid = str(job_def['pandaID'])
+        logger.info('making request for %s event ranges for panda id %s', job_def['nRanges'], pandaid)
+        try:
+            # use messenger to request event ranges from Harvester
+            self.harvester_messenger.request_eventranges(job_def)
+        except exceptions.MessengerEventRangesAlreadyRequested:
+            logger.warning('event ranges already requesting')
+
+        if pandaid not in self.outstanding:
+            self.outstanding[pandaid] = {'job_def': job_def, 'time': time.time()}
+
+    def retrieve_eventranges(self):
+        """ read the eventRangesFile and send its ranges to the WorkManager """
+        logger.info('reading event ranges')
+        try:
+            # use messenger to get event ranges from Harvester
+            eventranges = self.harvester_messenger.get_eventranges()
+        except exceptions.MessengerFailedToParse as e:
+            logger.error('failed to parse an event file: %s, repeating the outstanding requests', str(e))
+            for pandaid, request in self.outstanding.items():
+                self.harvester_messenger.request_eventranges(request['job_def'])
+            eventranges = {}
+        finally:
+            self.file_read.set()
+
+        for pandaid, ranges in eventranges.items():
+            pandaid = str(pandaid)
+            late = pandaid in self.timed_out
+            self.timed_out.discard(pandaid)
+            if late and len(ranges) > 0:
+                # the answer to the request that timed out, a request made since stays outstanding
+                logger.info('received %s event ranges for panda id %s after its request timed out', len(ranges), pandaid)
+                self.queues['WorkManager'].put({'type': MessageTypes.NEW_EVENT_RANGES, 'PandaID': pandaid,
+                                                'eventranges': ranges, 'late': True})
+                continue
+
+            request = self.outstanding.pop(pandaid, None)
+            if request is not None:
+                logger.info('received %s event ranges for panda id %s after %.1f seconds', len(ranges), pandaid, time.time() - request['time'])
+            else:
+                logger.warning('received %s event ranges for panda id %s which were not requested', len(ranges), pandaid)
+
+            # if Harvester provided no event ranges for this panda ID, then there are no more
+            if len(ranges) == 0:
+                logger.info('received empty list, no more event ranges for panda id %s', pandaid)
+                self.queues['WorkManager'].put({'type': MessageTypes.NO_MORE_EVENT_RANGES, 'PandaID': pandaid})
+            else:
+                self.queues['WorkManager'].put({'type': MessageTypes.NEW_EVENT_RANGES, 'PandaID': pandaid, 'eventranges': ranges})
+
+    def expire_requests(self):
+        """ give up on requests Harvester has not answered, the WorkManager decides whether to ask again """
+        now = time.time()
+        # wait at least one loop, as before when eventrange_timeout was only checked after blocking for loop_timeout
+        timeout = max(self.eventrange_timeout, self.loop_timeout)
+        for pandaid, request in self.outstanding.items():
+            time_waiting = now - request['time']
+            if time_waiting > timeout:
+                logger.info('have been waiting for eventranges for panda id %s for %d seconds, limited to %d',
+                            pandaid, time_waiting, timeout)
+                del self.outstanding[pandaid]
+                self.timed_out.add(pandaid)
+                self.queues['WorkManager'].put({'type': MessageTypes.EVENT_RANGES_TIMEOUT, 'PandaID': pandaid})
+
+    def watch_eventranges_file(self):
+        """ runs in a thread, posts a WAKE_UP message to the service queue when an eventRangesFile appears """
+        while not self.exit.is_set():
+            try:
+                self.file_read.wait(self.loop_timeout)
+                if not self.file_read.is_set():
+                    continue
+                if self.harvester_messenger.eventranges_ready(block=True, timeout=self.loop_timeout):
+                    logger.debug('eventRangesFile found, waking up the service')
+                    self.file_read.clear()
+                    self.queues['RequestHarvesterEventRanges'].put({'type': MessageTypes.WAKE_UP})
+            except Exception:
+                logger.exception('failed to watch for the eventRangesFile')
+                self.exit.wait(self.loop_timeout)
+
+    def read_config(self):
         if config_section in self.config:
             # read log level:
             if 'loglevel' in self.config[config_section]:
@@ -109,85 +231,3 @@ class RequestHarvesterEventRanges(StatefulService.StatefulService):
 
         else:
             raise Exception('no %s section in the configuration' % config_section)
-
-        # start in the request state
-        self.set_state(self.REQUEST)
-
-        while not self.exit.is_set():
-            # get state
-            logger.debug('start loop, current state: %s', self.get_state())
-
-            ########
-            # REQUEST State
-            ########################
-            if self.get_state() == self.REQUEST:
-                logger.info('making request for event ranges')
-
-                # first check if events already on disk
-                if self.harvester_messenger.eventranges_ready():
-                    logger.debug('event ranges already ready, skipping request')
-                    self.set_state(self.RETRIEVE_EVENTS)
-
-                else:
-                    # request event ranges from Harvester
-                    try:
-                        # use messenger to request event ranges from Harvester
-                        self.harvester_messenger.request_eventranges(self.job_def)
-                        request_time = time.time()
-                    except exceptions.MessengerEventRangesAlreadyRequested:
-                        logger.warning('event ranges already requesting')
-
-                    # request events
-                    self.set_state(self.WAITING)
-
-            #########
-            # WAITING State
-            ########################
-            if self.get_state() == self.WAITING:
-                logger.info('checking for event ranges, will block for %s', self.loop_timeout)
-                # use messenger to check if event ranges are ready
-                if self.harvester_messenger.eventranges_ready(block=True, timeout=self.loop_timeout):
-                    self.set_state(self.RETRIEVE_EVENTS)
-                else:
-                    logger.debug('no event ranges yet received.')
-                    time_waiting = time.time() - request_time
-                    if time_waiting > self.eventrange_timeout:
-                        logger.info('have been waiting for eventranges for %d seconds, limited to %d, triggering exit', time_waiting, self.eventrange_timeout)
-                        self.no_more_eventranges_flag.set()
-                        self.stop()
-                        continue
-
-            #########
-            #  RETRIEVE_EVENTS State
-            ########################
-            if self.get_state() == self.RETRIEVE_EVENTS:
-                logger.info('reading event ranges')
-                # use messenger to get event ranges from Harvester
-                try:
-                    eventranges = self.harvester_messenger.get_eventranges()
-
-                    # set event ranges for parent and change state
-                    if len(eventranges) > 0:
-                        if logger.getEffectiveLevel() == logging.DEBUG:
-                            tmpstr = ''
-                            for jobid in eventranges.keys():
-                                tmpstr += ' %s:%s' % (jobid, len(eventranges[jobid]))
-                            logger.debug('received new eventranges for PandaID:N-ranges: %s', tmpstr)
-
-                        self.set_eventranges(eventranges)
-
-                        # if Harvester provided no event ranges for this panda ID, then set the no more events flag
-                        if len(eventranges[str(self.job_def['pandaID'])]) == 0:
-                            logger.info('received empty file, no new event ranges received')
-                            self.no_more_eventranges_flag.set()
-
-                        self.stop()
-                    else:
-                        logger.debug('received no eventranges: %s', eventranges)
-                        self.stop()
-                except exceptions.MessengerFailedToParse as e:
-                    logger.error('failed to parse an event file: %s', str(e))
-                    self.stop()
-
-        self.set_state(self.EXITED)
-        logger.debug('thread is exiting')
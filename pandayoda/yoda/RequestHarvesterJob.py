@@ -87,6 +87,14 @@ class RequestHarvesterJob(StatefulService.StatefulService):
                 logger.warning('no "loop_timeout" in "%s" section of config file, keeping default %s', config_section,
                                self.loop_timeout)
 
+            # read job_timeout:
+            if 'job_timeout' in self.config[config_section]:
+                self.job_timeout = int(self.config[config_section]['job_timeout'])
+                logger.info('%s job_timeout: %s', config_section, self.job_timeout)
+            else:
+                self.job_timeout = 0
+                logger.warning('no "job_timeout" in "%s" section of config file, waiting for jobs without limit', config_section)
+
         else:
             raise Exception('no %s section in the configuration' % config_section)
 
@@ -112,6 +120,7 @@ class RequestHarvesterJob(StatefulService.StatefulService):
                         logger.warning('job already requested.')
 
                     # wait for events
+                    request_time = time.time()
                     self.set_state(self.WAITING)
                 else:
                     # since panda job is already ready, retrieve job
@@ -122,14 +131,17 @@ class RequestHarvesterJob(StatefulService.StatefulService):
             ########################
             elif self.get_state() == self.WAITING:
                 logger.debug('checking if request is complete')
-                # use messenger to check if jobs are ready
-                if self.harvester_messenger.pandajobs_ready():
+                # use messenger to check if jobs are ready, returns as soon as the jobSpecFile appears
+                if self.harvester_messenger.pandajobs_ready(block=True, timeout=self.loop_timeout):
                     logger.debug('jobs are ready')
                     # since panda job is already ready, retrieve job
                     self.set_state(self.GETTING_JOB)
+                elif self.job_timeout > 0 and time.time() - request_time > self.job_timeout:
+                    logger.info('no jobs from Harvester after %d seconds, assuming there are no more', time.time() - request_time)
+                    self.no_more_jobs_flag.set()
+                    self.stop()
                 else:
-                    logger.info('no response yet, sleep for %s', self.loop_timeout)
-                    time.sleep(self.loop_timeout)
+                    logger.info('no response yet after %s seconds', self.loop_timeout)
 
             #########
             # GETTING_JOB State
@@ -144,12 +156,11 @@ class RequestHarvesterJob(StatefulService.StatefulService):
                 if len(pandajobs) > 0:
                     logger.debug('setting NEW_JOBS variable')
                     self.set_jobs(pandajobs)
-                    logger.debug('sending WorkManager WAKE_UP message')
-                    self.queues['WorkManager'].put({'type': MessageTypes.WAKE_UP})
                     logger.debug('triggering exit')
                     self.stop()
                 else:
-                    logger.debug('no jobs returned: %s', pandajobs)
+                    logger.info('Harvester returned no jobs, there are no more')
+                    self.no_more_jobs_flag.set()
                     self.stop()
 
             else:
@@ -157,4 +168,7 @@ class RequestHarvesterJob(StatefulService.StatefulService):
                 self.exit.wait(timeout=self.loop_timeout)
 
         self.set_state(self.EXITED)
+        # the WorkManager only collects the jobs once this request has exited
+        logger.debug('sending WorkManager WAKE_UP message')
+        self.queues['WorkManager'].put({'type': MessageTypes.WAKE_UP})
         logger.debug('RequestHarvesterJob thread is exiting')
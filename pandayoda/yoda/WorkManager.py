@@ -8,18 +8,29 @@
 # - Paul Nilsson (paul.nilsson@cern.ch)
 
 import os
+import time
 import logging
 import Queue
+from collections import OrderedDict
 from pandayoda.common.yoda_multiprocessing import Process, Event, Manager
 import RequestHarvesterJob
 import RequestHarvesterEventRanges
 import PandaJobDict
+import EventRangePrefetcher
+import BatchSizer
+import LeaseTable
+import Checkpoint
 from pandayoda.common import MessageTypes, EventRangeList
 logger = logging.getLogger(__name__)
 
 config_section = os.path.basename(__file__)[:os.path.basename(__file__).rfind('.')]
 
 
+def _boolean(value):
+    """ convert a true/false configuration option """
+    return 'true' in value.lower()
+
+
 class WorkManager(Process):
     """ Work Manager: this thread manages work going to the running Droids """
 
@@ -46,14 +57,34 @@ class WorkManager(Process):
         self.exit = Event()
 
         # to be set
-        self.pending_index = None
-        self.pending_requests = None
+        self.pending_job_requests = None
+        self.pending_eventrange_requests = None
+        self.requestharvesterjob = None
+        self.requestharvestereventranges = None
+        self.eventranges_requested = None
+        self.no_more_jobs = False
+        self.prefetcher = None
+        self.batchsizer = None
+        self.leases = None
+        self.checkpoint = None
+        self.mpmgr = None
+        self.prefetch_safety_factor = 2.
+        self.active_rank_timeout = 600.
+        self.batch_target_time = 600.
+        self.min_send_n_eventranges = 1
+        self.max_send_n_eventranges = None
+        self.min_lease_time = 600.
+        self.lease_factor = 3.
+        self.lease_grace_time = 120.
+        self.use_checkpoint = True
+        self.checkpoint_interval = 300.
+        self.resume = False
 
     def stop(self):
         """ This function can be called by outside subthreads to cause the JobManager thread to exit """
         self.exit.set()
 
-    def run(self):  # noqa: C901
+    def run(self):
         """ This function is executed as the subthread. """
 
         # read inputs from config file
@@ -62,330 +93,369 @@ class WorkManager(Process):
         # list of all jobs received from Harvester key-ed by panda id
         pandajobs = PandaJobDict.PandaJobDict()
 
-        # pending requests from droid ranks
-        self.pending_requests = []
-        # helps track which request I am processing
-        self.pending_index = 0
-
-        # place holder for Request Harevester Event Ranges instance (wait for job definition before launching)
-        requestharvestereventranges = None
+        # pending job requests from droid ranks key-ed by source rank, in the order received
+        self.pending_job_requests = OrderedDict()
+        # pending event range requests grouped by panda id, each key-ed by source rank
+        self.pending_eventrange_requests = {}
+
+        # panda ids with a request for event ranges outstanding at Harvester
+        self.eventranges_requested = set()
+
+        # decides when and how many event ranges to request so the pool does not run dry
+        self.prefetcher = EventRangePrefetcher.EventRangePrefetcher(self.send_n_eventranges,
+                                                                    self.request_n_eventranges,
+                                                                    self.prefetch_safety_factor,
+                                                                    self.active_rank_timeout)
+
+        # sizes the batch of event ranges sent to each rank from its completion rate
+        self.batchsizer = BatchSizer.BatchSizer(self.send_n_eventranges,
+                                                self.batch_target_time,
+                                                self.min_send_n_eventranges,
+                                                self.max_send_n_eventranges)
+
+        # which rank holds which assigned event ranges, so ranges of lost ranks can be handed out again
+        self.leases = LeaseTable.LeaseTable(self.min_lease_time, self.lease_factor)
+
+        # keep the jobs and event ranges on disk so a later allocation can resume the work
+        if self.use_checkpoint:
+            self.checkpoint = Checkpoint.Checkpoint(os.path.join(os.getcwd(), 'yoda_checkpoint_' + config_section))
+            if self.resume:
+                self.restore_checkpoint(pandajobs)
+            self.checkpoint.compact(self.checkpoint_state(pandajobs))
+        last_compaction = time.time()
 
         # create a local multiprocessing manager for shared values
-        mpmgr = Manager()
+        self.mpmgr = Manager()
 
-        # start a Request Havester Job thread to begin getting a job
-        requestharvesterjob = RequestHarvesterJob.RequestHarvesterJob(self.config, self.queues, mpmgr, self.harvester_messenger)
-        requestharvesterjob.start()
+        # start a Request Havester Job thread to begin getting a job, unless jobs were resumed
+        if len(pandajobs) == 0:
+            self.requestharvesterjob = RequestHarvesterJob.RequestHarvesterJob(self.config, self.queues, self.mpmgr, self.harvester_messenger)
+            self.requestharvesterjob.start()
 
+        # start the Request Harvester Event Ranges service, it runs until WorkManager exits
+        self.requestharvestereventranges = RequestHarvesterEventRanges.RequestHarvesterEventRanges(self.config, self.queues, self.harvester_messenger)
+        self.requestharvestereventranges.start()
+
+        # only block on the queue when the last pass over the pending requests did not change anything
+        block = True
         while not self.exit.is_set():
             logger.debug('start loop')
             ################
-            # check for queue messages
+            # take all messages from the queue
             ################################
-            qmsg = None
-            if not self.queues['WorkManager'].empty():
-                logger.info('queue has messages')
-                qmsg = self.queues['WorkManager'].get(block=False)
-                # any time I get a message from this queue, I reset the index of the pending request list
-                # this way, I cycle through the pending requests once per new message
-                self.pending_index = 0
-            # if main queue is empty, process pending message queues
-            elif len(self.pending_requests) > 0:
-                if self.pending_index < len(self.pending_requests):
-                    logger.debug('pending queue has %s messages processing %s', len(self.pending_requests), self.pending_index)
-                    qmsg = self.pending_requests[self.pending_index]
-                else:
-                    logger.info('have cycled through all pending requests without a change, will block on queue for %s', self.loop_timeout)
-                    try:
-                        self.pending_index = 0
-                        qmsg = self.queues['WorkManager'].get(block=True, timeout=self.loop_timeout)
-                    except Queue.Empty:
-                        logger.debug('no messages on queue after blocking')
-            else:
-                # if not (
-                #  (requestharvesterjob is not None and requestharvesterjob.jobs_ready()) and
-                #  (requestharvestereventranges is not None and requestharvestereventranges.eventranges_ready())
-                #      ):
-                try:
-                    self.pending_index = 0
-                    logger.info('blocking on queue for %s', self.loop_timeout)
-                    qmsg = self.queues['WorkManager'].get(block=True, timeout=self.loop_timeout)
-                except Queue.Empty:
-                    logger.debug('no messages on queue after blocking')
-
-            if qmsg:
+            for qmsg in self.get_queue_messages(block):
                 logger.debug('received message %s', qmsg)
+                self.handle_queue_message(pandajobs, qmsg)
 
-                #############
-                ## Just a message to cause WorkManager to wake from sleep and process
-                ###############################
-                if qmsg['type'] == MessageTypes.WAKE_UP:
-                    continue
-
-                #############
-                ## DROID requesting new job
-                ###############################
-                elif qmsg['type'] == MessageTypes.REQUEST_JOB:
-                    logger.debug('droid requesting job description')
-
-                    # Do I have a panda job to give out?
-                    # if not, create a new request if no request is active
-                    if len(pandajobs) == 0:
-                        # if there are no panda jobs and requestHarvesterJob is None, then start a request
-                        # this really should never happen.
-                        logger.debug('There are no panda jobs')
-                        if requestharvesterjob is None:
-                            logger.info('launching new job request')
-                            requestharvesterjob = RequestHarvesterJob.RequestHarvesterJob(self.config, self.queues, mpmgr, self.harvester_messenger)
-                            requestharvesterjob.start()
-                        else:
-                            if requestharvesterjob.running():
-                                logger.debug('request is running, adding message to pending and will process again later')
-                            elif requestharvesterjob.exited():
-                                logger.debug('request has exited')
-                                jobs = requestharvesterjob.get_jobs()
-                                if jobs is None:
-                                    logger.error('request has exited and returned no events, reseting request object')
-                                    if requestharvesterjob.is_alive():
-                                        requestharvesterjob.stop()
-                                        logger.info('waiting for requestHarvesterJob to join')
-                                        requestharvesterjob.join()
-                                    requestharvesterjob = None
-                                else:
-                                    logger.info('new jobs ready, adding to PandaJobDict, then add to pending requests')
-                                    pandajobs.append_from_dict(jobs)
-                                    # add to pending requests because the job to send will be chose by another
-                                    # section of code below which sends the job based on the event ranges on hand
-
-                                    # reset job request
-                                    requestharvesterjob = None
-                                    # backup pending counter
-                                    self.pending_index += -1
-
-                            else:
-                                if requestharvesterjob.state_lifetime() > 60:
-                                    logger.error('request is stuck in state %s recreating it.', requestharvesterjob.get_state())
-                                    if requestharvesterjob.is_alive():
-                                        requestharvesterjob.stop()
-                                        logger.info('waiting for requestHarvesterJob to join')
-                                        requestharvesterjob.join()
-                                        requestharvesterjob = None
-                                else:
-                                    logger.debug('request is in %s state, waiting', requestharvesterjob.get_state())
-
-                        logger.debug('pending message')
-                        # place request on pending_requests queue and reprocess again when job is ready
-                        self.pend_request(qmsg)
-
-                    # There are jobs in the list so choose one to send
-                    # The choice depends on numbers of events available for each job
-                    elif len(pandajobs) == 1:
-                        logger.debug('There is one job so send it.')
-
-                        # get the job
-                        # FUTUREDEV: It's unclear if we will ever run more than one PandaID per Yoda job
-                        # so in the future this may need to actually search the pandajobs list for the
-                        # one with the most jobs to send or something like that.
-                        pandaid = pandajobs.keys()[0]
-                        job = pandajobs[pandaid]
-
-                        # send it to droid rank
-                        logger.info('sending droid rank %s panda id %s which has the most ready events %s',
-                                    qmsg['source_rank'], pandaid, job.number_ready())
-                        outmsg = {
-                            'type': MessageTypes.NEW_JOB,
-                            'job': job.job_def,
-                            'destination_rank': qmsg['source_rank']
-                        }
-                        self.queues['MPIService'].put(outmsg)
-
-                        if qmsg in self.pending_requests:
-                            self.pending_requests.remove(qmsg)
-                        qmsg = None
-
-                    # There are jobs in the list so choose one to send
-                    # The choice depends on numbers of events available for each job
-                    elif len(pandajobs) > 1:
-                        logger.error('there are multiple jobs to choose from, this is not yet implemented')
-                        raise Exception('there are multiple jobs to choose from, this is not yet implemented')
-
-                #############
-                ## DROID requesting new event ranges
-                ###############################
-                elif qmsg['type'] == MessageTypes.REQUEST_EVENT_RANGES:
-                    logger.debug('droid requesting event ranges')
-
-                    # the droid sent the current running panda id, determine if there are events left for this panda job
-                    droid_pandaid = str(qmsg['PandaID'])
-
-                    # if there are no event ranges left reply with such
-                    if pandajobs[droid_pandaid].eventranges.no_more_event_ranges:
-                        logger.debug('no event ranges left for panda ID %s', droid_pandaid)
-                        logger.info('sending NO_MORE_EVENT_RANGES to rank %s', qmsg['source_rank'])
-                        self.queues['MPIService'].put(
-                            {'type': MessageTypes.NO_MORE_EVENT_RANGES,
-                             'destination_rank': qmsg['source_rank'],
-                             'PandaID': droid_pandaid,
-                             })
-
-                        # remove message if from pending
-                        if qmsg in self.pending_requests:
-                            self.pending_requests.remove(qmsg)
-                        qmsg = None
-
-                    # may still be event ranges for this ID
-                    else:
-                        logger.debug('retrieving event ranges for panda ID %s', droid_pandaid)
-
-                        # event ranges found for pandaID
-                        if str(droid_pandaid) in pandajobs.keys():
-                            logger.debug('EventRangeList object for pandaID %s exists, events ready %s', droid_pandaid, pandajobs[droid_pandaid].number_ready())
-
-                            # have event ranges ready
-                            if pandajobs[droid_pandaid].number_ready() > 0:
-                                self.send_eventranges(pandajobs[droid_pandaid].eventranges, qmsg)
-
-                                # remove message if from pending
-                                if qmsg in self.pending_requests:
-                                    self.pending_requests.remove(qmsg)
-                                qmsg = None
-
-                            # no event ranges remaining, will request more
-                            else:
-                                logger.debug('no eventranges remain for pandaID %s, can we request more?', droid_pandaid)
-
-                                # check if the no more event ranges flag has been set for this panda id
-                                if pandajobs[droid_pandaid].eventranges.no_more_event_ranges:
-                                    # set the flag so we know there are no more events for this PandaID
-                                    logger.debug('no more event ranges for PandaID: %s', droid_pandaid)
-                                    logger.debug('sending NO_MORE_EVENT_RANGES to rank %s', qmsg['source_rank'])
-                                    self.queues['MPIService'].put(
-                                        {'type': MessageTypes.NO_MORE_EVENT_RANGES,
-                                         'destination_rank': qmsg['source_rank'],
-                                         'PandaID': droid_pandaid,
-                                         })
-
-                                    # remove message if from pending
-                                    if qmsg in self.pending_requests:
-                                        self.pending_requests.remove(qmsg)
-                                    qmsg = None
-
-                                # flag is not set, so if no request is running create one
-                                elif requestharvestereventranges is None:
-                                    logger.debug('requestHarvesterEventRanges does not exist, creating new request')
-                                    requestharvestereventranges = RequestHarvesterEventRanges.RequestHarvesterEventRanges(
-                                        self.config,
-                                        {
-                                            'pandaID': pandajobs[droid_pandaid]['PandaID'],
-                                            'jobsetID': pandajobs[droid_pandaid]['jobsetID'],
-                                            'taskID': pandajobs[droid_pandaid]['taskID'],
-                                            'nRanges': self.request_n_eventranges,
-                                        },
-                                        mpmgr,
-                                        self.harvester_messenger,
-                                    )
-                                    requestharvestereventranges.start()
-
-                                    # pend the request for later processing
-                                    self.pend_request(qmsg)
-                                # there is a request, if it is running, pend the message for later processing
-                                elif requestharvestereventranges.running():
-                                    logger.debug('requestHarvesterEventRanges is running, will pend this request and check again')
-                                    self.pend_request(qmsg)
-                                # there is a request, if it is has exited, check if there are events available
-                                elif requestharvestereventranges.exited():
-                                    logger.debug('requestHarvesterEventRanges exited, will check for new event ranges')
-
-                                    requestharvestereventranges.join()
-
-                                    # if no more events flag is set, there are no more events for this PandaID
-                                    if requestharvestereventranges.no_more_eventranges():
-                                        # set the flag so we know there are no more events for this PandaID
-                                        logger.debug('no more event ranges for PandaID: %s', droid_pandaid)
-                                        pandajobs[droid_pandaid].eventranges.no_more_event_ranges = True
-                                        logger.debug('sending NO_MORE_EVENT_RANGES to rank %s', qmsg['source_rank'])
-                                        self.queues['MPIService'].put(
-                                            {'type': MessageTypes.NO_MORE_EVENT_RANGES,
-                                             'destination_rank': qmsg['source_rank'],
-                                             'PandaID': droid_pandaid,
-                                             })
-
-                                        # remove message if from pending
-                                        if qmsg in self.pending_requests:
-                                            self.pending_requests.remove(qmsg)
-                                        qmsg = None
-
-                                    # event ranges received so add them to the list
-                                    else:
-                                        tmpeventranges = requestharvestereventranges.get_eventranges()
-
-                                        if tmpeventranges is not None:
-                                            logger.debug('received eventranges: %s',
-                                                         ' '.join(('%s:%i' % (tmpid, len(tmpeventranges[tmpid])))
-                                                                  for tmpid in tmpeventranges.keys()))
-                                            # add event ranges to pandajobs dict
-                                            for jobid in tmpeventranges.keys():
-                                                ers = tmpeventranges[jobid]
-                                                pandajobs[jobid].eventranges += EventRangeList.EventRangeList(ers)
-                                                # events will be sent in the next loop execution
-
-                                            self.send_eventranges(pandajobs[jobid].eventranges, qmsg)
-
-                                            # remove message if from pending
-                                            if qmsg in self.pending_requests:
-                                                self.pending_requests.remove(qmsg)
-                                            qmsg = None
-                                        else:
-                                            logger.error('no eventranges after requestHarvesterEventRanges exited, starting new request')
-                                            self.pend_request(qmsg)
-
-                                    # reset request
-                                    requestharvestereventranges = None
-
-                                else:
-                                    logger.error('requestHarvesterEventRanges is in strange state %s, restarting', requestharvestereventranges.get_state())
-                                    requestharvestereventranges = None
-                                    self.pend_request(qmsg)
-
-                        # something went wrong
-                        else:
-                            logger.error('there is no eventrange for pandaID %s, this should be impossible since every pandaID in the '
-                                         'pandajobs dictionary gets an empty EventRangeList object. '
-                                         'Something is amiss. panda job ids: %s', droid_pandaid, pandajobs.keys())
-
-                else:
-                    logger.error('message type was not recognized: %s', qmsg['type'])
-
-            # if there is nothing to be done, sleep
-
-            # if (requestharvesterjob is not None and requestharvesterjob.running()) and \
-            #   (requestharvestereventranges is not None and requestharvestereventranges.running()) and \
-            #   self.queues['WorkManager'].empty() and self.pending_requests.empty():
-            #   time.sleep(self.loop_timeout)
-            # else:
-            logger.debug('continuing loop')
-            if requestharvesterjob is not None:
-                logger.debug('RequestHarvesterJob: %s', requestharvesterjob.get_state())
-            if requestharvestereventranges is not None:
-                logger.debug('requestHarvesterEventRanges: %s', requestharvestereventranges.get_state())
+            # return the ranges of ranks that stopped reporting to the pool
+            self.handle_expired_leases(pandajobs)
+
+            ################
+            # answer the pending requests
+            ################################
+            progress = self.process_job_requests(pandajobs)
+            progress = self.process_eventrange_requests(pandajobs) or progress
+            self.prefetch_eventranges(pandajobs)
+            block = not progress
+
+            # replace the checkpoint log with a new snapshot
+            if self.checkpoint is not None and time.time() - last_compaction > self.checkpoint_interval:
+                logger.info('writing checkpoint snapshot')
+                self.checkpoint.compact(self.checkpoint_state(pandajobs))
+                last_compaction = time.time()
+
+            logger.debug('continuing loop, pending job requests: %s, pending event range requests: %s',
+                         len(self.pending_job_requests),
+                         sum(len(requests) for requests in self.pending_eventrange_requests.values()))
+            if self.requestharvesterjob is not None:
+                logger.debug('RequestHarvesterJob: %s', self.requestharvesterjob.get_state())
+            if self.requestharvestereventranges is not None:
+                logger.debug('requestHarvesterEventRanges: %s', self.requestharvestereventranges.get_state())
 
         logger.info('signaling exit to threads')
-        if requestharvesterjob is not None and requestharvesterjob.is_alive():
+        if self.requestharvesterjob is not None and self.requestharvesterjob.is_alive():
             logger.debug('signaling requestHarvesterJob to stop')
-            requestharvesterjob.stop()
-        if requestharvestereventranges is not None and requestharvestereventranges.is_alive():
+            self.requestharvesterjob.stop()
+        if self.requestharvestereventranges is not None and self.requestharvestereventranges.is_alive():
             logger.debug('signaling requestHarvesterEventRanges to stop')
-            requestharvestereventranges.stop()
+            self.requestharvestereventranges.stop()
 
-        if requestharvesterjob is not None and requestharvesterjob.is_alive():
+        if self.requestharvesterjob is not None and self.requestharvesterjob.is_alive():
             logger.debug('waiting for requestHarvesterJob to join')
-            requestharvesterjob.join()
-        if requestharvestereventranges is not None and requestharvestereventranges.is_alive():
+            self.requestharvesterjob.join()
+        if self.requestharvestereventranges is not None and self.requestharvestereventranges.is_alive():
             logger.debug('waiting for requestHarvesterEventRanges to join')
-            requestharvestereventranges.join()
+            self.requestharvestereventranges.join()
 
+        if self.leases is not None:
+            logger.info('%s event ranges were reassigned after their rank lost them', self.leases.total_reassigned)
+        if self.checkpoint is not None:
+            self.checkpoint.compact(self.checkpoint_state(pandajobs))
+            self.checkpoint.close()
         logger.info('WorkManager is exiting')
 
+    def handle_queue_message(self, pandajobs, qmsg):
+        """ dispatch one message from the WorkManager queue """
+        if qmsg['type'] == MessageTypes.WAKE_UP:
+            # just a message to cause WorkManager to wake from sleep and process
+            pass
+        elif qmsg['type'] == MessageTypes.REQUEST_JOB:
+            self.handle_job_request(qmsg)
+        elif qmsg['type'] == MessageTypes.REQUEST_EVENT_RANGES:
+            self.handle_eventrange_request(qmsg)
+        elif qmsg['type'] == MessageTypes.NEW_EVENT_RANGES:
+            self.handle_new_eventranges(pandajobs, qmsg)
+        elif qmsg['type'] == MessageTypes.NO_MORE_EVENT_RANGES:
+            self.handle_no_more_eventranges(pandajobs, qmsg)
+        elif qmsg['type'] == MessageTypes.EVENT_RANGES_TIMEOUT:
+            self.handle_eventranges_timeout(pandajobs, str(qmsg['PandaID']))
+        elif qmsg['type'] == MessageTypes.OUTPUT_FILE:
+            self.mark_eventranges_completed(pandajobs, qmsg)
+        elif qmsg['type'] == MessageTypes.DROID_HAS_EXITED:
+            self.handle_droid_exited(pandajobs, qmsg)
+        else:
+            logger.error('message type was not recognized: %s', qmsg['type'])
+
+    def handle_job_request(self, qmsg):
+        """ a droid rank requests a new job """
+        logger.debug('droid rank %s requesting job description', qmsg['source_rank'])
+        self.pending_job_requests[qmsg['source_rank']] = qmsg
+        # the rank is done with its previous job, what it did not finish goes back to
+        # the pool once its last output files had time to arrive
+        self.leases.orphan(qmsg['source_rank'], self.lease_grace_time)
+
+    def handle_eventrange_request(self, qmsg):
+        """ a droid rank requests new event ranges """
+        logger.debug('droid rank %s requesting event ranges', qmsg['source_rank'])
+        droid_pandaid = str(qmsg['PandaID'])
+        if droid_pandaid not in self.pending_eventrange_requests:
+            self.pending_eventrange_requests[droid_pandaid] = OrderedDict()
+        self.pending_eventrange_requests[droid_pandaid][qmsg['source_rank']] = qmsg
+        self.prefetcher.rank_active(droid_pandaid, qmsg['source_rank'])
+        self.leases.renew(qmsg['source_rank'])
+
+    def handle_new_eventranges(self, pandajobs, qmsg):
+        """ Harvester sent new event ranges, late ones answer a request that already timed out
+            and leave the request made since outstanding """
+        pandaid = str(qmsg['PandaID'])
+        if not qmsg.get('late', False):
+            self.eventranges_requested.discard(pandaid)
+            self.prefetcher.received(pandaid)
+        if pandaid in pandajobs:
+            logger.debug('received %s eventranges for panda id %s', len(qmsg['eventranges']), pandaid)
+            pandajobs[pandaid].eventranges.extend(qmsg['eventranges'])
+            pandajobs.update(pandaid)
+            self.log_checkpoint({'op': 'eventranges', 'PandaID': pandaid, 'eventranges': qmsg['eventranges'].dump()})
+        else:
+            logger.error('received eventranges for unknown panda id %s, panda job ids: %s', pandaid, pandajobs.keys())
+
+    def handle_no_more_eventranges(self, pandajobs, qmsg):
+        """ Harvester has no more event ranges """
+        pandaid = str(qmsg['PandaID'])
+        self.eventranges_requested.discard(pandaid)
+        self.prefetcher.received(pandaid)
+        if pandaid in pandajobs:
+            logger.debug('no more event ranges for panda id %s', pandaid)
+            pandajobs[pandaid].eventranges.no_more_event_ranges = True
+            pandajobs.update(pandaid)
+            self.log_checkpoint({'op': 'no_more_eventranges', 'PandaID': pandaid})
+        else:
+            logger.error('received NO_MORE_EVENT_RANGES for unknown panda id %s', pandaid)
+
+    def get_queue_messages(self, block):
+        """ return all messages waiting on the queue, if block is set wait up to loop_timeout for the first one """
+        messages = []
+        try:
+            if block:
+                logger.debug('blocking on queue for %s', self.loop_timeout)
+                messages.append(self.queues['WorkManager'].get(block=True, timeout=self.loop_timeout))
+            while True:
+                messages.append(self.queues['WorkManager'].get(block=False))
+        except Queue.Empty:
+            pass
+        if len(messages) > 0:
+            logger.info('received %s messages from queue', len(messages))
+        return messages
+
+    def process_job_requests(self, pandajobs):
+        """ send a job to every rank waiting for one, returns True if anything changed """
+        if len(self.pending_job_requests) == 0:
+            return False
+
+        progress = False
+        # choose a job to send to each rank, the choice depends on the job priority
+        # and the ready events per rank running it
+        for rank in list(self.pending_job_requests.keys()):
+            job = pandajobs.get_job_with_most_ready_events()
+            if job is None and self.no_more_jobs:
+                # Harvester has no more jobs, the droid ranks can exit
+                logger.info('no more jobs, sending NO_MORE_JOBS to droid ranks %s', self.pending_job_requests.keys())
+                for rank in self.pending_job_requests:
+                    self.queues['MPIService'].put({'type': MessageTypes.NO_MORE_JOBS, 'destination_rank': rank})
+                self.pending_job_requests.clear()
+                return True
+            elif job is None:
+                # create a new request if no request is active
+                logger.info('no panda job to give out, %s droid ranks waiting for a new job', len(self.pending_job_requests))
+                return self.check_job_request(pandajobs) or progress
+
+            pandaid = str(job['PandaID'])
+            logger.info('sending droid rank %s panda id %s which has %s ready events and %s ranks',
+                        rank, pandaid, job.number_ready(), len(job.ranks))
+            outmsg = {
+                'type': MessageTypes.NEW_JOB,
+                'job': job.job_def,
+                'destination_rank': rank
+            }
+            self.queues['MPIService'].put(outmsg)
+            del self.pending_job_requests[rank]
+            pandajobs.assign_rank(rank, pandaid)
+            progress = True
+
+        return progress
+
+    def check_job_request(self, pandajobs):
+        """ launch or check on the request for jobs from Harvester, returns True if jobs were added """
+        if self.requestharvesterjob is None:
+            logger.info('launching new job request')
+            self.requestharvesterjob = RequestHarvesterJob.RequestHarvesterJob(self.config, self.queues, self.mpmgr, self.harvester_messenger)
+            self.requestharvesterjob.start()
+        elif self.requestharvesterjob.running():
+            logger.debug('request is running, job requests stay pending')
+        elif self.requestharvesterjob.exited():
+            logger.debug('request has exited')
+            jobs = self.requestharvesterjob.get_jobs()
+            if self.requestharvesterjob.no_more_jobs():
+                logger.info('Harvester has no more jobs')
+                self.no_more_jobs = True
+                self.requestharvesterjob = None
+                return True
+            elif jobs is None:
+                logger.error('request has exited and returned no jobs, reseting request object')
+                if self.requestharvesterjob.is_alive():
+                    self.requestharvesterjob.stop()
+                    logger.info('waiting for requestHarvesterJob to join')
+                    self.requestharvesterjob.join()
+                self.requestharvesterjob = None
+            else:
+                logger.info('new jobs ready, adding to PandaJobDict')
+                pandajobs.append_from_dict(jobs)
+                self.log_checkpoint({'op': 'jobs', 'jobs': dict(jobs)})
+                # reset job request
+                self.requestharvesterjob = None
+                return True
+        elif self.requestharvesterjob.state_lifetime() > 60:
+            logger.error('request is stuck in state %s recreating it.', self.requestharvesterjob.get_state())
+            if self.requestharvesterjob.is_alive():
+                self.requestharvesterjob.stop()
+                logger.info('waiting for requestHarvesterJob to join')
+                self.requestharvesterjob.join()
+                self.requestharvesterjob = None
+        else:
+            logger.debug('request is in %s state, waiting', self.requestharvesterjob.get_state())
+        return False
+
+    def process_eventrange_requests(self, pandajobs):
+        """ hand out event ranges to every waiting rank in one pass over the panda ids,
+            returns True if anything changed """
+        progress = False
+        for pandaid in list(self.pending_eventrange_requests.keys()):
+            requests = self.pending_eventrange_requests[pandaid]
+
+            if pandaid not in pandajobs:
+                logger.error('there is no eventrange for pandaID %s, this should be impossible since every pandaID in the '
+                             'pandajobs dictionary gets an empty EventRangeList object. '
+                             'Something is amiss. panda job ids: %s', pandaid, pandajobs.keys())
+                del self.pending_eventrange_requests[pandaid]
+                continue
+
+            if self.answer_eventrange_requests(pandajobs[pandaid], requests):
+                pandajobs.update(pandaid)
+                progress = True
+
+            # no event ranges remaining, prefetch_eventranges will request more
+            if len(requests) > 0:
+                logger.debug('no eventranges remain for pandaID %s, %s ranks waiting', pandaid, len(requests))
+            else:
+                del self.pending_eventrange_requests[pandaid]
+
+        return progress
+
+    def answer_eventrange_requests(self, job, requests):
+        """ send ready event ranges to the waiting ranks in the order they asked,
+            or tell them there are no more. Returns True if any rank was answered. """
+        answered = False
+        while len(requests) > 0 and job.number_ready() > 0:
+            rank, qmsg = requests.popitem(last=False)
+            nranges = self.batchsizer.batch_size(rank, job.number_ready(), self.prefetcher.active_ranks(job['PandaID']))
+            local_eventranges = self.send_eventranges(job.eventranges, qmsg, nranges)
+            self.batchsizer.sent(rank)
+            self.prefetcher.consumed(job['PandaID'], len(local_eventranges))
+            self.leases.grant(rank, job['PandaID'], [eventrange['eventRangeID'] for eventrange in local_eventranges])
+            answered = True
+
+        # if there are no event ranges left reply with such
+        if len(requests) > 0 and job.eventranges.no_more_event_ranges:
+            logger.info('no event ranges left for panda ID %s, sending NO_MORE_EVENT_RANGES to ranks %s',
+                        job['PandaID'], requests.keys())
+            for rank in requests:
+                self.queues['MPIService'].put(
+                    {'type': MessageTypes.NO_MORE_EVENT_RANGES,
+                     'destination_rank': rank,
+                     'PandaID': str(job['PandaID']),
+                     })
+            requests.clear()
+            answered = True
+
+        return answered
+
+    def prefetch_eventranges(self, pandajobs):
+        """ request more event ranges for every panda id whose ready ranges are below the low watermark """
+        for pandaid, job in pandajobs.iteritems():
+            if pandaid in self.eventranges_requested or job.eventranges.no_more_event_ranges:
+                continue
+            nranges = self.prefetcher.need(pandaid, job.number_ready())
+            if nranges > 0:
+                self.request_eventranges(job, nranges)
+
+    def request_eventranges(self, job, nranges):
+        """ ask the RequestHarvesterEventRanges service for more event ranges,
+            only one request per panda id is outstanding at a time """
+        pandaid = str(job['PandaID'])
+        if pandaid in self.eventranges_requested or job.eventranges.no_more_event_ranges:
+            return
+        logger.debug('requesting %s event ranges for panda id %s', nranges, pandaid)
+        self.queues['RequestHarvesterEventRanges'].put({
+            'type': MessageTypes.REQUEST_EVENT_RANGES,
+            'pandaID': job['PandaID'],
+            'jobsetID': job['jobsetID'],
+            'taskID': job['taskID'],
+            'nRanges': nranges,
+        })
+        self.eventranges_requested.add(pandaid)
+        self.prefetcher.requested(pandaid)
+
+    def handle_eventranges_timeout(self, pandajobs, pandaid):
+        """ Harvester did not answer the request for this panda id. Prefetches go out while ranges
+            are still ready, so the job only counts as exhausted if ranks are waiting with
+            none ready, otherwise prefetch_eventranges asks again. """
+        self.eventranges_requested.discard(pandaid)
+        self.prefetcher.cancel(pandaid)
+        if pandaid not in pandajobs:
+            logger.error('request for event ranges timed out for unknown panda id %s', pandaid)
+            return
+        job = pandajobs[pandaid]
+        nwaiting = len(self.pending_eventrange_requests.get(pandaid, {}))
+        if nwaiting > 0 and job.number_ready() == 0:
+            logger.info('request for event ranges timed out for panda id %s with %s ranks waiting and none ready, '
+                        'no more event ranges', pandaid, nwaiting)
+            job.eventranges.no_more_event_ranges = True
+            pandajobs.update(pandaid)
+            self.log_checkpoint({'op': 'no_more_eventranges', 'PandaID': pandaid})
+        else:
+            logger.info('request for event ranges timed out for panda id %s with %s ready, requesting again',
+                        pandaid, job.number_ready())
+
     def number_eventranges_ready(self, eventranges):
         total = 0
         for id, range in eventranges.iteritems():
@@ -405,19 +475,106 @@ class WorkManager(Process):
 
         return job_id
 
-    def send_eventranges(self, eventranges, qmsg):
-        """ Send the requesting MPI rank some event ranges. """
-        # get a  subset of ready eventranges up to the send_n_eventranges value
-        local_eventranges = eventranges.get_next(min(eventranges.number_ready(), self.send_n_eventranges))
+    def mark_eventranges_completed(self, pandajobs, qmsg):
+        """ mark the event ranges of the output files a rank sent as completed and update its completion rate """
+        completed = {}
+        for output_file in qmsg['filelist']:
+            pandaid = str(output_file['pandaid'])
+            if pandaid not in pandajobs:
+                logger.warning('output file for unknown panda id %s', pandaid)
+                continue
+            try:
+                pandajobs[pandaid].eventranges.mark_completed(output_file['eventrangeid'])
+            except EventRangeList.EventRangeIdNotFound:
+                logger.warning('output file for unknown eventRangeID %s of panda id %s', output_file['eventrangeid'], pandaid)
+            self.leases.release(output_file['eventrangeid'])
+            completed.setdefault(pandaid, []).append(output_file['eventrangeid'])
+        for pandaid, eventrangeids in completed.items():
+            self.log_checkpoint({'op': 'completed', 'PandaID': pandaid, 'eventRangeIDs': eventrangeids})
+        self.leases.renew(qmsg['source_rank'])
+        self.batchsizer.completed(qmsg['source_rank'], len(qmsg['filelist']))
+
+    def log_checkpoint(self, record):
+        if self.checkpoint is not None:
+            self.checkpoint.append(record)
+
+    def checkpoint_state(self, pandajobs):
+        """ the jobs and their event ranges as written to the checkpoint snapshot """
+        state = {}
+        for pandaid, job in pandajobs.iteritems():
+            state[pandaid] = {'job': job.job_def, 'eventranges': job.eventranges.dump()}
+        return state
+
+    def restore_checkpoint(self, pandajobs):
+        """ add the jobs and event ranges of the checkpoint to pandajobs, assigned ranges become ready again """
+        state, records = self.checkpoint.load()
+        if state is None:
+            logger.warning('asked to resume but there is no checkpoint, starting from scratch')
+            return
+
+        for pandaid, saved in state.items():
+            pandajobs.append_from_dict({pandaid: saved['job']})
+            pandajobs[pandaid].eventranges.load(saved['eventranges'])
+
+        for record in records:
+            pandaid = str(record.get('PandaID'))
+            if record['op'] == 'jobs':
+                pandajobs.append_from_dict(dict((jobid, job_def) for jobid, job_def in record['jobs'].items()
+                                                if str(jobid) not in pandajobs))
+            elif pandaid not in pandajobs:
+                logger.warning('checkpoint record for unknown panda id %s', pandaid)
+            elif record['op'] == 'eventranges':
+                eventranges = EventRangeList.EventRangeList()
+                eventranges.load(record['eventranges'])
+                pandajobs[pandaid].eventranges.extend(eventranges)
+            elif record['op'] == 'no_more_eventranges':
+                pandajobs[pandaid].eventranges.no_more_event_ranges = True
+            elif record['op'] == 'completed':
+                for eventrangeid in record['eventRangeIDs']:
+                    try:
+                        pandajobs[pandaid].eventranges.mark_completed(eventrangeid)
+                    except EventRangeList.EventRangeIdNotFound:
+                        logger.warning('checkpoint completed unknown eventRangeID %s of panda id %s', eventrangeid, pandaid)
+
+        for pandaid, job in pandajobs.iteritems():
+            pandajobs.update(pandaid)
+            logger.info('resumed panda id %s with %s ready and %s completed event ranges',
+                        pandaid, job.number_ready(), job.eventranges.number_completed())
+
+    def handle_droid_exited(self, pandajobs, qmsg):
+        """ a droid rank exited, its assigned ranges go back to the pool """
+        logger.debug('droid rank %s exited', qmsg['source_rank'])
+        self.pending_job_requests.pop(qmsg['source_rank'], None)
+        pandajobs.release_rank(qmsg['source_rank'])
+        self.reassign_eventranges(pandajobs, self.leases.release_rank(qmsg['source_rank']))
+
+    def handle_expired_leases(self, pandajobs):
+        """ return the ranges of ranks that stopped reporting to the pool """
+        self.reassign_eventranges(pandajobs, self.leases.expire())
+
+    def reassign_eventranges(self, pandajobs, lost):
+        """ mark the ranges of lost leases, a list of (pandaid, eventrangeid), ready to be sent to another rank """
+        pandaids = set()
+        for pandaid, eventrangeid in lost:
+            if pandaid in pandajobs and pandajobs[pandaid].eventranges.mark_ready(eventrangeid):
+                pandaids.add(pandaid)
+        for pandaid in pandaids:
+            pandajobs.update(pandaid)
+
+    def send_eventranges(self, eventranges, qmsg, nranges):
+        """ Send the requesting MPI rank nranges event ranges, or fewer if not enough are ready. """
+        local_eventranges = eventranges.get_next(min(eventranges.number_ready(), nranges))
 
         # send event ranges to Droid
         logger.info('sending %d new event ranges to droid rank %d', len(local_eventranges), qmsg['source_rank'])
         outmsg = {
             'type': MessageTypes.NEW_EVENT_RANGES,
             'eventranges': local_eventranges,
+            'PandaID': str(qmsg['PandaID']),
             'destination_rank': qmsg['source_rank'],
         }
         self.queues['MPIService'].put(outmsg)
+        return local_eventranges
 
     def read_config(self):
 
@@ -456,12 +613,27 @@ class WorkManager(Process):
                                 'Typically you should set it to the number of AthenaMP workers on a single node multiplied by the '
                                 'total number of Droid ranks running or some factor of that.' % config_section)
 
+            self._read_option('prefetch_safety_factor', float)
+            self._read_option('active_rank_timeout', float)
+            self._read_option('batch_target_time', float)
+            self._read_option('min_send_n_eventranges', int)
+            self._read_option('max_send_n_eventranges', int)
+            self._read_option('min_lease_time', float)
+            self._read_option('lease_factor', float)
+            self._read_option('lease_grace_time', float)
+            self._read_option('checkpoint', _boolean, 'use_checkpoint')
+            self._read_option('checkpoint_interval', float)
+            self._read_option('resume', _boolean)
+
         else:
             raise Exception('no %s section in the configuration' % config_section)
 
-    def pend_request(self, msg):
-        if msg in self.pending_requests:
-            self.pending_index += 1
+    def _read_option(self, name, type_, attribute=None):
+        """ set attribute, name by default, to the option converted with type_,
+            the attribute keeps its default value if the option is not set """
+        attribute = attribute or name
+        if name in self.config[config_section]:
+            setattr(self, attribute, type_(self.config[config_section][name]))
+            logger.info('%s %s: %s', config_section, name, getattr(self, attribute))
         else:
-            self.pending_requests.append(msg)
-            self.pending_index = 0
+            logger.warning('no "%s" in "%s" section of config file, keeping default %s', name, config_section, getattr(self, attribute))
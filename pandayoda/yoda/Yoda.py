@@ -131,6 +131,10 @@ class Yoda(Process):
                 else:
                     self.queues['MPIService'].put({'type': MessageTypes.DROID_EXIT, 'destination_rank': ranknum})
 
+        # have the FileManager stage the waiting output files right away
+        if self.wallclock_expired.is_set() and 'FileManager' in subthreads:
+            self.queues['FileManager'].put({'type': MessageTypes.WALLCLOCK_EXPIRING})
+
         # send the exit signal to all subthreads
         for name, thread in subthreads.iteritems():
             logger.info('sending exit signal to %s', name)
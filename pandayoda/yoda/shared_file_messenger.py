@@ -4,9 +4,9 @@ import logging
 import ConfigParser
 import time
 import glob
-import sys
+import threading
 from pandayoda.common.yoda_multiprocessing import Lock, Manager, Event
-from pandayoda.common import exceptions, serializer
+from pandayoda.common import exceptions, serializer, EventRangeList, FileWatcher
 
 logger = logging.getLogger(__name__)
 
@@ -171,6 +171,21 @@ sfm_har_config = sfm_mgr.dict()
 sfm_har_config_lock = Lock()
 sfm_har_config_done = Event()
 
+# settings of this module from the shared_file_messenger section of the yoda config
+sfm_config = sfm_mgr.dict()
+sfm_config['file_settle_time'] = 1.
+sfm_config['file_settle_timeout'] = 10.
+sfm_config['read_chunk_size'] = 65536
+sfm_config['stage_out_mode'] = 'rewrite'
+sfm_config['watch_poll_interval'] = 1.
+sfm_config['use_inotify'] = True
+
+# FileWatcher of each thread key-ed by (process id, thread id)
+sfm_watchers = {}
+
+# ways of handing output files to Harvester, see stage_out_files
+STAGE_OUT_MODES = ['rewrite', 'journal']
+
 
 def setup(config):
     global sfm_har_config, sfm_har_config_lock, sfm_har_config_done
@@ -191,6 +206,8 @@ def setup(config):
                 loglevel = config['shared_file_messenger']['loglevel']
                 logger.info('loglevel: %s', loglevel)
                 logger.setLevel(logging.getLevelName(loglevel))
+
+            read_options(config['shared_file_messenger'])
         else:
             raise Exception('must include "shared_file_messenger" section in config file')
 
@@ -218,6 +235,34 @@ def setup(config):
     sfm_har_config_lock.release()
 
 
+def read_options(section):
+    """ read the options of the shared_file_messenger section into sfm_config """
+    global sfm_config
+    # a Harvester file is only read once it has not changed for this many seconds
+    read_option(section, 'file_settle_time', float)
+    # give up waiting for a file to settle after this many seconds, and try again later
+    read_option(section, 'file_settle_timeout', float)
+    # bytes read at a time when parsing the eventRangesFile
+    read_option(section, 'read_chunk_size', int)
+    # rewrite: merge each batch of output files into eventStatusDumpJsonFile
+    # journal: append each batch to a journal, copied to eventStatusDumpJsonFile once Harvester consumed the last one
+    read_option(section, 'stage_out_mode', str)
+    if sfm_config['stage_out_mode'] not in STAGE_OUT_MODES:
+        raise Exception('stage_out_mode must be one of %s, not %s' % (STAGE_OUT_MODES, sfm_config['stage_out_mode']))
+    # Harvester files are watched with inotify where available, and checked every watch_poll_interval
+    # seconds since inotify does not see files written from other nodes of a shared file system
+    read_option(section, 'watch_poll_interval', float)
+    read_option(section, 'use_inotify', lambda value: 'true' in value.lower())
+
+
+def read_option(section, name, type_):
+    """ set sfm_config[name] to the option converted with type_ if it is in section """
+    global sfm_config
+    if name in section:
+        sfm_config[name] = type_(section[name])
+    logger.info('%s: %s', name, sfm_config[name])
+
+
 def get_config(config_filename):
     config = {}
     default = {}
@@ -250,7 +295,8 @@ def request_jobs():
     open(jobrequestfile, 'w').write('jobRequestFile')
 
 
-def pandajobs_ready():
+def pandajobs_ready(block=False, timeout=60):
+    """ returns True if Harvester has written the jobSpecFile, if block is set wait up to timeout seconds for it """
     global sfm_har_config, sfm_har_config_done
     sfm_har_config_done.wait()
     logger.debug('check if panda jobs exist')
@@ -263,7 +309,7 @@ def pandajobs_ready():
         raise Exception('could not find "jobSpecFile" in harvester config file')
 
     # check to see if a file exists.
-    if os.path.exists(jobspecfile):
+    if wait_for_file(jobspecfile, True, block, timeout):
         logger.debug('found jobSpecFile file from Harvester: %s', jobspecfile)
         return True
     else:
@@ -352,7 +398,8 @@ def request_eventranges(job_def):
         os.rename(eventrequestfile_tmp, eventrequestfile)
 
 
-def eventranges_ready(block=False, timeout=60, loop_sleep_time=5):
+def eventranges_ready(block=False, timeout=60):
+    """ returns True if Harvester has written the eventRangesFile, if block is set wait up to timeout seconds for it """
     global sfm_har_config, sfm_har_config_done
     sfm_har_config_done.wait()
     logger.debug('eventranges_ready start')
@@ -361,25 +408,19 @@ def eventranges_ready(block=False, timeout=60, loop_sleep_time=5):
     eventrangesfile = sfm_har_config['eventRangesFile']
 
     # check to see if a file exists.
-    start = time.time()
-    timewaiting = int(time.time() - start)
-    while block and (timeout > timewaiting):
-        logger.debug('checking for eventRangesFile')
-        if os.path.exists(eventrangesfile):
-            logger.debug('eventRangesFile exists')
-            return True
-        else:
-            logger.debug('no eventRangesFile so sleeping 1 second and checking again, timewaiting = %d; timeout = %d',
-                         timewaiting, timeout)
-            time.sleep(loop_sleep_time)
-            timewaiting = int(time.time() - start)
+    if wait_for_file(eventrangesfile, True, block, timeout):
+        logger.debug('eventRangesFile exists')
+        return True
 
     logger.debug('no eventRangesFile, exiting')
     return False
 
 
 def get_eventranges():
-    global sfm_har_config, sfm_har_config_done
+    """ read the eventRangesFile written by Harvester, returns a dictionary of
+        EventRangeList objects key-ed by panda id, or an empty dictionary if
+        there is no file or it is still being written """
+    global sfm_har_config, sfm_har_config_done, sfm_config
     sfm_har_config_done.wait()
     logger.debug('getting eventranges')
 
@@ -388,36 +429,16 @@ def get_eventranges():
 
     # first check to see if a file already exists.
     if os.path.exists(eventrangesfile):
+        # Harvester may still be writing the file, wait for it to settle
+        if not wait_for_stable_file(eventrangesfile, sfm_config['file_settle_time'], sfm_config['file_settle_timeout']):
+            logger.warning('eventRangesFile is still changing after %s seconds, will read it later', sfm_config['file_settle_timeout'])
+            return {}
+
+        newname = eventrangesfile
         try:
             logger.debug('eventRangesFile is present, parsing event ranges')
-            # read in event range file
-            fstat = os.stat(eventrangesfile)
-            logger.debug('eventRangesFile stat: %s', str(fstat))
-            try:
-                eventranges = json.load(open(eventrangesfile))
-            except Exception:
-                # try again if the files modify time is within 10 seconds
-                succeeded = False
-                time_since_last_modified = fstat.st_mtime - time.time()
-                while time_since_last_modified < 10 and not succeeded:
-                    try:
-                        logger.debug(' trying again to open eventRangesFile: %s', str(fstat))
-                        eventranges = json.load(open(eventrangesfile))
-                        succeeded = True
-                    except Exception:
-                        logger.debug(' failed to open, time since last modified is %d seconds',
-                                     time_since_last_modified)
-                        time.sleep(1)
-                        # update data before checking again
-                        fstat = os.stat(eventrangesfile)
-                        time_since_last_modified = fstat.st_mtime - time.time()
-
-                if not succeeded:
-                    raise Exception(
-                        'failed to open eventRangesFile, even after waiting for modified status. '
-                        'Time since last modified: %d seconds' % time_since_last_modified)
-
-            logger.debug('received json object with size %s bytes', sys.getsizeof(eventranges))
+            eventranges = read_eventranges_file(eventrangesfile, sfm_config['read_chunk_size'])
+
             for jobid, ranges in eventranges.iteritems():
                 logger.debug('received %s ranges for Panda ID: %s', len(ranges), jobid)
 
@@ -440,6 +461,135 @@ def get_eventranges():
     return {}
 
 
+def wait_for_stable_file(filename, settle_time, timeout):
+    """ wait until the size and modification time of a file have not changed for
+        settle_time seconds, returns False if that does not happen within timeout.
+        A file last modified settle_time ago is stable right away. Otherwise, and when
+        the modification time comes from a clock running ahead of the local one, two
+        stats taken settle_time apart on the local clock have to agree. """
+    start = time.time()
+    fstat = os.stat(filename)
+    if start - fstat.st_mtime >= settle_time:
+        return True
+    while time.time() - start + settle_time <= timeout:
+        time.sleep(settle_time)
+        newstat = os.stat(filename)
+        if newstat.st_size == fstat.st_size and newstat.st_mtime == fstat.st_mtime:
+            return True
+        logger.debug('%s changed while waiting for it to settle, size %s -> %s', filename, fstat.st_size, newstat.st_size)
+        fstat = newstat
+    return False
+
+
+def read_eventranges_file(filename, chunk_size=65536):
+    """ parse an eventRangesFile into a dictionary of EventRangeList objects key-ed by panda id,
+        one range at a time, without holding the whole document in memory """
+    eventranges = {}
+    with open(filename) as fileobj:
+        for pandaid, eventrange in iter_eventranges(fileobj, chunk_size):
+            if pandaid not in eventranges:
+                eventranges[pandaid] = EventRangeList.EventRangeList()
+            erl = eventranges[pandaid]
+            # a panda id with an empty list still gets an entry
+            if eventrange is None:
+                continue
+            if eventrange['eventRangeID'] in erl:
+                logger.warning('eventRangesFile lists eventRangeID %s twice', eventrange['eventRangeID'])
+                continue
+            erl.add_row(eventrange['eventRangeID'], eventrange['LFN'], eventrange['GUID'], eventrange['scope'],
+                        eventrange['startEvent'], eventrange['lastEvent'], EventRangeList.EventRangeList.READY)
+    return eventranges
+
+
+def iter_eventranges(fileobj, chunk_size=65536):
+    """ incrementally parse a file of the form {"pandaid": [{range}, ...], ...},
+        yields (pandaid, range dictionary) pairs. Panda ids with no ranges are yielded
+        as (pandaid, None). Raises MessengerFileIncomplete if the file ends before the
+        top level object is closed. """
+    reader = JSONStreamReader(fileobj, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.expect('}')
+    else:
+        while True:
+            pandaid = reader.decode()
+            reader.expect(':')
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
+                yield pandaid, None
+            else:
+                while True:
+                    yield pandaid, reader.decode()
+                    if reader.expect(',]') == ']':
+                        break
+            if reader.expect(',}') == '}':
+                break
+    if reader.peek() is not None:
+        raise exceptions.MessengerFailedToParse('unexpected data after the end of the event ranges')
+
+
+class JSONStreamReader(object):
+    """ reads a JSON document from a file in chunks, decoding one value at a time """
+
+    def __init__(self, fileobj, chunk_size=65536):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """ read the next chunk, dropping the part of the buffer already parsed. Returns False at the end of the file. """
+        if self.eof:
+            return False
+        chunk = self.fileobj.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ return the next non-whitespace character without consuming it, None at the end of the file """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return None
+
+    def expect(self, chars):
+        """ consume the next non-whitespace character, which must be one of chars, and return it """
+        char = self.peek()
+        if char is None:
+            raise exceptions.MessengerFileIncomplete('file ended while expecting one of "%s"' % chars)
+        if char not in chars:
+            raise exceptions.MessengerFailedToParse('expected one of "%s" but found "%s"' % (chars, char))
+        self.pos += 1
+        return char
+
+    def decode(self):
+        """ decode the next JSON value, reading more of the file if the value runs past the buffer """
+        if self.peek() is None:
+            raise exceptions.MessengerFileIncomplete('file ended while expecting a value')
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise exceptions.MessengerFailedToParse('could not decode value at: %s' % self.buf[self.pos:self.pos + 100])
+                continue
+            # a number at the very end of the buffer may continue in the next chunk
+            if end == len(self.buf) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
 '''
 The worker needs to put eventStatusDumpJsonFile to update events and/or stage-out. The file is a json dump of a dictionary
 {pandaID_1:[{'eventRangeID':???, 'eventStatus':???, 'path':???, 'type':???, 'chksum':???, 'guid':???}, ...],
@@ -462,6 +612,38 @@ def stage_out_file_exists():
     return os.path.exists(eventstatusdumpjsonfile)
 
 
+def wait_for_stage_out_file(exists, timeout=60):
+    """ wait up to timeout seconds for the eventStatusDumpJsonFile to be written (exists=True)
+        or consumed by Harvester (exists=False), returns False on timeout """
+    global sfm_har_config, sfm_har_config_done
+    sfm_har_config_done.wait()
+
+    return wait_for_file(sfm_har_config['eventStatusDumpJsonFile'], exists, True, timeout)
+
+
+def get_watcher():
+    """ the FileWatcher of the calling thread. The messenger functions are called from several
+        processes and threads, each needs its own inotify file descriptor since reading the
+        events of a shared one would take them away from the other threads waiting on it """
+    global sfm_watchers, sfm_config
+    key = (os.getpid(), threading.current_thread().ident)
+    if key not in sfm_watchers:
+        # close the watchers of threads that ended, those of a parent process are left alone
+        alive = set(thread.ident for thread in threading.enumerate())
+        for pid, ident in list(sfm_watchers.keys()):
+            if pid == os.getpid() and ident not in alive:
+                sfm_watchers.pop((pid, ident)).close()
+        sfm_watchers[key] = FileWatcher.FileWatcher(sfm_config['watch_poll_interval'], sfm_config['use_inotify'])
+    return sfm_watchers[key]
+
+
+def wait_for_file(filename, exists=True, block=True, timeout=60):
+    """ returns True if os.path.exists(filename) equals exists, if block is set wait up to timeout seconds for it """
+    if not block:
+        return os.path.exists(filename) == exists
+    return get_watcher().wait_for(filename, exists, timeout)
+
+
 def stage_out_file(output_type, output_path, eventrangeid, eventstatus, pandaid, chksum=None, ):
     global sfm_har_config, sfm_har_config_done
     sfm_har_config_done.wait()
@@ -534,40 +716,21 @@ def stage_out_file(output_type, output_path, eventrangeid, eventstatus, pandaid,
 
 
 def stage_out_files(file_list, output_type):
-    global sfm_har_config, sfm_har_config_done
+    global sfm_har_config, sfm_har_config_done, sfm_config
     sfm_har_config_done.wait()
 
     if output_type not in ['output', 'es_output', 'log']:
         raise Exception('incorrect type provided: %s' % (output_type))
 
     # load name of eventStatusDumpJsonFile file
-        eventstatusdumpjsonfile = sfm_har_config['eventStatusDumpJsonFile']
-
-    eventstatusdumpdata = {}
-    # loop over filelist
-    for filedata in file_list:
-
-        # make sure pandaID is a string
-        pandaid = str(filedata['pandaid'])
-
-        chksum = None
-        if 'chksum' in filedata:
-            chksum = filedata['chksum']
+    eventstatusdumpjsonfile = sfm_har_config['eventStatusDumpJsonFile']
 
-        # filename = os.path.join(output_path,os.path.basename(filedata['filename']))
+    eventstatusdumpdata = get_file_descriptors(file_list, output_type)
 
-        # format data for file:
-        file_descriptor = {'eventRangeID': filedata['eventrangeid'],
-                           'eventStatus': filedata['eventstatus'],
-                           'path': filedata['filename'],
-                           'type': output_type,
-                           'chksum': chksum,
-                           'guid': None,
-                           }
-        try:
-            eventstatusdumpdata[pandaid].append(file_descriptor)
-        except KeyError:
-            eventstatusdumpdata[pandaid] = [file_descriptor]
+    if sfm_config['stage_out_mode'] == 'journal':
+        append_stage_out_journal(eventstatusdumpdata)
+        compact_stage_out_journal()
+        return
 
     # create a temp file to place contents
     # this avoids Harvester trying to read the file while it is being written
@@ -620,3 +783,128 @@ def stage_out_files(file_list, output_type):
     os.rename(eventstatusdumpjsonfile_tmp, eventstatusdumpjsonfile)
 
     logger.debug('done')
+
+
+def get_file_descriptors(file_list, output_type):
+    """ format the output files for eventStatusDumpJsonFile, returns the descriptors key-ed by panda id """
+    eventstatusdumpdata = {}
+    # loop over filelist
+    for filedata in file_list:
+
+        # make sure pandaID is a string
+        pandaid = str(filedata['pandaid'])
+
+        chksum = None
+        if 'chksum' in filedata:
+            chksum = filedata['chksum']
+
+        # filename = os.path.join(output_path,os.path.basename(filedata['filename']))
+
+        # format data for file:
+        file_descriptor = {'eventRangeID': filedata['eventrangeid'],
+                           'eventStatus': filedata['eventstatus'],
+                           'path': filedata['filename'],
+                           'type': output_type,
+                           'chksum': chksum,
+                           'guid': None,
+                           }
+        try:
+            eventstatusdumpdata[pandaid].append(file_descriptor)
+        except KeyError:
+            eventstatusdumpdata[pandaid] = [file_descriptor]
+
+    return eventstatusdumpdata
+
+
+'''
+In the journal stage out mode each batch of output files is appended to <eventStatusDumpJsonFile>.journal
+as one line of JSON holding the descriptors key-ed by panda id. A line only counts once its newline is
+written, a batch cut short by a crash is dropped when the journal is read. Whenever eventStatusDumpJsonFile
+is absent, because Harvester consumed it, the journal is compacted into a new eventStatusDumpJsonFile in the
+usual single file format. Each flush therefore only writes its own batch, and each batch is copied once more
+when it is handed to Harvester.
+
+The next append after a crash first ends the cut short batch with a newline, so it keeps a line of its own
+instead of running into the next batch.
+'''
+
+
+def append_stage_out_journal(eventstatusdumpdata):
+    """ append one batch of file descriptors, key-ed by panda id, to the stage out journal """
+    global sfm_har_config, sfm_har_config_done
+    sfm_har_config_done.wait()
+
+    journalfile = sfm_har_config['eventStatusDumpJsonFile'] + '.journal'
+
+    # the whole record goes out in one write, the trailing newline marks it committed
+    record = serializer.serialize(eventstatusdumpdata) + '\n'
+    with open(journalfile, 'a+') as f:
+        # a record torn by a crash gets its own line, otherwise it would merge with this one
+        f.seek(0, os.SEEK_END)
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != '\n':
+                logger.warning('closing off an uncommitted record at the end of %s', journalfile)
+                record = '\n' + record
+        f.write(record)
+        f.flush()
+        os.fsync(f.fileno())
+
+    logger.debug('appended %s files to %s', sum(len(x) for x in eventstatusdumpdata.values()), journalfile)
+
+
+def compact_stage_out_journal():
+    """ if Harvester has consumed eventStatusDumpJsonFile, write the committed journal records
+        to a new eventStatusDumpJsonFile. Returns the number of files handed to Harvester. """
+    global sfm_har_config, sfm_har_config_done
+    sfm_har_config_done.wait()
+
+    eventstatusdumpjsonfile = sfm_har_config['eventStatusDumpJsonFile']
+    journalfile = eventstatusdumpjsonfile + '.journal'
+    compactingfile = journalfile + '.compacting'
+
+    # wait for Harvester to consume the current file
+    if os.path.exists(eventstatusdumpjsonfile):
+        return 0
+
+    # move the journal aside so new batches start a new journal. A file left
+    # from an interrupted compaction has not been handed to Harvester yet.
+    if not os.path.exists(compactingfile):
+        if not os.path.exists(journalfile):
+            return 0
+        os.rename(journalfile, compactingfile)
+
+    data = {}
+    nfiles = 0
+    with open(compactingfile) as f:
+        for line in f:
+            if not line.endswith('\n'):
+                logger.warning('dropping uncommitted record at the end of %s', compactingfile)
+                break
+            try:
+                record = serializer.deserialize(line)
+            except ValueError:
+                logger.warning('dropping uncommitted record in %s: %s', compactingfile, line[:100])
+                continue
+            for pandaid, descriptors in record.iteritems():
+                nfiles += len(descriptors)
+                try:
+                    data[pandaid] += descriptors
+                except KeyError:
+                    data[pandaid] = descriptors
+
+    if nfiles > 0:
+        logger.debug('compacting %s files from %s into %s', nfiles, compactingfile, eventstatusdumpjsonfile)
+        # write to a temp file so Harvester never sees a partial file
+        eventstatusdumpjsonfile_tmp = eventstatusdumpjsonfile + '.tmp'
+        with open(eventstatusdumpjsonfile_tmp, 'w') as f:
+            f.write(serializer.serialize(data, pretty_print=True))
+        os.rename(eventstatusdumpjsonfile_tmp, eventstatusdumpjsonfile)
+
+    os.remove(compactingfile)
+    return nfiles
+
+
+def stage_out_journal_enabled():
+    global sfm_config
+    return sfm_config['stage_out_mode'] == 'journal'
@@ -67,6 +67,8 @@ def main():  # noqa: C901
                          help='The wall clock time limit in minutes. If given, yoda will trigger all droid ranks to kill their subprocesses and exit.'
                               'Then Yoda will perform log/output file cleanup.',
                          default=-1, type=int)
+    oparser.add_argument('--resume', dest='resume', default=False, action='store_true',
+                         help='Resume the work of a previous allocation from the checkpoint in the working path.')
     # control output level
     oparser.add_argument('--debug', dest='debug', default=False, action='store_true', help="Set Logger to DEBUG")
     oparser.add_argument('--error', dest='error', default=False, action='store_true', help="Set Logger to ERROR")
@@ -97,6 +99,12 @@ def main():  # noqa: C901
     except Exception:
         raise
 
+    # resume from the checkpoint of the WorkManager and FileManager
+    if args.resume:
+        for section in ['WorkManager', 'FileManager']:
+            if section in config:
+                config[section]['resume'] = 'true'
+
     # start the MPI service
     if 'MPIService' in config:
 
@@ -115,6 +123,30 @@ def main():  # noqa: C901
         mpi_loop_timeout = 30
         if 'loop_timeout' in config['MPIService']:
             mpi_loop_timeout = int(config['MPIService']['loop_timeout'])
+
+        mpi_min_poll_interval = 0.0001
+        if 'min_poll_interval' in config['MPIService']:
+            mpi_min_poll_interval = float(config['MPIService']['min_poll_interval'])
+
+        mpi_max_poll_interval = 0.001
+        if 'max_poll_interval' in config['MPIService']:
+            mpi_max_poll_interval = float(config['MPIService']['max_poll_interval'])
+
+        mpi_max_in_flight_bytes = 100000000
+        if 'max_in_flight_bytes' in config['MPIService']:
+            mpi_max_in_flight_bytes = int(config['MPIService']['max_in_flight_bytes'])
+
+        mpi_detach_sends = False
+        if 'detach_sends' in config['MPIService']:
+            mpi_detach_sends = 'true' in config['MPIService']['detach_sends'].lower()
+
+        mpi_receive_mode = MPIService.MPIService.IRECV_RECEIVE
+        if 'receive_mode' in config['MPIService']:
+            mpi_receive_mode = config['MPIService']['receive_mode']
+
+        mpi_wire_format = MPIService.MPIService.PICKLE_WIRE_FORMAT
+        if 'wire_format' in config['MPIService']:
+            mpi_wire_format = config['MPIService']['wire_format']
     else:
         raise Exception('no MPIService configuration')
 
@@ -136,6 +168,12 @@ def main():  # noqa: C901
         mpi_debug_message_char_length,
         mpi_default_message_buffer_size,
         mpi_loop_timeout,
+        mpi_min_poll_interval,
+        mpi_max_poll_interval,
+        mpi_max_in_flight_bytes,
+        mpi_detach_sends,
+        mpi_receive_mode,
+        mpi_wire_format,
     )
     # start the subprocess
     mpiservice.start()